@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+""" Content-addressed array artifacts passed between NiPype nodes by handle.
+
+timeevents returns its events as a list (one per run) of {condition:
+DataFrame}. Passed as is, NiPype pickles the DataFrames into the result
+file of the node, unpickles them for every consumer and evt_info deep
+copies every column again. Instead, the events of a run are stored once as
+
+    <root>/events/<sha1>.npz    condition -> (events x [time, dur,
+                                amplitude]) float64
+
+and only the path (the handle) goes through the connections. The name is
+the SHA1 of the content, so identical events share one file and NiPype's
+hash of the handle changes exactly when the events change.
+
+The root is $NHP_ARTIFACT_DIR or <dataset>/workingdirs/artifacts, which is
+shared by the nodes of a PBS run.
+
+Compare the cost of both ways with:
+
+    python -m artifacts --benchmark
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+
+ds_root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+EVENT_FIELDS = ['time', 'dur', 'amplitude']
+
+
+def artifact_root(root=None):
+    if root is None:
+        root = os.environ.get('NHP_ARTIFACT_DIR',
+                              os.path.join(ds_root, 'workingdirs',
+                                           'artifacts'))
+    return os.path.abspath(root)
+
+
+def is_handle(obj):
+    return isinstance(obj, str) and obj.endswith('.npz')
+
+
+def save_arrays(kind, arrays, root=None):
+    """ Store {name: array} (in order) as <root>/<kind>/<sha1>.npz and
+    return its path. Existing artifacts are not rewritten.
+    """
+    h = hashlib.sha1()
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        h.update(name.encode('UTF-8'))
+        h.update(str(array.dtype).encode('UTF-8'))
+        h.update(str(array.shape).encode('UTF-8'))
+        h.update(array.tobytes())
+
+    out_dir = os.path.join(artifact_root(root), kind)
+    out_file = os.path.join(out_dir, h.hexdigest() + '.npz')
+    if not os.path.isfile(out_file):
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        tmp = '%s.%d.tmp.npz' % (out_file[:-len('.npz')], os.getpid())
+        order = np.array(list(arrays.keys()), dtype=str)
+        np.savez(tmp, __order__=order, **arrays)
+        os.rename(tmp, out_file)
+    return out_file
+
+
+def load_arrays(handle):
+    """ {name: array} of an artifact, in the order it was saved.
+    """
+    from collections import OrderedDict
+    with np.load(handle) as data:
+        return OrderedDict((str(name), data[name])
+                           for name in data['__order__'])
+
+
+def save_events(events, root=None):
+    """ Handle of the events of one run, {condition: DataFrame or dict of
+    arrays with time, dur and amplitude}.
+    """
+    from collections import OrderedDict
+    arrays = OrderedDict()
+    for name, ev in events.items():
+        columns = [np.asarray(ev[field], dtype=np.float64)
+                   for field in EVENT_FIELDS]
+        arrays[name] = np.stack(columns, axis=1).reshape(-1, 3)
+    return save_arrays('events', arrays, root)
+
+
+def load_events(handle):
+    """ {condition: {time, dur, amplitude: arrays}} of an events handle; other
+    objects (e.g. {condition: DataFrame}) are returned unchanged.
+    """
+    from collections import OrderedDict
+    if not is_handle(handle):
+        return handle
+    events = OrderedDict()
+    for name, array in load_arrays(handle).items():
+        events[name] = dict(zip(EVENT_FIELDS, array.T))
+    return events
+
+
+# --------------------------------------------------------- Benchmark
+
+def _synthetic_events(n_runs=8, n_conditions=16, n_events=300, seed=0):
+    import pandas as pd
+
+    rng = np.random.RandomState(seed)
+    runs = []
+    for _ in range(n_runs):
+        events = dict()
+        for c in range(n_conditions):
+            events['cond%d' % c] = pd.DataFrame(dict(
+                time=np.sort(rng.uniform(0, 1200, n_events)),
+                dur=rng.uniform(0, 2, n_events),
+                amplitude=np.ones(n_events)))
+        runs.append(events)
+    return runs
+
+
+def benchmark(repeat=5, root=None):
+    """ Time NiPype's way of passing the events (pickle of the result,
+    unpickle, deep copy of the columns by evt_info) against handles.
+    """
+    import pickle
+    import tempfile
+    import time
+    from copy import deepcopy
+
+    if root is None:
+        root = tempfile.mkdtemp()
+    runs = _synthetic_events()
+
+    def best(f):
+        times = []
+        for _ in range(repeat):
+            start = time.time()
+            f()
+            times.append(time.time() - start)
+        return min(times)
+
+    def dataframes():
+        data = pickle.loads(pickle.dumps(runs, protocol=2))
+        for ev in data:
+            for name in ev:
+                for field in EVENT_FIELDS:
+                    deepcopy(ev[name][field])
+
+    handles = [save_events(ev, root) for ev in runs]
+
+    def by_handle():
+        data = pickle.loads(pickle.dumps(
+            [save_events(ev, root) for ev in runs], protocol=2))
+        for handle in data:
+            ev = load_events(handle)
+            for name in ev:
+                for field in EVENT_FIELDS:
+                    ev[name][field].tolist()
+
+    rows = [
+        ('pickled DataFrames', len(pickle.dumps(runs, protocol=2)),
+         best(dataframes)),
+        ('handles', len(pickle.dumps(handles, protocol=2)),
+         best(by_handle)),
+    ]
+    print('%-20s %14s %10s' % ('', 'pickle bytes', 'time (ms)'))
+    for name, size, seconds in rows:
+        print('%-20s %14d %10.1f' % (name, size, seconds * 1000))
+    return rows
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Content-addressed artifacts passed by handle.')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Compare pickling events with handles.')
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark()
+    else:
+        parser.print_help()
@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+
+""" SQLite index of the dataset, answering SelectFiles templates without
+globbing the network file system.
+
+Every file and directory under the dataset (sourcedata/, the BIDS root and
+derivatives/; not workingdirs/, code/ or hidden files) is a row of
+
+    entries(path, parent, name, is_dir, sub, ses, task, run, res, desc,
+            suffix, ext)
+
+with the BIDS entities parsed from its name, and every directory a row of
+dirs(path, mtime_ns, indexed_ns). A refresh only lists the directories
+whose mtime changed since they were indexed (adding or removing an entry
+changes the mtime of its directory), the others just cost a stat. The
+directories are opened to stat them, which revalidates their attributes
+on NFS, and a row is only trusted when the directory's mtime is older
+than the row by RACY_NS: an entry added in the same mtime tick as the
+listing, or hidden by the attribute cache of the host that listed it,
+would otherwise never be seen.
+
+IndexedSelectFiles is a drop-in replacement for nio.SelectFiles. The
+index is only written where the workflow is built: creating the node
+refreshes the directories its templates can match. The nodes (e.g. in PBS
+jobs on other hosts) open it read-only and only stat the directories a
+filled template can match: if one changed since it was indexed or is too
+recent to trust, nothing matches, or SQLite fails, the template is
+globbed.
+Templates outside the dataset are globbed.
+
+Build or refresh the index and show its size with:
+
+    python -m bids_index
+    python -m bids_index --rebuild
+"""
+
+import fnmatch
+import glob
+import os
+import re
+import sqlite3
+import time
+from urllib.parse import quote
+
+
+ds_root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+ENTITIES = ['sub', 'ses', 'task', 'run', 'res', 'desc']
+EXCLUDE = ['workingdirs', 'code']
+# longer than the NFS attribute cache (acdirmax) plus clock skew
+RACY_NS = 60 * 10**9
+
+_entity_re = re.compile(r'(?:^|_)(%s)-([a-zA-Z0-9]+)' % '|'.join(ENTITIES))
+_wildcard_re = re.compile(r'[*?[]')
+
+
+def parse_entities(name):
+    """ {entity: value} of a BIDS file name, with its suffix and extension,
+    e.g. sub-eddy_ses-20180117_task-ct_run-01_bold.nii.gz gives sub, ses,
+    task, run, suffix='bold' and ext='.nii.gz'.
+    """
+    base, ext = name, ''
+    for known in ('.nii.gz', '.tsv.gz', '.param.1D'):
+        if name.endswith(known):
+            base, ext = name[:-len(known)], known
+            break
+    else:
+        if '.' in name[1:]:
+            base, ext = name[:name.index('.', 1)], name[name.index('.', 1):]
+    out = dict((key, value) for key, value in _entity_re.findall(base))
+    parts = base.split('_')
+    if len(parts) > 1 and '-' not in parts[-1]:
+        out['suffix'] = parts[-1]
+    out['ext'] = ext
+    return out
+
+
+def dir_mtime_ns(path):
+    """ mtime of directory `path`; opening it revalidates the cached
+    attributes on NFS (close-to-open), a plain stat may not.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.fstat(fd).st_mtime_ns
+    finally:
+        os.close(fd)
+
+
+def _trusted(row, mtime_ns):
+    """ Whether the dirs row (mtime_ns, indexed_ns) still lists a directory
+    with mtime `mtime_ns`.
+    """
+    return row is not None and row[0] == mtime_ns and \
+        mtime_ns < row[1] - RACY_NS
+
+
+def default_index_file():
+    return os.path.join(ds_root, 'workingdirs', 'bids_index.sqlite')
+
+
+class BIDSIndex(object):
+    def __init__(self, base_directory=ds_root, index_file=None,
+                 exclude=EXCLUDE, readonly=False):
+        self.base = os.path.abspath(base_directory)
+        self.index_file = os.path.abspath(index_file or
+                                          default_index_file())
+        self.exclude = set(exclude)
+        self.stats = dict(stat=0, listed=0)
+        if readonly:
+            # shared lock: a concurrent refresh is waited for, not read
+            # half-written
+            self.db = sqlite3.connect(
+                'file:%s?mode=ro' % quote(self.index_file), uri=True,
+                timeout=60)
+            return
+        if not os.path.isdir(os.path.dirname(self.index_file)):
+            os.makedirs(os.path.dirname(self.index_file))
+        self.db = sqlite3.connect(self.index_file, timeout=60)
+        columns = [r[1] for r in self.db.execute('PRAGMA table_info(dirs)')]
+        if columns and 'indexed_ns' not in columns:
+            # older layout: index again
+            self.db.executescript('''
+                DROP TABLE dirs;
+                DROP TABLE IF EXISTS entries;
+            ''')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS dirs (
+                path TEXT PRIMARY KEY, mtime_ns INTEGER,
+                indexed_ns INTEGER);
+            CREATE TABLE IF NOT EXISTS entries (
+                path TEXT PRIMARY KEY, parent TEXT, name TEXT,
+                is_dir INTEGER, %s, suffix TEXT, ext TEXT);
+            CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent);
+            CREATE INDEX IF NOT EXISTS entries_sub_ses ON entries (sub, ses);
+        ''' % ', '.join('%s TEXT' % e for e in ENTITIES))
+
+    def close(self):
+        self.db.close()
+
+    def _relative(self, path):
+        """ Path relative to the dataset ('' for the dataset itself), or
+        None outside of it.
+        """
+        path = os.path.abspath(path)
+        if path == self.base:
+            return ''
+        if not path.startswith(self.base + os.sep):
+            return None
+        return path[len(self.base) + 1:]
+
+    def _remove(self, rel):
+        """ Remove the entry `rel` and everything below it.
+        """
+        prefix = rel + '/'
+        for table in ('entries', 'dirs'):
+            self.db.execute(
+                'DELETE FROM %s WHERE path = ? OR '
+                'substr(path, 1, ?) = ?' % table,
+                (rel, len(prefix), prefix))
+
+    def _scan(self, rel, depth):
+        """ Refresh directory `rel` if its mtime changed, and its
+        subdirectories down to `depth` levels (None: all).
+        """
+        full = os.path.join(self.base, rel) if rel else self.base
+        self.stats['stat'] += 1
+        try:
+            mtime_ns = dir_mtime_ns(full)
+        except OSError:
+            self._remove(rel)
+            return
+        row = self.db.execute(
+            'SELECT mtime_ns, indexed_ns FROM dirs WHERE path = ?',
+            (rel,)).fetchone()
+        if not _trusted(row, mtime_ns):
+            self.stats['listed'] += 1
+            indexed_ns = int(time.time() * 10**9)
+            entries = dict()
+            for entry in os.scandir(full):
+                if entry.name.startswith('.') or \
+                        (not rel and entry.name in self.exclude):
+                    continue
+                entries[entry.name] = entry.is_dir()
+            known = dict(self.db.execute(
+                'SELECT name, is_dir FROM entries WHERE parent = ?', (rel,)))
+            for name, is_dir in known.items():
+                if entries.get(name) != bool(is_dir):
+                    self._remove(os.path.join(rel, name) if rel else name)
+            rows = []
+            for name, is_dir in entries.items():
+                if known.get(name) == is_dir:
+                    continue
+                info = parse_entities(name)
+                rows.append([os.path.join(rel, name) if rel else name, rel,
+                             name, int(is_dir)] +
+                            [info.get(e) for e in ENTITIES] +
+                            [info.get('suffix'), info['ext']])
+            self.db.executemany(
+                'INSERT OR REPLACE INTO entries VALUES (%s)' %
+                ', '.join('?' * (6 + len(ENTITIES))), rows)
+            self.db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)',
+                            (rel, mtime_ns, indexed_ns))
+
+        if depth == 0:
+            return
+        subdirs = [r[0] for r in self.db.execute(
+            'SELECT path FROM entries WHERE parent = ? AND is_dir = 1',
+            (rel,))]
+        for subdir in subdirs:
+            self._scan(subdir, None if depth is None else depth - 1)
+
+    def _changed(self, rel, depth):
+        """ Whether directory `rel`, or its subdirectories down to `depth`
+        levels, changed since they were indexed or are too recent to trust
+        (stat only).
+        """
+        full = os.path.join(self.base, rel) if rel else self.base
+        self.stats['stat'] += 1
+        row = self.db.execute(
+            'SELECT mtime_ns, indexed_ns FROM dirs WHERE path = ?',
+            (rel,)).fetchone()
+        try:
+            if not _trusted(row, dir_mtime_ns(full)):
+                return True
+        except OSError:
+            return True
+        if depth == 0:
+            return False
+        return any(self._changed(r[0], None if depth is None else depth - 1)
+                   for r in self.db.execute(
+                       'SELECT path FROM entries WHERE parent = ? AND '
+                       'is_dir = 1', (rel,)).fetchall())
+
+    def refresh(self, path=None, depth=None):
+        """ Bring the index of `path` (default: the dataset) up to date,
+        down to `depth` levels of subdirectories (None: all).
+        Returns {stat: directories checked, listed: directories listed}.
+        """
+        rel = '' if path is None else self._relative(path)
+        if rel is None:
+            raise ValueError('%s is not in %s' % (path, self.base))
+        self.stats = dict(stat=0, listed=0)
+        with self.db:
+            self._scan(rel, depth)
+        return self.stats
+
+    def rebuild(self):
+        with self.db:
+            self.db.execute('DELETE FROM entries')
+            self.db.execute('DELETE FROM dirs')
+        return self.refresh()
+
+    def glob(self, pattern, refresh=True):
+        """ As glob.glob(pattern) for an absolute pattern in the dataset,
+        from the index. With refresh, the directories that the pattern can
+        match are refreshed first; without, None if one of them changed
+        since it was indexed or is too recent to trust.
+        """
+        find_dirs = pattern.endswith(os.sep)
+        rel = self._relative(pattern.rstrip(os.sep))
+        parts = rel.split('/') if rel else []
+        if rel is None or (parts and parts[0] in self.exclude):
+            return glob.glob(pattern)
+        n_fixed = 0
+        while n_fixed < len(parts) and \
+                not _wildcard_re.search(parts[n_fixed]):
+            n_fixed += 1
+        if n_fixed == len(parts):
+            # nothing to match
+            exists = os.path.isdir(pattern) if find_dirs \
+                else os.path.exists(pattern)
+            return [pattern] if exists else []
+
+        prefix = '/'.join(parts[:n_fixed])
+        prefix_dir = os.path.join(self.base, prefix)
+        if not os.path.isdir(prefix_dir):
+            return []
+        if refresh:
+            self.refresh(prefix_dir, depth=len(parts) - n_fixed - 1)
+        elif self._changed(prefix, len(parts) - n_fixed - 1):
+            return None
+
+        query = 'SELECT path, is_dir FROM entries WHERE path GLOB ?'
+        like = (prefix + '/' if prefix else '') + '*'
+        out = []
+        for path, is_dir in self.db.execute(query, (like,)):
+            names = path.split('/')
+            if len(names) != len(parts) or (find_dirs and not is_dir):
+                continue
+            if all(fnmatch.fnmatchcase(n, p)
+                   for n, p in zip(names[n_fixed:], parts[n_fixed:])):
+                out.append(os.path.join(self.base, path) +
+                           (os.sep if find_dirs else ''))
+        return out
+
+    def find(self, **entities):
+        """ Absolute paths of the files whose entities (sub, ses, task, run,
+        res, desc, suffix, ext) equal the given values.
+        """
+        keys = sorted(entities)
+        where = ' AND '.join('%s = ?' % k for k in keys) or '1'
+        rows = self.db.execute(
+            'SELECT path FROM entries WHERE is_dir = 0 AND %s ORDER BY path'
+            % where, [entities[k] for k in keys])
+        return [os.path.join(self.base, r[0]) for r in rows]
+
+    def counts(self):
+        return dict(
+            files=self.db.execute(
+                'SELECT COUNT(*) FROM entries WHERE is_dir = 0').fetchone()[0],
+            dirs=self.db.execute('SELECT COUNT(*) FROM dirs').fetchone()[0])
+
+
+# --------------------------------------------------------- NiPype interface
+
+import nipype.interfaces.io as nio
+
+
+_refreshed = set()
+
+
+def refresh_templates(templates, base_directory=None, index_file=None):
+    """ Refresh the directories of the index that templates (relative to
+    base_directory) can match, once per process.
+    """
+    base = base_directory or os.getcwd()
+    paths = set()
+    for template in templates.values():
+        template = os.path.abspath(os.path.join(base, template))
+        fixed = re.split(r'[{*?[]', template)[0]
+        path = fixed if fixed.endswith(os.sep) else os.path.dirname(fixed)
+        path = path.rstrip(os.sep) or os.sep
+        if path == ds_root or path.startswith(ds_root + os.sep):
+            paths.add(path)
+    paths -= _refreshed
+    if not paths:
+        return
+    try:
+        index = BIDSIndex(ds_root, index_file)
+        try:
+            for path in sorted(paths):
+                # the closest indexed ancestor, if path doesn't exist yet
+                while not os.path.isdir(path):
+                    path = os.path.dirname(path)
+                if path not in _refreshed:
+                    index.refresh(path)
+                    _refreshed.add(path)
+        finally:
+            index.close()
+    except (sqlite3.Error, ValueError) as e:
+        print('Warning: BIDS index not refreshed (%s)' % e)
+
+
+class IndexedSelectFiles(nio.SelectFiles):
+    """ nio.SelectFiles answered from a BIDSIndex of the dataset (see
+    bids_index.py), with the same templates, inputs and outputs. The
+    index is refreshed when the node is created, and read-only in the
+    node.
+    """
+
+    def __init__(self, templates, index_file=None, **kwargs):
+        super(IndexedSelectFiles, self).__init__(templates, **kwargs)
+        self._index_file = index_file
+        refresh_templates(templates, kwargs.get('base_directory'),
+                          index_file)
+
+    def _list_outputs(self):
+        from nipype.interfaces.base import isdefined
+        from nipype.utils.misc import human_order_sorted
+
+        outputs = {}
+        info = dict((k, v) for k, v in list(self.inputs.__dict__.items())
+                    if k in self._infields)
+
+        force_lists = self.inputs.force_lists
+        if isinstance(force_lists, bool):
+            force_lists = self._outfields if force_lists else []
+        bad_fields = set(force_lists) - set(self._outfields)
+        if bad_fields:
+            raise ValueError("The field(s) '%s' set in 'force_lists' are not "
+                             "in 'templates'." % ', '.join(bad_fields))
+
+        base = self.inputs.base_directory \
+            if isdefined(self.inputs.base_directory) else os.getcwd()
+        try:
+            index = BIDSIndex(ds_root, self._index_file, readonly=True)
+        except sqlite3.Error:
+            # e.g. not built yet: glob as SelectFiles
+            index = None
+        try:
+            for field, template in list(self._templates.items()):
+                find_dirs = template[-1] == os.sep
+                template = os.path.abspath(os.path.join(base, template))
+                if find_dirs:
+                    template += os.sep
+
+                filled_template = template.format(**info)
+                try:
+                    filelist = index.glob(filled_template, refresh=False)
+                except (AttributeError, sqlite3.Error):
+                    filelist = None
+                if not filelist:
+                    # changed since the index was refreshed, or a miss
+                    filelist = glob.glob(filled_template)
+
+                if not filelist:
+                    msg = 'No files were found matching %s template: %s' % (
+                        field, filled_template)
+                    if self.inputs.raise_on_empty:
+                        raise IOError(msg)
+                    else:
+                        print('Warning: %s' % msg)
+
+                if self.inputs.sort_filelist:
+                    filelist = human_order_sorted(filelist)
+
+                if field not in force_lists and len(filelist) == 1:
+                    filelist = filelist[0]
+
+                outputs[field] = filelist
+        finally:
+            if index is not None:
+                index.close()
+        return outputs
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Build or refresh the SQLite index of the dataset.')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Index everything again.')
+    parser.add_argument('--index-file', default=None,
+                        help='Default: workingdirs/bids_index.sqlite.')
+    args = parser.parse_args()
+
+    index = BIDSIndex(ds_root, args.index_file)
+    start = time.time()
+    stats = index.rebuild() if args.rebuild else index.refresh()
+    counts = index.counts()
+    print('%s: %d files in %d directories; checked %d, listed %d '
+          'directories in %.2f s' % (index.index_file, counts['files'],
+                                     counts['dirs'], stats['stat'],
+                                     stats['listed'], time.time() - start))
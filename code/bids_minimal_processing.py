@@ -16,19 +16,21 @@ import os
 import sys
 import errno
 
-import nipype.interfaces.io as nio           # Data i/o
 import nipype.interfaces.utility as niu      # utility
 import nipype.pipeline.engine as pe          # pypeline engine
-import nipype.algorithms.modelgen as model   # model generation
-import nipype.algorithms.rapidart as ra      # artifact detection
+from nhp_bids import lazy_import, write_graph
+model = lazy_import('nipype.algorithms.modelgen')  # model generation
+ra = lazy_import('nipype.algorithms.rapidart')     # artifact detection
 from nipype.interfaces.utility import IdentityInterface
 
 from nipype.pipeline.engine import Workflow, Node, MapNode
 
 import nipype.interfaces.fsl as fsl          # fsl
-import nipype.interfaces.freesurfer as fs    # freesurfer
+fs = lazy_import('nipype.interfaces.freesurfer')   # freesurfer
 
 from bids_convert_csv_eventlog import ConvertCSVEventLog
+from bids_index import IndexedSelectFiles
+from link_datasink import LinkDataSink
 
 
 def create_images_workflow():
@@ -142,7 +144,7 @@ def run_workflow(session, csv_file, use_pbs, stop_on_first_crash, ignore_events)
 
         # SelectFiles
         imgfiles = Node(
-            nio.SelectFiles({
+            IndexedSelectFiles({
                 'images':
                 'sourcedata/%s' % bt.templates['images'],
             }, base_directory=data_dir), name="img_files")
@@ -154,7 +156,7 @@ def run_workflow(session, csv_file, use_pbs, stop_on_first_crash, ignore_events)
         ('session_id', session_list), ('subject_id', subject_list),
     ]
     evfiles = Node(
-        nio.SelectFiles({
+        IndexedSelectFiles({
             'csv_eventlogs':
             'sourcedata/sub-{subject_id}/ses-{session_id}/func/'
             'sub-{subject_id}_ses-{session_id}_*events/Log_*_eventlog.csv',
@@ -165,7 +167,7 @@ def run_workflow(session, csv_file, use_pbs, stop_on_first_crash, ignore_events)
 
     # ------------------ Output Files
     # Datasink
-    outputfiles = Node(nio.DataSink(
+    outputfiles = Node(LinkDataSink(
         base_directory=ds_root,
         container=output_dir,
         parameterization=True),
@@ -228,7 +230,7 @@ def run_workflow(session, csv_file, use_pbs, stop_on_first_crash, ignore_events)
     workflow.stop_on_first_crash = stop_on_first_crash
     workflow.keep_inputs = True
     workflow.remove_unnecessary_outputs = False
-    workflow.write_graph()
+    write_graph(workflow)
     #workflow.run(plugin='MultiProc', plugin_args={'n_procs' : 10})
     workflow.run()
 
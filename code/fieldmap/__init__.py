@@ -0,0 +1,4 @@
+
+from fieldmap.vsm import calc_vsm_interface, apply_vsm_interface
+from fieldmap.prepare import prepare_fieldmap_interface
+from fieldmap.unwrap import native_unwrap_interface
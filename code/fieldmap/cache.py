@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+""" Content-addressed cache for fieldmap derivatives.
+
+Entries are stored as:
+
+    <root>/<kind>/<key>/<name>.nii.gz
+
+where `key` is derived from the content of the input files and the
+parameters used to compute the entry. Identical fieldmaps (e.g. the same
+session's fieldmap used by every run) therefore map onto the same entry.
+
+Every lookup is appended to <root>/cache.log, which is summarized by
+`FieldmapCache.report()` or by running:
+
+    python -m fieldmap.cache derivatives/fieldmap-cache
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """ SHA1 of the content of `path`, or of the names and content of the
+    files in a directory (e.g. a masked series).
+    """
+    h = hashlib.sha1()
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            h.update(name.encode('UTF-8'))
+            h.update(file_digest(os.path.join(path, name)).encode('UTF-8'))
+        return h.hexdigest()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_stamp(path):
+    """ SHA1 of the path, inode, size and modification time of `path`, or of
+    the files in a directory: a stat instead of a read, for inputs that are
+    only replaced by writing a new file (the outputs of other nodes).
+    """
+    path = os.path.realpath(path)
+    h = hashlib.sha1()
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            h.update(file_stamp(os.path.join(path, name)).encode('UTF-8'))
+        return h.hexdigest()
+    st = os.stat(path)
+    h.update(('%s\0%d\0%d\0%d\0%d' % (
+        path, st.st_dev, st.st_ino, st.st_size,
+        st.st_mtime_ns)).encode('UTF-8'))
+    return h.hexdigest()
+
+
+class FieldmapCache(object):
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def key(self, kind, files, file_key=file_digest, **params):
+        """ Key for a cache entry of type `kind`, computed from the content of
+        `files` (list of paths, order matters; or their file_stamp with
+        file_key=file_stamp) and `params`.
+        """
+        h = hashlib.sha1()
+        h.update(kind.encode('UTF-8'))
+        for f in files:
+            h.update(file_key(f).encode('UTF-8'))
+        h.update(json.dumps(params, sort_keys=True).encode('UTF-8'))
+        return h.hexdigest()
+
+    def entry_dir(self, kind, key):
+        return os.path.join(self.root, kind, key)
+
+    def path(self, kind, key, name):
+        return os.path.join(self.entry_dir(kind, key), name + '.nii.gz')
+
+    def lookup(self, kind, key, names):
+        """ Returns {name: path} if all `names` are cached, otherwise None.
+        """
+        paths = dict((name, self.path(kind, key, name)) for name in names)
+        hit = all(os.path.isfile(p) for p in paths.values())
+        self.record(kind, key, hit)
+        if hit:
+            return paths
+        return None
+
+    def record(self, kind, key, hit):
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root, exist_ok=True)
+        # a single short append is atomic, so parallel runs can share the log
+        with open(os.path.join(self.root, 'cache.log'), 'a') as f:
+            f.write('%d\t%s\t%s\t%s\n' % (
+                time.time(), 'hit' if hit else 'miss', kind, key))
+        print('fieldmap cache %s: %s/%s' % (
+            'hit' if hit else 'miss', kind, key))
+
+    def report(self):
+        """ {kind: {'hit': n, 'miss': n}} over all recorded lookups.
+        """
+        counts = dict()
+        log_file = os.path.join(self.root, 'cache.log')
+        if not os.path.isfile(log_file):
+            return counts
+        with open(log_file) as f:
+            for line in f:
+                fields = line.split('\t')
+                if len(fields) != 4:
+                    continue
+                kind_counts = counts.setdefault(fields[2],
+                                                {'hit': 0, 'miss': 0})
+                kind_counts[fields[1]] += 1
+        return counts
+
+    def store(self, kind, key, files):
+        """ Copy {name: path} into the cache and return {name: cached path}.
+
+        The entry is assembled in a temporary directory and renamed into place,
+        so concurrent runs never see a partially written entry.
+        """
+        dest = self.entry_dir(kind, key)
+        parent = os.path.dirname(dest)
+        if not os.path.isdir(parent):
+            os.makedirs(parent, exist_ok=True)
+
+        tmp = tempfile.mkdtemp(prefix='.tmp-', dir=parent)
+        try:
+            for name, src in files.items():
+                shutil.copyfile(src, os.path.join(tmp, name + '.nii.gz'))
+            try:
+                os.rename(tmp, dest)
+            except OSError:
+                # another process stored the same entry first
+                if not os.path.isdir(dest):
+                    raise
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+
+        return dict((name, self.path(kind, key, name)) for name in files)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Report hits and misses of a fieldmap cache.')
+    parser.add_argument('cache_dir', help='Cache directory, e.g. '
+                        'derivatives/fieldmap-cache.')
+    args = parser.parse_args()
+
+    for kind, c in sorted(FieldmapCache(args.cache_dir).report().items()):
+        total = c['hit'] + c['miss']
+        print('%-8s hits: %5d  misses: %5d  hit rate: %5.1f%%' % (
+            kind, c['hit'], c['miss'], 100. * c['hit'] / total))
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+""" Fieldmap preprocessing, cached per fieldmap.
+
+The phase -> radians -> unwrapped -> rad/s -> unmasked chain only depends on
+the session's fieldmap (phasediff, magnitude and mask), not on the functional
+run. The derivatives are therefore stored in the content-addressed cache of
+fieldmap/cache.py and every run (and rerun) of the session looks them up
+instead of running PRELUDE and FUGUE again.
+"""
+
+# derivative name --> output of the fieldmap chain
+FMAP_DERIVATIVES = ['radians', 'unwrapped', 'rads', 'unmasked']
+
+
+def compute_fieldmap_derivatives(phasediff, magnitude, mask,
+                                 unwarp_direction='y',
+                                 unwrap_method='prelude'):
+    """ Run the fieldmap chain in the current directory, returns
+    {derivative name: file}.
+
+    unwrap_method is 'prelude' or 'native' (see fieldmap/unwrap.py).
+    """
+    import nipype.interfaces.fsl as fsl
+    from nipype.interfaces.fsl.preprocess import PRELUDE
+    from nipype.interfaces.fsl.preprocess import FUGUE
+
+    # fslmaths phase -mul 3.14159 -div 100 -odt float phase_radians
+    radians = fsl.ImageMaths(
+        in_file=phasediff,
+        op_string='-mul 3.141592653589793116 -div 100',
+        out_data_type='float',
+        suffix='_radians',
+    ).run().outputs.out_file
+
+    # prelude -p phase_radians -a magnitude -m mask -o unwrapped
+    if unwrap_method == 'native':
+        from fieldmap.unwrap import unwrap_phase_file
+        unwrapped = unwrap_phase_file(radians, mask)
+    else:
+        assert unwrap_method == 'prelude', (
+            'Unknown unwrap_method %s' % unwrap_method)
+        unwrapped = PRELUDE(
+            phase_file=radians,
+            magnitude_file=magnitude,
+            mask_file=mask,
+        ).run().outputs.unwrapped_phase_file
+
+    # Convert to radians / sec
+    rads = fsl.ImageMaths(
+        in_file=unwrapped,
+        op_string='-mul 200',
+    ).run().outputs.out_file
+
+    unmasked = FUGUE(
+        fmap_in_file=rads,
+        mask_file=mask,
+        save_unmasked_fmap=True,
+        unwarp_direction=unwarp_direction,
+    ).run().outputs.fmap_out_file
+
+    return dict(radians=radians, unwrapped=unwrapped, rads=rads,
+                unmasked=unmasked)
+
+
+def prepare_fieldmap_files(phasediff, magnitude, mask, unwarp_direction='y',
+                           cache_dir=None, unwrap_method='prelude'):
+    """ Look up the derivatives of a fieldmap, computing them on a miss.
+    """
+    from fieldmap.cache import FieldmapCache
+
+    if not cache_dir:
+        return compute_fieldmap_derivatives(
+            phasediff, magnitude, mask, unwarp_direction, unwrap_method)
+
+    cache = FieldmapCache(cache_dir)
+    key = cache.key('fmap', [phasediff, magnitude, mask],
+                    unwarp_direction=unwarp_direction,
+                    unwrap_method=unwrap_method)
+    hit = cache.lookup('fmap', key, FMAP_DERIVATIVES)
+    if hit is not None:
+        return hit
+
+    files = compute_fieldmap_derivatives(
+        phasediff, magnitude, mask, unwarp_direction, unwrap_method)
+    return cache.store('fmap', key, files)
+
+
+# --------------------------------------------------------- NiPype wrapper
+
+def prepare_fieldmap(phasediff, magnitude, mask, unwarp_direction, cache_dir,
+                     unwrap_method):
+    # necessary for importing with NiPype
+    from fieldmap.prepare import prepare_fieldmap_files
+    files = prepare_fieldmap_files(phasediff, magnitude, mask,
+                                   unwarp_direction, cache_dir, unwrap_method)
+    return (files['radians'], files['unwrapped'], files['rads'],
+            files['unmasked'])
+
+
+import nipype.interfaces.utility as niu
+
+
+prepare_fieldmap_interface = niu.Function(
+    input_names=['phasediff', 'magnitude', 'mask', 'unwarp_direction',
+                 'cache_dir', 'unwrap_method'],
+    output_names=['radians_file', 'unwrapped_file', 'rads_file',
+                  'unmasked_file'],
+    function=prepare_fieldmap,
+)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+""" Parameter sweep over fieldmap unwarping settings.
+
+Replaces the serial loops of scratch/undistort-v0.2.sh and v0.3.sh. The
+shared upstream steps (radians, unwrap, rad/s, unmask) are computed once
+through the fieldmap cache, after which every combination of
+
+    --poly (0 = no polynomial fit), --smooth3, -m (median), mask erosion
+
+is applied natively in a process pool. Each variant is scored by the
+normalised mutual information between the unwarped (median) functional and
+the T1 reference inside the fieldmap mask, and written to a ranked table.
+"""
+
+import itertools
+import os
+
+import numpy as np
+
+
+def make_grid(polys=(0, 1, 2, 3, 4, 5), smooth3s=(0., 1., 2.),
+              medians=(False, True), erodes=(False, True)):
+    return [dict(poly=int(p), smooth3=float(s), median=bool(m), erode=bool(e))
+            for p, s, m, e in itertools.product(polys, smooth3s, medians,
+                                                 erodes)]
+
+
+def fit_polynomial(fmap, mask, degree):
+    """ Least-squares fit of a 3D polynomial of total `degree` to the
+    fieldmap inside `mask`, evaluated over the whole volume (as fugue --poly).
+    """
+    shape = fmap.shape
+    coords = [np.linspace(-1, 1, n) for n in shape]
+    powers = [(i, j, k)
+              for i in range(degree + 1)
+              for j in range(degree + 1 - i)
+              for k in range(degree + 1 - i - j)]
+
+    inside = np.nonzero(mask)
+    xyz = [c[idx] for c, idx in zip(coords, inside)]
+    A = np.stack([xyz[0] ** i * xyz[1] ** j * xyz[2] ** k
+                  for i, j, k in powers], axis=1)
+    coef = np.linalg.lstsq(A, fmap[inside], rcond=-1)[0]
+
+    fitted = np.zeros(shape)
+    for c, (i, j, k) in zip(coef, powers):
+        fitted += c * np.multiply.outer(
+            np.multiply.outer(coords[0] ** i, coords[1] ** j), coords[2] ** k)
+    return fitted
+
+
+def normalised_mutual_information(a, b, bins=64):
+    """ (H(a) + H(b)) / H(a, b)
+    """
+    hist, _, _ = np.histogram2d(a, b, bins=bins)
+    p = hist / hist.sum()
+
+    def entropy(q):
+        q = q[q > 0]
+        return -np.sum(q * np.log(q))
+
+    return (entropy(p.sum(axis=0)) + entropy(p.sum(axis=1))) / entropy(p)
+
+
+def erode_mask(rads_file, mask_file, out_file):
+    """ fslmaths rads -abs -bin -mul mask -kernel box 3x3x3 -ero out
+    """
+    import nibabel as nib
+    from scipy import ndimage
+
+    img = nib.load(rads_file)
+    rads = np.asanyarray(img.dataobj)
+    mask = np.asanyarray(nib.load(mask_file).dataobj) > 0
+    eroded = ndimage.binary_erosion((rads != 0) & mask,
+                                    structure=np.ones((3, 3, 3)))
+    nib.save(nib.Nifti1Image(eroded.astype(np.uint8), img.affine), out_file)
+    return out_file
+
+
+def unmask_fieldmap(rads_file, mask_file, unwarp_direction, out_dir):
+    """ FUGUE --unmaskfmap with an arbitrary mask, as in the scratch scripts.
+    """
+    from nipype.interfaces.fsl.preprocess import FUGUE
+
+    cwd = os.getcwd()
+    os.chdir(out_dir)
+    try:
+        return FUGUE(fmap_in_file=rads_file, mask_file=mask_file,
+                     save_unmasked_fmap=True,
+                     unwarp_direction=unwarp_direction,
+                     ).run().outputs.fmap_out_file
+    finally:
+        os.chdir(cwd)
+
+
+def run_variant(variant, unmasked_file, mask_file, func_file, t1_file,
+                dwell_time, unwarp_direction, out_dir):
+    """ Unwarp the reference functional with a single set of settings.
+    Runs in a worker process; only file names are passed in.
+    """
+    import nibabel as nib
+    from fieldmap.vsm import compute_vsm, apply_vsm
+
+    fmap_img = nib.load(unmasked_file)
+    fmap = np.asanyarray(fmap_img.dataobj).astype(np.float64)
+    mask = np.asanyarray(nib.load(mask_file).dataobj) > 0
+
+    if variant['poly'] > 0:
+        fmap = fit_polynomial(fmap, mask, variant['poly'])
+
+    vsm = compute_vsm(fmap, fmap_img.header.get_zooms(), dwell_time,
+                      unwarp_direction, smooth3d=variant['smooth3'],
+                      median_2dfilter=variant['median'])
+
+    func_img = nib.load(func_file)
+    func = np.asanyarray(func_img.dataobj)
+    unwarped, = apply_vsm([func], vsm, unwarp_direction)
+
+    t1 = np.asanyarray(nib.load(t1_file).dataobj)
+    if t1.ndim > 3:
+        t1 = t1[..., 0]
+    if t1.shape != unwarped.shape[:3]:
+        raise ValueError('T1 %s is not in the space of the functional %s' %
+                         (t1_file, func_file))
+    score = normalised_mutual_information(unwarped[mask], t1[mask])
+
+    name = 'poly-%(poly)d_smooth3-%(smooth3)g_median-%(median)d_' \
+           'erode-%(erode)d' % variant
+    out_file = os.path.join(out_dir, 'unwarped_%s.nii.gz' % name)
+    nib.save(nib.Nifti1Image(unwarped.astype(np.float32), func_img.affine),
+             out_file)
+
+    result = dict(variant)
+    result.update(nmi=score, unwarped_file=out_file)
+    return result
+
+
+def run_sweep(phasediff, magnitude, mask, func, t1, out_dir, grid=None,
+              dwell_time=0.0005585, unwarp_direction='y', n_procs=None,
+              cache_dir=None, unwrap_method='prelude'):
+    """ Run all variants of `grid` and write <out_dir>/sweep.tsv, ranked by
+    normalised mutual information with the T1 (best first).
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    import nibabel as nib
+    from fieldmap.prepare import prepare_fieldmap_files
+
+    if grid is None:
+        grid = make_grid()
+    phasediff, magnitude, mask, func, t1, out_dir = [
+        os.path.abspath(f)
+        for f in (phasediff, magnitude, mask, func, t1, out_dir)]
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    # --- shared upstream steps, once for all variants
+    cwd = os.getcwd()
+    os.chdir(out_dir)
+    try:
+        fmap = prepare_fieldmap_files(phasediff, magnitude, mask,
+                                      unwarp_direction, cache_dir,
+                                      unwrap_method)
+    finally:
+        os.chdir(cwd)
+
+    unmasked = {False: fmap['unmasked']}
+    if any(v['erode'] for v in grid):
+        eroded_mask = erode_mask(fmap['rads'], mask,
+                                 os.path.join(out_dir, 'fmap_mask_ero.nii.gz'))
+        unmasked[True] = unmask_fieldmap(fmap['rads'], eroded_mask,
+                                         unwarp_direction, out_dir)
+
+    # score on the temporal median of the functional
+    func_img = nib.load(func)
+    if len(func_img.shape) > 3:
+        ref_func = os.path.join(out_dir, 'func_median.nii.gz')
+        nib.save(nib.Nifti1Image(
+            np.median(np.asanyarray(func_img.dataobj), axis=3).astype(
+                np.float32), func_img.affine), ref_func)
+    else:
+        ref_func = func
+
+    with ProcessPoolExecutor(max_workers=n_procs) as pool:
+        futures = [pool.submit(run_variant, v, unmasked[v['erode']], mask,
+                               ref_func, t1, dwell_time, unwarp_direction,
+                               out_dir)
+                   for v in grid]
+        results = [f.result() for f in futures]
+
+    results.sort(key=lambda r: -r['nmi'])
+    table = os.path.join(out_dir, 'sweep.tsv')
+    columns = ['poly', 'smooth3', 'median', 'erode', 'nmi', 'unwarped_file']
+    with open(table, 'w') as f:
+        f.write('rank\t%s\n' % '\t'.join(columns))
+        for rank, r in enumerate(results, 1):
+            f.write('%d\t%s\n' % (rank, '\t'.join(
+                '%.6f' % r[c] if c == 'nmi' else str(r[c])
+                for c in columns)))
+    print('Wrote %s (best: %s)' % (table, results[0]['unwarped_file']))
+    return table
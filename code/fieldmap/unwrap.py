@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+""" Native 3D phase unwrapping, as an alternative to PRELUDE.
+
+Weighted least-squares unwrapping (Ghiglia & Romero, 1994): the unwrapped
+phase is the solution of a masked Poisson equation whose right-hand side is
+the divergence of the wrapped phase gradients. It is solved with conjugate
+gradients, preconditioned by the unmasked problem, which is diagonalised by
+the 3D DCT. The DCTs run on multiple threads when scipy.fft is available.
+Finally, the result is made congruent with the input phase, i.e. it differs
+from the wrapped phase by exact multiples of 2 pi.
+
+Benchmark on synthetic wrapped phase (against PRELUDE if it is on the PATH):
+
+    python -m fieldmap.unwrap --benchmark
+"""
+
+import os
+import time
+
+import numpy as np
+
+
+def wrap(phase):
+    return (phase + np.pi) % (2 * np.pi) - np.pi
+
+
+def _dctn(x, inverse=False, workers=None):
+    try:
+        from scipy import fft
+    except ImportError:
+        fft = None
+    if hasattr(fft, 'dctn'):
+        if inverse:
+            return fft.idctn(x, type=2, norm='ortho', workers=workers)
+        return fft.dctn(x, type=2, norm='ortho', workers=workers)
+    # scipy < 1.4, where scipy.fft is numpy's fft function
+    from scipy import fftpack
+    for axis in range(x.ndim):
+        x = fftpack.dct(x, type=3 if inverse else 2, axis=axis,
+                        norm='ortho')
+    return x
+
+
+def _laplacian_eigenvalues(shape):
+    """ Eigenvalues of the Neumann Laplacian in the DCT-II basis.
+    """
+    eig = np.zeros(shape)
+    for axis, n in enumerate(shape):
+        k = np.arange(n).reshape([-1 if a == axis else 1
+                                  for a in range(len(shape))])
+        eig = eig + (2 * np.cos(np.pi * k / n) - 2)
+    return eig
+
+
+def _weighted_laplacian(phi, weights):
+    """ sum over axes of w+ (phi[i+1] - phi[i]) - w- (phi[i] - phi[i-1])
+    """
+    out = np.zeros_like(phi)
+    for axis, w in enumerate(weights):
+        d = np.diff(phi, axis=axis) * w
+        lo = [slice(None)] * phi.ndim
+        hi = [slice(None)] * phi.ndim
+        lo[axis] = slice(None, -1)
+        hi[axis] = slice(1, None)
+        out[tuple(lo)] += d
+        out[tuple(hi)] -= d
+    return out
+
+
+def unwrap_phase(phase, mask=None, max_iter=50, tol=1e-6, workers=None):
+    """ Unwrap a 3D `phase` image (radians) within `mask`.
+    Returns the unwrapped phase, 0 outside the mask.
+    """
+    phase = np.asarray(phase, dtype=np.float64)
+    if mask is None:
+        mask = np.ones(phase.shape, dtype=bool)
+    mask = np.asarray(mask) > 0
+
+    # gradient weights: only between voxels that are both inside the mask
+    weights = []
+    rho = np.zeros_like(phase)
+    for axis in range(phase.ndim):
+        lo = [slice(None)] * phase.ndim
+        hi = [slice(None)] * phase.ndim
+        lo[axis] = slice(None, -1)
+        hi[axis] = slice(1, None)
+        w = (mask[tuple(lo)] & mask[tuple(hi)]).astype(np.float64)
+        g = wrap(np.diff(phase, axis=axis)) * w
+        rho[tuple(lo)] += g
+        rho[tuple(hi)] -= g
+        weights.append(w)
+
+    eig = _laplacian_eigenvalues(phase.shape)
+    eig[(0,) * phase.ndim] = 1.
+
+    def precondition(r):
+        z = _dctn(r, workers=workers) / eig
+        z[(0,) * phase.ndim] = 0.
+        return _dctn(z, inverse=True, workers=workers)
+
+    # solve L_w phi = rho with preconditioned conjugate gradients
+    # (the unweighted problem is solved exactly by the first iteration)
+    phi = np.zeros_like(phase)
+    r = rho.copy()
+    z = precondition(r)
+    p = z.copy()
+    rz = np.sum(r * z)
+    norm0 = np.sqrt(np.sum(rho ** 2))
+    for _ in range(max_iter):
+        if norm0 == 0:
+            break
+        q = _weighted_laplacian(p, weights)
+        alpha = rz / np.sum(p * q)
+        phi += alpha * p
+        r -= alpha * q
+        if np.sqrt(np.sum(r ** 2)) < tol * norm0:
+            break
+        z = precondition(r)
+        rz_new = np.sum(r * z)
+        p = z + (rz_new / rz) * p
+        rz = rz_new
+
+    # congruence: add multiples of 2 pi to the wrapped phase
+    offset = np.angle(np.mean(np.exp(1j * (phase - phi)[mask])))
+    phi += offset
+    unwrapped = phase + 2 * np.pi * np.round((phi - phase) / (2 * np.pi))
+    unwrapped[~mask] = 0
+    return unwrapped
+
+
+def unwrap_phase_file(phase_file, mask_file=None, out_file=None,
+                      workers=None):
+    """ Native replacement for `prelude -p phase -m mask -o unwrapped`.
+    """
+    import nibabel as nib
+
+    img = nib.load(phase_file)
+    phase = np.asanyarray(img.dataobj)
+    mask = None
+    if mask_file:
+        mask = np.asanyarray(nib.load(mask_file).dataobj)
+
+    unwrapped = unwrap_phase(phase, mask, workers=workers)
+
+    if out_file is None:
+        base = os.path.basename(phase_file)
+        for ext in ('.nii.gz', '.nii'):
+            if base.endswith(ext):
+                base = base[:-len(ext)]
+        out_file = os.path.abspath(base + '_unwrapped.nii.gz')
+
+    out_img = nib.Nifti1Image(unwrapped.astype(np.float32), img.affine,
+                              img.header)
+    out_img.set_data_dtype(np.float32)
+    nib.save(out_img, out_file)
+    return out_file
+
+
+# --------------------------------------------------------- NiPype wrapper
+
+def native_unwrap(phase_file, magnitude_file, mask_file):
+    # necessary for importing with NiPype
+    # (magnitude_file is accepted for compatibility with PRELUDE's inputs)
+    import multiprocessing
+    from fieldmap.unwrap import unwrap_phase_file
+    return unwrap_phase_file(phase_file, mask_file,
+                             workers=multiprocessing.cpu_count())
+
+
+import nipype.interfaces.utility as niu
+
+
+native_unwrap_interface = niu.Function(
+    input_names=['phase_file', 'magnitude_file', 'mask_file'],
+    output_names=['unwrapped_phase_file'],
+    function=native_unwrap,
+)
+
+
+# --------------------------------------------------------- Benchmark
+
+def synthetic_phase(shape=(96, 96, 64), max_rad=15., noise=0.1, seed=0):
+    """ Smooth phase in an ellipsoid mask (true phase, wrapped phase, mask).
+    """
+    rng = np.random.RandomState(seed)
+    grid = np.meshgrid(*[np.linspace(-1, 1, n) for n in shape],
+                       indexing='ij')
+    mask = sum(g ** 2 for g in grid) < 0.8
+
+    true = 0.3 * max_rad * grid[1]
+    for _ in range(5):
+        centre = rng.uniform(-0.5, 0.5, 3)
+        width = rng.uniform(0.15, 0.4)
+        true += rng.uniform(-1, 1) * max_rad * np.exp(
+            -sum((g - c) ** 2 for g, c in zip(grid, centre)) / width ** 2)
+    true += noise * rng.randn(*shape)
+    true[~mask] = 0
+    return true, wrap(true) * mask, mask
+
+
+def unwrap_errors(unwrapped, true, mask):
+    """ Fraction of voxels off by a multiple of 2 pi (after removing a global
+    2 pi k offset) and the RMS error in radians.
+    """
+    diff = (unwrapped - true)[mask]
+    diff -= 2 * np.pi * np.round(np.median(diff) / (2 * np.pi))
+    wrong = np.mean(np.abs(diff) > np.pi)
+    return wrong, np.sqrt(np.mean(diff ** 2))
+
+
+def benchmark(shape=(96, 96, 64), workers=None):
+    import shutil
+    import subprocess as sp
+    import tempfile
+    import nibabel as nib
+
+    true, wrapped, mask = synthetic_phase(shape)
+    print('Synthetic phase %s, %d voxels in mask, range %.1f rad' % (
+        shape, mask.sum(), np.ptp(true[mask])))
+    print('%-10s %10s %14s %10s' % ('method', 'time (s)', 'wrong voxels',
+                                     'RMS (rad)'))
+
+    start = time.time()
+    native = unwrap_phase(wrapped, mask, workers=workers)
+    elapsed = time.time() - start
+    wrong, rms = unwrap_errors(native, true, mask)
+    print('%-10s %10.2f %13.4f%% %10.4f' % ('native', elapsed,
+                                             100 * wrong, rms))
+
+    if shutil.which('prelude') is None:
+        print('prelude not found on PATH, skipping PRELUDE comparison')
+        return
+
+    tmp = tempfile.mkdtemp()
+    try:
+        affine = np.eye(4)
+        files = dict((name, os.path.join(tmp, name + '.nii.gz'))
+                     for name in ('phase', 'mag', 'mask', 'unwrapped'))
+        nib.save(nib.Nifti1Image(wrapped.astype(np.float32), affine),
+                 files['phase'])
+        nib.save(nib.Nifti1Image(mask.astype(np.float32), affine),
+                 files['mag'])
+        nib.save(nib.Nifti1Image(mask.astype(np.uint8), affine),
+                 files['mask'])
+        start = time.time()
+        sp.check_call(['prelude', '-p', files['phase'], '-a', files['mag'],
+                       '-m', files['mask'], '-o', files['unwrapped']])
+        elapsed = time.time() - start
+        prelude = np.asanyarray(nib.load(files['unwrapped']).dataobj)
+        wrong, rms = unwrap_errors(prelude, true, mask)
+        print('%-10s %10.2f %13.4f%% %10.4f' % ('prelude', elapsed,
+                                                 100 * wrong, rms))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Native 3D phase unwrapping (alternative to PRELUDE).')
+    parser.add_argument('-p', '--phase', help='Wrapped phase (radians).')
+    parser.add_argument('-m', '--mask', help='Mask.')
+    parser.add_argument('-o', '--out', help='Unwrapped phase.')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Compare accuracy and speed with PRELUDE on '
+                             'synthetic wrapped phase.')
+    parser.add_argument('--shape', type=int, nargs=3, default=[96, 96, 64],
+                        help='Shape of the synthetic phase for --benchmark.')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Number of FFT threads.')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(tuple(args.shape), args.workers)
+    else:
+        unwrap_phase_file(args.phase, args.mask, args.out, args.workers)
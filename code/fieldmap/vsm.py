@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+""" Voxel shift maps (VSM) computed from an unmasked fieldmap.
+
+This replaces running FUGUE separately for the functionals and for their
+masks: the fieldmap is smoothed and converted to a shift map once (and cached,
+see fieldmap/cache.py), after which any number of images - 4D functionals and
+3D masks alike - are resampled along the phase-encode axis in one pass.
+
+The shift (in voxels) follows FUGUE's convention:
+
+    shift = fmap [rad/s] / (2 pi) * dwell_time [s] * N_phase_encode
+
+and unwarped(y) = distorted(y + shift(y)).
+"""
+
+import os
+
+import numpy as np
+
+
+def parse_direction(unwarp_direction):
+    """ 'x', 'y', 'z', 'x-', 'y-', 'z-' --> (axis, sign)
+    """
+    axes = {'x': 0, 'y': 1, 'z': 2}
+    if unwarp_direction[0] not in axes or \
+            unwarp_direction[1:] not in ('', '-'):
+        raise ValueError('Unknown unwarp direction "%s"' % unwarp_direction)
+    sign = -1. if unwarp_direction.endswith('-') else 1.
+    return axes[unwarp_direction[0]], sign
+
+
+def compute_vsm(fmap, zooms, dwell_time, unwarp_direction='y',
+                smooth3d=0., median_2dfilter=False):
+    """ Convert an (unmasked) fieldmap in rad/s to a voxel shift map.
+
+    smooth3d is the sigma of the 3D Gaussian in mm, median_2dfilter applies a
+    3x3 in-plane median filter to every slice (both as in FUGUE).
+    """
+    from scipy import ndimage
+
+    fmap = np.asarray(fmap, dtype=np.float64)
+    axis, sign = parse_direction(unwarp_direction)
+
+    if median_2dfilter:
+        fmap = ndimage.median_filter(fmap, size=(3, 3, 1), mode='nearest')
+    if smooth3d > 0:
+        sigma = [smooth3d / z for z in zooms[:3]]
+        fmap = ndimage.gaussian_filter(fmap, sigma=sigma, mode='nearest')
+
+    n_pe = fmap.shape[axis]
+    return (sign * fmap * dwell_time * n_pe / (2 * np.pi)).astype(np.float32)
+
+
+def apply_vsm(images, vsm, unwarp_direction='y'):
+    """ Unwarp a list of 3D/4D images with a 3D voxel shift map.
+
+    All images are stacked along a trailing axis and resampled with a single
+    linear-interpolation gather, so the sampling coordinates and weights are
+    computed once for all of them. Samples that fall outside the field of
+    view are set to 0.
+    """
+    axis, _ = parse_direction(unwarp_direction)
+    shape = vsm.shape
+    for img in images:
+        if img.shape[:3] != shape:
+            raise ValueError('Image shape %s does not match VSM shape %s' %
+                             (img.shape, shape))
+
+    nvols = [img.shape[3] if img.ndim > 3 else 1 for img in images]
+    stack = np.concatenate(
+        [img.reshape(shape + (n,)).astype(np.float32, copy=False)
+         for img, n in zip(images, nvols)], axis=3)
+
+    n = shape[axis]
+    grid = list(np.ix_(*[np.arange(s) for s in shape]))
+    coord = grid[axis] + vsm
+    valid = (coord >= 0) & (coord <= n - 1)
+
+    coord = np.clip(coord, 0, n - 1)
+    i0 = np.floor(coord).astype(np.intp)
+    i1 = np.minimum(i0 + 1, n - 1)
+    w1 = (coord - i0).astype(np.float32)
+    w0 = (1 - w1) * valid
+    w1 = w1 * valid
+
+    idx0 = list(grid)
+    idx0[axis] = i0
+    idx1 = list(grid)
+    idx1[axis] = i1
+    out = (stack[tuple(idx0)] * w0[..., np.newaxis] +
+           stack[tuple(idx1)] * w1[..., np.newaxis])
+
+    results = []
+    start = 0
+    for img, nv in zip(images, nvols):
+        res = out[..., start:start + nv]
+        start += nv
+        results.append(res.reshape(img.shape))
+    return results
+
+
+def unwarped_name(in_file, suffix='_unwarped'):
+    """ sub-x_bold.nii.gz --> <cwd>/sub-x_bold_unwarped.nii.gz (as FUGUE)
+    """
+    base = os.path.basename(in_file)
+    for ext in ('.nii.gz', '.nii'):
+        if base.endswith(ext):
+            base = base[:-len(ext)]
+            break
+    return os.path.abspath(base + suffix + '.nii.gz')
+
+
+def calc_vsm_file(fmap_file, dwell_time, unwarp_direction='y', smooth3d=0.,
+                  median_2dfilter=False, cache_dir=None):
+    """ Compute (or look up) the VSM of `fmap_file`.
+    """
+    import nibabel as nib
+    from fieldmap.cache import FieldmapCache
+
+    params = dict(dwell_time=float(dwell_time),
+                  unwarp_direction=unwarp_direction,
+                  smooth3d=float(smooth3d),
+                  median_2dfilter=bool(median_2dfilter))
+
+    if cache_dir:
+        cache = FieldmapCache(cache_dir)
+        key = cache.key('vsm', [fmap_file], **params)
+        hit = cache.lookup('vsm', key, ['vsm'])
+        if hit is not None:
+            return hit['vsm']
+
+    img = nib.load(fmap_file)
+    vsm = compute_vsm(np.asanyarray(img.dataobj), img.header.get_zooms(),
+                      **params)
+    out_file = unwarped_name(fmap_file, '_vsm')
+    out_img = nib.Nifti1Image(vsm, img.affine, img.header)
+    out_img.set_data_dtype(np.float32)
+    nib.save(out_img, out_file)
+
+    if cache_dir:
+        return cache.store('vsm', key, {'vsm': out_file})['vsm']
+    return out_file
+
+
+def apply_vsm_files(vsm_file, in_files, unwarp_direction='y'):
+    """ Unwarp all `in_files` with `vsm_file`; returns the unwarped files.
+    """
+    import nibabel as nib
+
+    vsm = np.asanyarray(nib.load(vsm_file).dataobj).astype(np.float32)
+    imgs = [nib.load(f) for f in in_files]
+    datas = [np.asanyarray(img.dataobj) for img in imgs]
+
+    out_files = []
+    for f, img, data, res in zip(in_files, imgs, datas,
+                                 apply_vsm(datas, vsm, unwarp_direction)):
+        is_mask = data.ndim == 3 and np.all((data == 0) | (data == 1))
+        if is_mask:
+            # binary masks stay binary
+            res = (res > 0.5).astype(data.dtype)
+        out_file = unwarped_name(f)
+        out_img = nib.Nifti1Image(res, img.affine, img.header)
+        if not is_mask:
+            out_img.set_data_dtype(np.float32)
+        nib.save(out_img, out_file)
+        out_files.append(out_file)
+    return out_files
+
+
+# --------------------------------------------------------- NiPype wrappers
+
+def calc_vsm(fmap_file, dwell_time, unwarp_direction, smooth3d,
+             median_2dfilter, cache_dir):
+    # necessary for importing with NiPype
+    from fieldmap.vsm import calc_vsm_file
+    vsm_file = calc_vsm_file(fmap_file, dwell_time, unwarp_direction,
+                             smooth3d, median_2dfilter, cache_dir)
+    return vsm_file
+
+
+def unwarp_func_and_mask(vsm_file, in_file, mask_file, unwarp_direction):
+    # necessary for importing with NiPype
+    from fieldmap.vsm import apply_vsm_files
+    out_file, out_mask_file = apply_vsm_files(
+        vsm_file, [in_file, mask_file], unwarp_direction)
+    return (out_file, out_mask_file)
+
+
+import nipype.interfaces.utility as niu
+
+
+calc_vsm_interface = niu.Function(
+    input_names=['fmap_file', 'dwell_time', 'unwarp_direction', 'smooth3d',
+                 'median_2dfilter', 'cache_dir'],
+    output_names=['vsm_file'],
+    function=calc_vsm,
+)
+
+apply_vsm_interface = niu.Function(
+    input_names=['vsm_file', 'in_file', 'mask_file', 'unwarp_direction'],
+    output_names=['out_file', 'out_mask_file'],
+    function=unwarp_func_and_mask,
+)
@@ -29,6 +29,104 @@ class FilterNumsTask(nib.CommandLine):
     output_spec = FilterNumsOutputSpec
     _cmd = 'awk'
 
+def group_outliers(volumes, merge_adjacent=0):
+    """ Split sorted outlier volumes into blocks; volumes at most
+    `merge_adjacent` apart share a block (0: one block per volume).
+    """
+    blocks = []
+    for vol in volumes:
+        if blocks and vol - blocks[-1][-1] <= merge_adjacent:
+            blocks[-1].append(vol)
+        else:
+            blocks.append([vol])
+    return blocks
+
+
+def scrubbing_regressors(volumes, nvols, merge_adjacent=0):
+    """ (nvols x blocks) indicator regressors of the outlier `volumes` below
+    nvols, one column per block of group_outliers.
+    """
+    import numpy as np
+
+    volumes = sorted(set(int(v) for v in volumes if 0 <= v < nvols))
+    blocks = group_outliers(volumes, merge_adjacent)
+    regressors = np.zeros((nvols, len(blocks)))
+    for i, block in enumerate(blocks):
+        regressors[block, i] = 1
+    return regressors
+
+
+def build_scrubbing_regressors(in_files, max_numbers, merge_adjacent=0,
+                               motion_parameters=None):
+    """ Outlier files of all runs of a session -> scrubbing regressors.
+
+    For each run, the ART outliers (one volume per line) at or beyond
+    max_number are dropped, as FilterNumsTask does, and the remaining
+    outliers are turned into scrubbing regressors. Writes per run:
+
+        <run>_filtered.txt    remaining outlier volumes
+        <run>_scrubbing.txt   scrubbing regressors (empty without outliers)
+        <run>_confounds.txt   motion parameters (first max_number volumes)
+                              followed by the scrubbing regressors, if
+                              motion_parameters are given
+
+    Returns (filtered files, scrubbing files, confound files).
+    """
+    import os
+    import numpy as np
+
+    if isinstance(in_files, str):
+        in_files, max_numbers = [in_files], [max_numbers]
+    if isinstance(motion_parameters, str):
+        motion_parameters = [motion_parameters]
+
+    filtered_files, scrubbing_files, confound_files = [], [], []
+    for run, (in_file, nvols) in enumerate(zip(in_files, max_numbers)):
+        base = os.path.splitext(os.path.basename(in_file))[0]
+        volumes = np.loadtxt(in_file, ndmin=1) \
+            if os.path.getsize(in_file) > 0 else np.zeros(0)
+        volumes = volumes.astype(int)
+        volumes = volumes[volumes < nvols]
+
+        regressors = scrubbing_regressors(volumes, nvols, merge_adjacent)
+
+        filtered = os.path.abspath(base + '_filtered.txt')
+        np.savetxt(filtered, volumes, fmt='%d')
+        filtered_files.append(filtered)
+
+        scrubbing = os.path.abspath(base + '_scrubbing.txt')
+        with open(scrubbing, 'w') as f:
+            if regressors.shape[1]:
+                np.savetxt(f, regressors, fmt='%d')
+        scrubbing_files.append(scrubbing)
+
+        if motion_parameters:
+            motion = np.loadtxt(motion_parameters[run], ndmin=2)[:nvols]
+            confounds = os.path.abspath(base + '_confounds.txt')
+            np.savetxt(confounds, np.hstack([motion, regressors]),
+                       fmt='%.8g')
+            confound_files.append(confounds)
+
+    return filtered_files, scrubbing_files, confound_files
+
+
+def scrubbing(in_files, max_numbers, merge_adjacent, motion_parameters):
+    # necessary for importing with NiPype
+    from filter_numbers import build_scrubbing_regressors
+    return build_scrubbing_regressors(in_files, max_numbers, merge_adjacent,
+                                      motion_parameters)
+
+
+import nipype.interfaces.utility as niu
+
+
+scrubbing_interface = niu.Function(
+    input_names=['in_files', 'max_numbers', 'merge_adjacent',
+                 'motion_parameters'],
+    output_names=['outlier_files', 'scrubbing_files', 'confound_files'],
+    function=scrubbing,
+)
+
 if __name__ == '__main__':
 
     filtnum = FilterNumsTask(in_file='an_existing_file')
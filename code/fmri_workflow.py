@@ -29,6 +29,7 @@ from nipype.workflows.fmri.fsl import (create_featreg_preproc,
                                        create_fixed_effects_flow)
 
 import preprocessing_workflow as preproc
+from link_datasink import LinkDataSink
 
 # -------------------------------------------------------------------
 #            /~_ _  _  _  _. _   _ . _  _ |. _  _
@@ -115,7 +116,7 @@ level1_workflow.connect([
 ds_root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 data_dir = ds_root
 
-outputfiles = pe.Node(nio.DataSink(
+outputfiles = pe.Node(LinkDataSink(
     base_directory=ds_root,
     container='level1flow',
     parameterization=True),
@@ -0,0 +1,4 @@
+
+from glm.fit import native_glm_interface
+from glm.fixedfx import native_fixed_effects_interface
+from glm.workflow import create_modelfit_workflow, create_fixed_effects_flow
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+""" Native first-level design matrices, replacing SpecifyModel, Level1Design
+and FEATModel for the conditions produced by timeevents.
+
+As FEAT, every condition is a boxcar (or impulse) on a fine time grid that
+is convolved with the double-gamma HRF and sampled at every TR, followed by
+its temporal derivative (orthogonalised to it). Motion parameters and the
+scrubbing regressors of the outliers (see filter_numbers.py) are added as
+confounds, and all columns are high-pass filtered like the data (bptf with
+sigma = cutoff / (2 TR)) and demeaned.
+
+All conditions of all runs of a session are put on a single fine grid and
+convolved with one FFT call; the HRF kernels and high-pass matrices are
+cached.
+"""
+
+import functools
+
+import numpy as np
+
+
+# FEAT's temporal resolution for convolution, in seconds
+RESOLUTION = 0.05
+
+
+def _gamma_pdf(t, mean, sd):
+    """ Gamma density parameterised by mean and standard deviation, as FEAT.
+    """
+    from scipy import stats
+    shape = (mean / sd) ** 2
+    scale = sd ** 2 / mean
+    return stats.gamma.pdf(t, shape, scale=scale)
+
+
+@functools.lru_cache(maxsize=None)
+def dgamma_kernels(dt=RESOLUTION, length=32.):
+    """ (2, samples) double-gamma HRF (sum 1) and its temporal derivative on
+    a grid of `dt` seconds. The result is read-only, as it is shared.
+    """
+    t = np.arange(0, length, dt)
+    hrf = _gamma_pdf(t, 6., 6. / np.sqrt(6.)) - \
+        _gamma_pdf(t, 16., 4.) / 6.
+    hrf /= hrf.sum()
+    kernels = np.stack([hrf, np.gradient(hrf, dt)])
+    kernels.setflags(write=False)
+    return kernels
+
+
+@functools.lru_cache(maxsize=None)
+def highpass_matrix(n_vols, sigma):
+    """ (n_vols x n_vols) matrix of FSL's bptf high-pass filter with `sigma`
+    in volumes: subtracts a Gaussian-weighted running line. Read-only.
+    """
+    t = np.arange(n_vols)
+    d = t[None, :] - t[:, None]
+    w = np.exp(-0.5 * (d / sigma) ** 2)
+    w[np.abs(d) > 3 * sigma] = 0
+    s0 = w.sum(axis=1, keepdims=True)
+    s1 = (w * d).sum(axis=1, keepdims=True)
+    s2 = (w * d ** 2).sum(axis=1, keepdims=True)
+    # weights of the local linear fit, evaluated at the centre
+    smoother = w * (s2 - d * s1) / (s0 * s2 - s1 ** 2)
+    matrix = np.eye(n_vols) - smoother
+    matrix.setflags(write=False)
+    return matrix
+
+
+def _event_arrays(events):
+    """ (onsets, durations, amplitudes) of a DataFrame or dict of arrays with
+    time, dur and amplitude.
+    """
+    return (np.asarray(events['time'], dtype=np.float64),
+            np.asarray(events['dur'], dtype=np.float64),
+            np.asarray(events['amplitude'], dtype=np.float64))
+
+
+def _n_events(events):
+    return 0 if events is None else len(events['time'])
+
+
+def convolved_conditions(cond_events, trs, nvols, conditions,
+                         dt=RESOLUTION):
+    """ Convolve `conditions` of all runs at once.
+
+    cond_events is a list (one per run) of {condition: events}. Returns a
+    list (one per run) of (conditions x 2 x nvols) arrays with the HRF
+    convolved regressor and its derivative, sampled every TR.
+    """
+    from scipy.signal import fftconvolve
+
+    kernels = dgamma_kernels(dt)
+    pad = kernels.shape[1]
+
+    # place the runs one after the other on a single fine grid
+    lengths = [int(np.ceil(n * tr / dt)) + 1 for n, tr in zip(nvols, trs)]
+    offsets = np.cumsum([0] + [n + pad for n in lengths])
+    total = offsets[-1]
+
+    steps = np.zeros((len(conditions), total + 1))
+    for run, (events, length, offset) in enumerate(
+            zip(cond_events, lengths, offsets)):
+        for c, name in enumerate(conditions):
+            if _n_events(events.get(name)) == 0:
+                continue
+            onsets, durs, amps = _event_arrays(events[name])
+            start = np.clip(np.round(onsets / dt).astype(int), 0, length)
+            stop = np.clip(np.round((onsets + durs) / dt).astype(int),
+                           start + 1, length)
+            np.add.at(steps[c], offset + start, amps)
+            np.add.at(steps[c], offset + stop, -amps)
+    boxcars = np.cumsum(steps, axis=1)[:, :total]
+
+    # (conditions x 1 x time) * (1 x 2 x time) only convolves over time, also
+    # with scipy < 1.0, whose fftconvolve has no axes argument
+    convolved = fftconvolve(boxcars[:, None, :],
+                            kernels[None, :, :])[:, :, :total]
+
+    out = []
+    for n, tr, offset in zip(nvols, trs, offsets):
+        idx = offset + np.round(np.arange(n) * tr / dt).astype(int)
+        out.append(convolved[:, :, idx])
+    return out
+
+
+def build_designs(cond_events, trs, nvols, contrasts=None, motion=None,
+                  scrubbing=None, highpass_cutoff=None, derivatives=True):
+    """ Design matrices of all runs of a session.
+
+    cond_events: list of {condition: events} (timeevents' out_events,
+                 loaded with artifacts.load_events)
+    trs, nvols: per run
+    contrasts: [(name, 'T', [conditions], [weights]), ...]
+    motion: per run (nvols x params) array or None
+    scrubbing: per run (nvols x outliers) scrubbing regressors or None
+    highpass_cutoff: in seconds (FEAT's high_pass_filter_cutoff)
+
+    Returns a list (one per run) of dicts with 'design' (nvols x
+    regressors), 'names' (regressors) and, with contrasts, 'contrasts'
+    (contrasts x regressors) and 'contrast_names'. Conditions without events
+    in a run are left out of its design, as in evt_info.
+    """
+    n_runs = len(cond_events)
+    conditions = []
+    for events in cond_events:
+        for name in events:
+            if name not in conditions:
+                conditions.append(name)
+
+    convolved = convolved_conditions(cond_events, trs, nvols, conditions)
+
+    designs = []
+    for run in range(n_runs):
+        n = nvols[run]
+        columns, names = [], []
+        for c, name in enumerate(conditions):
+            if _n_events(cond_events[run].get(name)) == 0:
+                continue
+            ev, deriv = convolved[run][c]
+            columns.append(ev)
+            names.append(name)
+            if derivatives:
+                centred = ev - ev.mean()
+                norm = centred.dot(centred)
+                if norm > 0:
+                    deriv = deriv - centred * (deriv.dot(centred) / norm)
+                columns.append(deriv)
+                names.append(name + '_deriv')
+
+        if motion is not None and motion[run] is not None:
+            params = np.atleast_2d(motion[run])[:n]
+            for i, col in enumerate(params.T):
+                columns.append(col)
+                names.append('motion%d' % (i + 1))
+
+        if scrubbing is not None and scrubbing[run] is not None:
+            for i, col in enumerate(np.asarray(scrubbing[run]).T):
+                columns.append(col)
+                names.append('scrubbing%d' % (i + 1))
+
+        X = np.stack(columns, axis=1) if columns else np.zeros((n, 0))
+        if highpass_cutoff:
+            X = highpass_matrix(n, highpass_cutoff / (2. * trs[run])).dot(X)
+        X = X - X.mean(axis=0)
+
+        design = dict(design=X, names=names)
+        if contrasts is not None:
+            design['contrast_names'], design['contrasts'] = \
+                contrast_matrix(contrasts, names)
+        designs.append(design)
+    return designs
+
+
+def contrast_matrix(contrasts, names):
+    """ Expand T contrasts over conditions to (contrasts x regressors) for
+    the regressors `names`; conditions missing from the design are dropped.
+    """
+    out_names, rows = [], []
+    for contrast in contrasts:
+        name, stat, conds, weights = contrast[:4]
+        if stat != 'T':
+            continue
+        row = np.zeros(len(names))
+        for cond, weight in zip(conds, weights):
+            if cond in names:
+                row[names.index(cond)] = weight
+        out_names.append(name)
+        rows.append(row)
+    return out_names, np.array(rows).reshape(len(rows), len(names))
+
+
+def write_design_files(design, prefix='design'):
+    """ Write <prefix>.mat and (with contrasts) <prefix>.con for FSL or
+    glm.fit. Returns (mat file, con file or None).
+    """
+    import os
+    from glm.vest import write_design, write_contrasts
+
+    mat_file = write_design(os.path.abspath(prefix + '.mat'),
+                            design['design'])
+    con_file = None
+    if 'contrasts' in design:
+        con_file = write_contrasts(os.path.abspath(prefix + '.con'),
+                                   design['contrast_names'],
+                                   design['contrasts'])
+    return mat_file, con_file
+
+
+# --------------------------------------------------------- NiPype wrapper
+
+def build_design_files(cond_events, TR, nvols, contrasts, motion_parameters,
+                       scrubbing_files, highpass_cutoff):
+    # necessary for importing with NiPype
+    import os
+    import numpy as np
+    from artifacts import load_events
+    from glm.design import build_designs, write_design_files
+
+    cond_events = [load_events(ev) for ev in cond_events]
+    n_runs = len(cond_events)
+    motion = [np.loadtxt(f, ndmin=2) for f in motion_parameters] \
+        if motion_parameters else None
+    scrubbing = None
+    if scrubbing_files:
+        # (see filter_numbers.build_scrubbing_regressors)
+        scrubbing = [np.loadtxt(f, ndmin=2) if os.path.getsize(f) > 0
+                     else np.zeros((n, 0))
+                     for f, n in zip(scrubbing_files, nvols)]
+
+    designs = build_designs(cond_events, TR, nvols, contrasts, motion,
+                            scrubbing, highpass_cutoff)
+
+    design_files, con_files = [], []
+    for run in range(n_runs):
+        mat_file, con_file = write_design_files(designs[run],
+                                                'run%d_design' % run)
+        design_files.append(mat_file)
+        con_files.append(con_file)
+    return design_files, con_files
+
+
+import nipype.interfaces.utility as niu
+
+
+build_design_interface = niu.Function(
+    input_names=['cond_events', 'TR', 'nvols', 'contrasts',
+                 'motion_parameters', 'scrubbing_files', 'highpass_cutoff'],
+    output_names=['design_files', 'con_files'],
+    function=build_design_files,
+)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+""" Native fixed-effects combination of runs, as an alternative to
+fslmerge + flameo --runmode=fe per contrast.
+
+All copes and varcopes of all contrasts and runs are read into
+(contrasts x runs x voxels) arrays inside the mask and combined in one
+vectorized pass with inverse-variance weights:
+
+    cope = sum(cope_r / varcope_r) / sum(1 / varcope_r)
+    varcope = 1 / sum(1 / varcope_r)
+    dof = sum(dof_r)
+"""
+
+import os
+
+import numpy as np
+
+
+def inverse_variance(varcopes):
+    """ Fixed-effects weights 1 / varcope (0 where varcope <= 0).
+    """
+    varcopes = np.asarray(varcopes, dtype=np.float64)
+    valid = varcopes > 0
+    return np.where(valid, 1. / np.where(valid, varcopes, 1.), 0.)
+
+
+def combine(sum_wcope, sum_w, dof):
+    """ Fixed-effects copes, varcopes, tstats and zstats (contrasts x voxels)
+    from the sufficient statistics sum(w cope) and sum(w) over runs.
+    """
+    from glm.fit import t_to_z
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cope = np.where(sum_w > 0, sum_wcope / sum_w, 0.)
+        varcope = np.where(sum_w > 0, 1. / sum_w, 0.)
+        tstat = np.where(varcope > 0, cope / np.sqrt(varcope), 0.)
+    return dict(copes=cope, varcopes=varcope, tstats=tstat,
+                zstats=t_to_z(tstat, dof), dof=dof)
+
+
+def fixed_effects(copes, varcopes, dofs):
+    """ Combine (contrasts x runs x voxels) copes and varcopes of runs with
+    `dofs` degrees of freedom.
+
+    Returns dict with copes, varcopes, tstats, zstats (contrasts x voxels),
+    res4d (contrasts x runs x voxels, the weighted residuals) and dof.
+    """
+    copes = np.asarray(copes, dtype=np.float64)
+    weights = inverse_variance(varcopes)
+    fx = combine((weights * copes).sum(axis=1), weights.sum(axis=1),
+                 int(np.sum(dofs)))
+    fx['res4d'] = (copes - fx['copes'][:, None, :]) * np.sqrt(weights)
+    return fx
+
+
+def _read_dof(dof_file):
+    return float(np.loadtxt(dof_file))
+
+
+def fixed_effects_files(copes, varcopes, dof_files, mask_file=None,
+                        out_dir='stats', store_dir=None, res4d=True):
+    """ Native replacement for the fixed-effects flow.
+
+    copes and varcopes are lists (one per contrast) of lists (one per run) of
+    NIfTI files or masked series (see masked/series.py), as produced by
+    sort_copes; dof_files has one file per run.
+    Writes <out_dir>/cope<n>, varcope<n>, tstat<n>, zstat<n> and res4d<n>
+    (.nii.gz, n the contrast) and <out_dir>/dof, and returns
+    {output: list of files}.
+
+    With store_dir, the runs are accumulated in a FixedEffectsStore (see
+    glm/fxstore.py): only runs that are not in the store yet are read. The
+    res4d images (if res4d) are computed from the stored contributions of
+    all runs.
+    """
+    import nibabel as nib
+    from glm.fit import save_volume
+    from masked.series import geometry, read_masked
+
+    out_dir = os.path.abspath(out_dir)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    shape, affine = geometry(copes[0][0])
+    mask = np.ones(shape, dtype=bool)
+    if mask_file:
+        mask &= np.asanyarray(nib.load(mask_file).dataobj) > 0
+    index = np.flatnonzero(mask)
+
+    def read(files):
+        out = np.empty((len(files), len(files[0]), index.size),
+                       dtype=np.float32)
+        for c, runs in enumerate(files):
+            for r, f in enumerate(runs):
+                out[c, r] = read_masked(f, index)[0]
+        return out
+
+    if store_dir:
+        from glm.fxstore import FixedEffectsStore
+
+        store = FixedEffectsStore(store_dir)
+
+        def loader(run):
+            return lambda: (read([[c[run]] for c in copes])[:, 0],
+                            read([[v[run]] for v in varcopes])[:, 0],
+                            _read_dof(dof_files[run]))
+
+        keys, runs = [], dict()
+        for run in range(len(dof_files)):
+            key = store.run_key([c[run] for c in copes] +
+                                [v[run] for v in varcopes] +
+                                [dof_files[run]])
+            keys.append(key)
+            runs[key] = loader(run)
+        added, removed = store.sync(runs, shape, affine, index,
+                                    len(copes))
+        print('fixed-effects store %s: %d runs, %d added, %d removed' % (
+            store.root, len(keys), len(added), len(removed)))
+        fx = store.estimate(keys, res4d=res4d)
+    else:
+        dofs = [_read_dof(f) for f in dof_files]
+        fx = fixed_effects(read(copes), read(varcopes), dofs)
+
+    def save(values, name):
+        return save_volume(values, index, shape, affine,
+                           os.path.join(out_dir, name + '.nii.gz'))
+
+    outputs = dict()
+    for name, prefix in (('copes', 'cope'), ('varcopes', 'varcope'),
+                         ('tstats', 'tstat'), ('zstats', 'zstat')):
+        outputs[name] = [save(v, '%s%d' % (prefix, c))
+                         for c, v in enumerate(fx[name], 1)]
+
+    outputs['res4d'] = []
+    for c, res in enumerate(fx['res4d'] if res4d else [], 1):
+        volume = np.zeros((int(np.prod(shape)), res.shape[0]),
+                          dtype=np.float32)
+        volume[index] = res.T
+        out_file = os.path.join(out_dir, 'res4d%d.nii.gz' % c)
+        nib.save(nib.Nifti1Image(volume.reshape(shape + (-1,)), affine),
+                 out_file)
+        outputs['res4d'].append(out_file)
+
+    dof_file = os.path.join(out_dir, 'dof')
+    with open(dof_file, 'w') as f:
+        f.write('%d\n' % fx['dof'])
+    outputs['dof_file'] = dof_file
+    return outputs
+
+
+# --------------------------------------------------------- NiPype wrapper
+
+def native_fixed_effects(copes, varcopes, dof_files, mask_file,
+                         store_dir=None, session=None, res4d=True):
+    # necessary for importing with NiPype
+    import os
+    from glm.fixedfx import fixed_effects_files
+    # without a session, the runs of every session would share a store
+    store_dir = os.path.join(store_dir, session) \
+        if store_dir and session else None
+    out = fixed_effects_files(copes, varcopes, dof_files, mask_file,
+                              store_dir=store_dir, res4d=res4d)
+    return (out['copes'], out['varcopes'], out['tstats'], out['zstats'],
+            out['res4d'], out['dof_file'])
+
+
+import nipype.interfaces.utility as niu
+
+
+native_fixed_effects_interface = niu.Function(
+    input_names=['copes', 'varcopes', 'dof_files', 'mask_file',
+                 'store_dir', 'session', 'res4d'],
+    output_names=['copes', 'varcopes', 'tstats', 'zstats', 'res4d',
+                  'dof_file'],
+    function=native_fixed_effects,
+)
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+
+""" Incremental fixed effects across runs.
+
+Fixed effects only depend on the sufficient statistics sum(w cope) and
+sum(w) over runs (w = 1 / varcope) and on the summed dof. The store keeps
+these sums together with the contribution of every run:
+
+    <root>/index.npy              flat indices of the voxels in the mask
+    <root>/sums.npz               sum_wcope, sum_w (contrasts x voxels) and
+                                  state (JSON: shape, affine, {run key: dof})
+    <root>/runs/<key>/cope.npy    contrasts x voxels
+    <root>/runs/<key>/w.npy       contrasts x voxels
+
+The sums and the runs they hold are written as one file, renamed into
+place, so a job killed during an update leaves the previous sums and runs
+(the contributions it wrote for new runs are written again).
+
+Runs are keyed by the path, size and modification time of their copes,
+varcopes and dof file (masked series: of the files in them), which takes a
+stat and no read. When the set of runs changes (e.g. a run is added to the
+CSV, or a run's copes are recomputed), only the new runs are read and
+added to the sums and the removed runs are subtracted, so updating the
+copes, varcopes, tstats and zstats does not depend on the number of runs.
+The residuals (res4d) need every run: estimate() only reads the run
+contributions when asked for them.
+
+Check that the sums match a recomputation from the run contributions, or
+recompute them:
+
+    python -m glm.fxstore verify derivatives/modelfit/fx-store/<sub>_<ses>
+    python -m glm.fxstore rebuild derivatives/modelfit/fx-store/<sub>_<ses>
+
+(derivatives/modelfit/<module>/fx-store/... with several contrasts
+modules.)
+
+Check adding and removing runs, and a sync killed before it is written,
+against glm.fixedfx.fixed_effects of the same (random) runs:
+
+    python -m glm.fxstore selftest [DIR]
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+
+def _save(path, array):
+    """ np.save to a temporary file, then rename it into place.
+    """
+    tmp = path + '.tmp.npy'
+    np.save(tmp, array)
+    os.rename(tmp, path)
+
+
+class FixedEffectsStore(object):
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def _path(self, *names):
+        return os.path.join(self.root, *names)
+
+    def run_key(self, files):
+        """ Key of a run, from the stat of its cope, varcope and dof files.
+        """
+        h = hashlib.sha1(b'fxrun')
+        for path in files:
+            path = os.path.realpath(path)
+            if os.path.isdir(path):
+                names = sorted(os.path.join(path, name)
+                               for name in os.listdir(path))
+            else:
+                names = [path]
+            for name in names:
+                st = os.stat(name)
+                h.update(('%s\0%d\0%d\n' % (name, st.st_size,
+                                             st.st_mtime_ns)).encode('UTF-8'))
+        return h.hexdigest()
+
+    def _load(self, name):
+        """ sum_wcope, sum_w or state of the sums file (each read alone).
+        """
+        with np.load(self._path('sums.npz')) as f:
+            return f[name]
+
+    def state(self):
+        if not os.path.isfile(self._path('sums.npz')):
+            return None
+        return json.loads(self._load('state').item())
+
+    def _write(self, sum_wcope, sum_w, state):
+        """ The sums and the state that says which runs are in them, as one
+        file renamed into place.
+        """
+        tmp = self._path('sums.tmp.npz')
+        np.savez(tmp, sum_wcope=sum_wcope, sum_w=sum_w,
+                 state=np.array(json.dumps(state)))
+        os.rename(tmp, self._path('sums.npz'))
+
+    def reset(self, shape, affine, index, n_contrasts):
+        """ Empty the store for a new mask (or number of contrasts).
+        """
+        if os.path.isdir(self.root):
+            shutil.rmtree(self.root)
+        os.makedirs(self._path('runs'))
+        _save(self._path('index.npy'), np.asarray(index, dtype=np.int64))
+        zeros = np.zeros((n_contrasts, len(index)))
+        self._write(zeros, zeros, dict(shape=list(shape),
+                                       affine=np.asarray(affine).tolist(),
+                                       runs={}))
+
+    def matches(self, shape, index, n_contrasts):
+        state = self.state()
+        if state is None or list(shape) != state['shape']:
+            return False
+        stored = np.load(self._path('index.npy'), mmap_mode='r')
+        return (np.array_equal(stored, index) and
+                self._load('sum_w').shape[0] == n_contrasts)
+
+    def sync(self, runs, shape, affine, index, n_contrasts):
+        """ Make the stored runs equal to `runs`, {key: loader}, where
+        loader() returns (copes, varcopes, dof) of a run, with copes and
+        varcopes (contrasts x voxels). Only the loaders of new runs are
+        called. Returns (added, removed) run keys.
+        """
+        from glm.fixedfx import inverse_variance
+
+        if not self.matches(shape, index, n_contrasts):
+            self.reset(shape, affine, index, n_contrasts)
+        state = self.state()
+
+        added = [key for key in runs if key not in state['runs']]
+        removed = [key for key in state['runs'] if key not in runs]
+        if not added and not removed:
+            return added, removed
+
+        sum_wcope = self._load('sum_wcope')
+        sum_w = self._load('sum_w')
+        for key in removed:
+            cope, w = self.contribution(key)
+            sum_wcope -= w * cope
+            sum_w -= w
+            del state['runs'][key]
+        for key in added:
+            copes, varcopes, dof = runs[key]()
+            cope = np.asarray(copes, dtype=np.float64)
+            w = inverse_variance(varcopes)
+            run_dir = self._path('runs', key)
+            if not os.path.isdir(run_dir):
+                os.makedirs(run_dir)
+            _save(os.path.join(run_dir, 'cope.npy'), cope)
+            _save(os.path.join(run_dir, 'w.npy'), w)
+            sum_wcope += w * cope
+            sum_w += w
+            state['runs'][key] = dof
+
+        self._write(sum_wcope, sum_w, state)
+        # with those of a sync that was killed
+        for key in os.listdir(self._path('runs')):
+            if key not in state['runs']:
+                shutil.rmtree(self._path('runs', key))
+        return added, removed
+
+    def contribution(self, key):
+        """ (cope, w) of a stored run, contrasts x voxels.
+        """
+        run_dir = self._path('runs', key)
+        return (np.load(os.path.join(run_dir, 'cope.npy'), mmap_mode='r'),
+                np.load(os.path.join(run_dir, 'w.npy'), mmap_mode='r'))
+
+    def estimate(self, keys=None, res4d=False):
+        """ Fixed effects of the stored runs (as glm.fixedfx.fixed_effects).
+        With res4d, also the residuals over `keys` (default: all stored
+        runs) in that order, which reads the contribution of every run.
+        """
+        from glm.fixedfx import combine
+
+        state = self.state()
+        if keys is None:
+            keys = sorted(state['runs'])
+        fx = combine(self._load('sum_wcope'), self._load('sum_w'),
+                     int(sum(state['runs'].values())))
+        if not res4d:
+            return fx
+        res4d = np.empty(fx['copes'].shape[:1] + (len(keys),) +
+                         fx['copes'].shape[1:])
+        for r, key in enumerate(keys):
+            cope, w = self.contribution(key)
+            res4d[:, r] = (cope - fx['copes']) * np.sqrt(w)
+        fx['res4d'] = res4d
+        return fx
+
+    def recompute(self):
+        """ (sum_wcope, sum_w) from scratch over the stored runs.
+        """
+        state = self.state()
+        sum_wcope = np.zeros(self._load('sum_w').shape)
+        sum_w = np.zeros_like(sum_wcope)
+        for key in state['runs']:
+            cope, w = self.contribution(key)
+            sum_wcope += w * cope
+            sum_w += w
+        return sum_wcope, sum_w
+
+    def verify(self, rtol=1e-6):
+        """ Compare the incremental fixed effects with a full recomputation.
+        Returns (ok, max relative difference of the copes and varcopes).
+        """
+        from glm.fixedfx import combine
+
+        state = self.state()
+        dof = int(sum(state['runs'].values()))
+        incremental = combine(self._load('sum_wcope'),
+                              self._load('sum_w'), dof)
+        full = combine(*(self.recompute() + (dof,)))
+        diff = 0.
+        for name in ('copes', 'varcopes'):
+            if full[name].size:
+                scale = max(np.abs(full[name]).max(), 1e-12)
+                diff = max(diff, np.abs(incremental[name] -
+                                        full[name]).max() / scale)
+        return diff <= rtol, diff
+
+    def rebuild(self):
+        """ Replace the sums by a recomputation from the run contributions.
+        """
+        sum_wcope, sum_w = self.recompute()
+        self._write(sum_wcope, sum_w, self.state())
+
+
+def selftest(root=None, n_runs=4, n_contrasts=2, n_voxels=1000):
+    """ Sync random runs into a store (a temporary one unless given): add
+    them, remove one, kill a sync before its sums are written and sync
+    again. Returns whether the store matched fixed_effects every time.
+    """
+    import multiprocessing
+    import signal
+    import tempfile
+
+    from glm.fixedfx import fixed_effects
+
+    tmp_dir = None
+    if root is None:
+        root = tmp_dir = tempfile.mkdtemp(prefix='fxstore-')
+    store = FixedEffectsStore(os.path.join(root, 'fx-store'))
+    rng = np.random.RandomState(0)
+    shape, affine = (10, 10, n_voxels // 100), np.eye(4)
+    index = np.arange(n_voxels)
+    runs = dict(('run%d' % r, (rng.randn(n_contrasts, n_voxels),
+                               rng.gamma(2., size=(n_contrasts, n_voxels)),
+                               100 + r))
+                for r in range(n_runs))
+
+    def sync(keys):
+        store.sync(dict((key, lambda key=key: runs[key]) for key in keys),
+                   shape, affine, index, n_contrasts)
+
+    def check(what, keys):
+        keys = sorted(keys)
+        fx = store.estimate(keys, res4d=True)
+        expected = fixed_effects(
+            np.stack([runs[key][0] for key in keys], axis=1),
+            np.stack([runs[key][1] for key in keys], axis=1),
+            [runs[key][2] for key in keys])
+        ok = sorted(store.state()['runs']) == keys and all(
+            np.allclose(fx[name], expected[name])
+            for name in ('copes', 'varcopes', 'zstats', 'res4d'))
+        print('%-30s %s' % (what, 'ok' if ok else 'FAILED'))
+        return ok
+
+    def killed_sync(keys):
+        rename = os.rename
+
+        def kill_before_sums(src, dst):
+            if dst == store._path('sums.npz'):
+                os.kill(os.getpid(), signal.SIGKILL)
+            rename(src, dst)
+
+        os.rename = kill_before_sums
+        sync(keys)
+
+    keys = sorted(runs)
+    sync(keys[:2])
+    ok = [check('add 2 runs', keys[:2])]
+    sync(keys)
+    ok.append(check('add the other runs', keys))
+    sync(keys[1:])
+    ok.append(check('remove a run', keys[1:]))
+    job = multiprocessing.get_context('fork').Process(
+        target=killed_sync, args=(keys[:1] + keys[2:],))
+    job.start()
+    job.join()
+    ok.append(check('sync killed before its sums', keys[1:]) and
+              job.exitcode == -signal.SIGKILL)
+    sync(keys[:1] + keys[2:])
+    ok.append(check('the same sync again', keys[:1] + keys[2:]) and
+              sorted(os.listdir(store._path('runs'))) ==
+              sorted(keys[:1] + keys[2:]))
+    if tmp_dir is not None:
+        shutil.rmtree(tmp_dir)
+    return all(ok)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Check or rebuild an incremental fixed-effects store.')
+    parser.add_argument('command',
+                        choices=['list', 'verify', 'rebuild', 'selftest'])
+    parser.add_argument('store_dir', nargs='?',
+                        help='Store, e.g. '
+                             'derivatives/modelfit/fx-store/<sub>_<ses> '
+                             '(selftest: where to create one, default a '
+                             'temporary directory).')
+    args = parser.parse_args()
+
+    if args.command == 'selftest':
+        raise SystemExit(0 if selftest(args.store_dir) else 1)
+    if args.store_dir is None:
+        parser.error('the store directory is required')
+    store = FixedEffectsStore(args.store_dir)
+    state = store.state()
+    if state is None:
+        parser.error('No fixed-effects store in %s' % args.store_dir)
+
+    if args.command == 'list':
+        for key, dof in sorted(state['runs'].items()):
+            print('%s\tdof %d' % (key, dof))
+    elif args.command == 'rebuild':
+        store.rebuild()
+        print('Rebuilt %s from %d runs' % (store.root, len(state['runs'])))
+    else:
+        ok, diff = store.verify()
+        print('%s: %d runs, max relative difference %.3g' % (
+            'OK' if ok else 'MISMATCH', len(state['runs']), diff))
+        if not ok:
+            raise SystemExit(1)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+""" ROI-restricted GLM for quick contrast previews.
+
+Instead of fitting every voxel, the time courses of a few ROIs are
+extracted once per run (as a masked series of the voxels in any ROI, see
+masked/series.py, cached by the stat of the run and the ROI files) and the GLM is fitted on the mean
+time course of every ROI ('mean') or on its voxels ('voxels'). The results
+are written as tables:
+
+    <run>_roi_betas.tsv   roi, voxels, regressor, beta
+    <run>_roi_stats.tsv   roi, voxels, contrast, cope, varcope, tstat,
+                          zstat, zmax, dof
+
+and combined over the runs of a session with fixed effects on cope and
+varcope (combine_roi_tables). An ROI file is either a mask (ROI named after
+the file) or a label image with several values (ROIs <file>_<label>).
+"""
+
+import os
+
+import numpy as np
+
+
+STATS_COLUMNS = ['roi', 'voxels', 'contrast', 'cope', 'varcope', 'tstat',
+                 'zstat', 'zmax', 'dof']
+ROI_MODES = ['mean', 'voxels']
+
+
+def _roi_name(roi_file):
+    base = os.path.basename(roi_file)
+    for ext in ('.nii.gz', '.nii'):
+        if base.endswith(ext):
+            return base[:-len(ext)]
+    return base
+
+
+def roi_indices(roi_files, shape=None):
+    """ [(name, flat indices)] of the ROIs in roi_files, in order.
+    """
+    import nibabel as nib
+
+    if isinstance(roi_files, str):
+        roi_files = [roi_files]
+    rois = []
+    for roi_file in roi_files:
+        data = np.asanyarray(nib.load(roi_file).dataobj)
+        if shape is not None:
+            assert data.shape[:3] == tuple(shape[:3]), \
+                'ROI %s does not match shape %s' % (roi_file, shape)
+        data = np.round(data).astype(int).reshape(-1)
+        labels = np.unique(data[data > 0])
+        if len(labels) == 1:
+            rois.append((_roi_name(roi_file), np.flatnonzero(data)))
+        else:
+            for label in labels:
+                rois.append(('%s_%d' % (_roi_name(roi_file), label),
+                             np.flatnonzero(data == label)))
+    return rois
+
+
+def extract_rois(in_file, roi_files, t_size=None, cache_dir=None):
+    """ Masked series of the first t_size volumes of in_file in the voxels
+    of any ROI. With cache_dir, the series is kept in
+    <cache_dir>/roi/<key>.masked, with key computed from the path, inode,
+    size and modification time of in_file and roi_files (file_stamp), so
+    every run is only read once.
+    """
+    from masked.series import (geometry, is_masked, read_masked,
+                               save_series, series_path)
+
+    shape, affine = geometry(in_file)
+    index = np.unique(np.concatenate(
+        [idx for _, idx in roi_indices(roi_files, shape)]))
+
+    if cache_dir:
+        from fieldmap.cache import FieldmapCache, file_stamp
+        key = FieldmapCache(cache_dir).key(
+            'roi', [in_file] + list(roi_files), file_key=file_stamp,
+            t_size=t_size)
+        out_path = os.path.join(os.path.abspath(cache_dir), 'roi',
+                                key + '.masked')
+        if is_masked(out_path):
+            print('roi cache hit: %s' % out_path)
+            return out_path
+        if not os.path.isdir(os.path.dirname(out_path)):
+            os.makedirs(os.path.dirname(out_path))
+    else:
+        out_path = series_path(in_file, suffix='_roi')
+
+    values = read_masked(in_file, index,
+                         stop=int(t_size) if t_size else None)
+    return save_series(out_path, values, index, shape, affine)
+
+
+def fit_rois(in_file, design_file, tcon_file, roi_files, mode='mean',
+             autocorr='ar1', t_size=None, cache_dir=None, out_dir='.'):
+    """ Fit the GLM on the ROIs of one run and write
+    <out_dir>/<run>_roi_betas.tsv and <out_dir>/<run>_roi_stats.tsv, with
+    <run> the name of in_file. Returns (betas file, stats file).
+
+    With mode='mean' the GLM is fitted on the mean time course of every ROI,
+    with mode='voxels' on all its voxels, and the tables hold the means over
+    the voxels (zmax: the maximum z).
+    """
+    from glm.fit import contrast_stats, fit_glm
+    from glm.store import pack_symmetric
+    from glm.vest import read_contrasts, read_design
+    from masked.series import SUFFIX, load_series
+
+    assert mode in ROI_MODES, 'Unknown ROI mode %s' % mode
+    out_dir = os.path.abspath(out_dir)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    X = read_design(design_file)
+    names, contrasts = read_contrasts(tcon_file)
+
+    series = load_series(extract_rois(in_file, roi_files, t_size,
+                                      cache_dir))
+    Y = series.values()
+    rois = roi_indices(roi_files, series.shape)
+    n_voxels = [len(idx) for _, idx in rois]
+    columns = [np.searchsorted(series.index, idx) for _, idx in rois]
+    if mode == 'mean':
+        Y = np.stack([Y[:, cols].mean(axis=1) for cols in columns], axis=1)
+        columns = [[r] for r in range(len(rois))]
+
+    pe, sigmasq, xtxi, dof = fit_glm(Y, X, autocorr)
+    xtxi = pack_symmetric(xtxi)
+    if xtxi.ndim == 1:
+        xtxi = xtxi[None]
+    stats = contrast_stats(pe, sigmasq, xtxi, contrasts, dof)
+
+    prefix = os.path.join(out_dir, _roi_name(in_file).replace(SUFFIX, ''))
+    betas_file = prefix + '_roi_betas.tsv'
+    with open(betas_file, 'w') as f:
+        f.write('roi\tvoxels\tregressor\tbeta\n')
+        for (name, _), cols, n in zip(rois, columns, n_voxels):
+            for i, beta in enumerate(pe[:, cols].mean(axis=1), 1):
+                f.write('%s\t%d\tpe%d\t%.6g\n' % (name, n, i, beta))
+
+    rows = []
+    for (name, _), cols, n in zip(rois, columns, n_voxels):
+        for c, contrast in enumerate(names):
+            rows.append(dict(
+                roi=name, voxels=n, contrast=contrast,
+                cope=stats['copes'][c, cols].mean(),
+                varcope=stats['varcopes'][c, cols].mean(),
+                tstat=stats['tstats'][c, cols].mean(),
+                zstat=stats['zstats'][c, cols].mean(),
+                zmax=stats['zstats'][c, cols].max(), dof=dof))
+    stats_file = write_roi_table(rows, prefix + '_roi_stats.tsv')
+    return betas_file, stats_file
+
+
+def write_roi_table(rows, out_file):
+    with open(out_file, 'w') as f:
+        f.write('%s\n' % '\t'.join(STATS_COLUMNS))
+        for row in rows:
+            f.write('%s\n' % '\t'.join(
+                '%.6g' % row[c] if isinstance(row[c], float) else
+                str(row[c]) for c in STATS_COLUMNS))
+    return os.path.abspath(out_file)
+
+
+def read_roi_table(in_file):
+    rows = []
+    with open(in_file) as f:
+        header = f.readline().rstrip('\n').split('\t')
+        for line in f:
+            row = dict(zip(header, line.rstrip('\n').split('\t')))
+            for c in header:
+                if c not in ('roi', 'contrast'):
+                    row[c] = float(row[c])
+            rows.append(row)
+    return rows
+
+
+def combine_roi_tables(stats_files, out_file='roi_stats.tsv'):
+    """ Fixed effects over runs of the cope and varcope of every ROI and
+    contrast in the roi_stats.tsv tables of the runs (see glm.fixedfx).
+    """
+    from glm.fixedfx import fixed_effects
+
+    if isinstance(stats_files, str):
+        stats_files = [stats_files]
+    runs = [read_roi_table(f) for f in stats_files]
+    keys = [(row['roi'], row['contrast']) for row in runs[0]]
+    by_key = [dict(((row['roi'], row['contrast']), row) for row in run)
+              for run in runs]
+    runs_with = [[run[key] for run in by_key if key in run] for key in keys]
+
+    rows = []
+    for key, key_runs in zip(keys, runs_with):
+        fx = fixed_effects(
+            np.array([[[row['cope']] for row in key_runs]]),
+            np.array([[[row['varcope']] for row in key_runs]]),
+            [row['dof'] for row in key_runs])
+        rows.append(dict(
+            roi=key[0], voxels=int(key_runs[0]['voxels']),
+            contrast=key[1], cope=float(fx['copes'][0, 0]),
+            varcope=float(fx['varcopes'][0, 0]),
+            tstat=float(fx['tstats'][0, 0]),
+            zstat=float(fx['zstats'][0, 0]),
+            zmax=max(row['zmax'] for row in key_runs), dof=fx['dof']))
+    out_file = write_roi_table(rows, out_file)
+
+    print('%-24s %-16s %10s %8s' % ('roi', 'contrast', 'cope', 'z'))
+    for row in rows:
+        print('%-24s %-16s %10.4g %8.2f' % (row['roi'], row['contrast'],
+                                             row['cope'], row['zstat']))
+    return out_file
+
+
+# --------------------------------------------------------- NiPype wrapper
+
+def roi_glm(in_file, design_file, tcon_file, roi_files, mode, autocorr,
+            t_size, cache_dir):
+    # necessary for importing with NiPype
+    from glm.roi import fit_rois
+    return fit_rois(in_file, design_file, tcon_file, roi_files, mode=mode,
+                    autocorr=autocorr, t_size=t_size, cache_dir=cache_dir)
+
+
+def roi_combine(stats_files):
+    # necessary for importing with NiPype
+    from glm.roi import combine_roi_tables
+    return combine_roi_tables(stats_files)
+
+
+import nipype.interfaces.utility as niu
+
+
+roi_glm_interface = niu.Function(
+    input_names=['in_file', 'design_file', 'tcon_file', 'roi_files', 'mode',
+                 'autocorr', 't_size', 'cache_dir'],
+    output_names=['betas_file', 'stats_file'],
+    function=roi_glm,
+)
+
+roi_combine_interface = niu.Function(
+    input_names=['stats_files'],
+    output_names=['stats_file'],
+    function=roi_combine,
+)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+""" Store of fitted first-level GLMs, for contrast-only re-estimation.
+
+Copes, varcopes and t/z stats are linear algebra on the parameter estimates,
+the residual variance and the unscaled covariance (X'X)^-1 of the (whitened)
+design. These are stored per run, keyed by the path, inode, size and
+modification time of the design matrix, the functional data and the mask
+(fieldmap.cache.file_stamp, a stat: looking up a run does not read it) and
+by the fit parameters:
+
+    <root>/<key>/meta.json     shape, affine, dof, regressors
+    <root>/<key>/index.npy     flat indices of the fitted voxels
+    <root>/<key>/pe.npy        regressors x voxels
+    <root>/<key>/sigmasq.npy   voxels
+    <root>/<key>/xtxi.npy      upper triangle of (X'X)^-1, per voxel (or 1 row
+                               when shared, i.e. OLS)
+
+Changing only the contrasts keeps the design, so the fit is looked up and
+only the contrasts are computed (see glm.fit.fit_glm_files).
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+def pack_symmetric(a):
+    """ Upper triangle (..., n (n + 1) / 2) of symmetric (..., n, n).
+    """
+    iu = np.triu_indices(a.shape[-1])
+    return a[..., iu[0], iu[1]]
+
+
+def quadratic_weights(contrasts, n_regs):
+    """ w such that pack_symmetric(A).dot(w[i]) == c_i' A c_i (A symmetric).
+    """
+    iu = np.triu_indices(n_regs)
+    contrasts = np.atleast_2d(contrasts)
+    w = contrasts[:, iu[0]] * contrasts[:, iu[1]]
+    w[:, iu[0] != iu[1]] *= 2
+    return w
+
+
+class GLMStore(object):
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def key(self, files, **params):
+        """ Key of a fit of the design and data in `files` with `params`.
+        """
+        from fieldmap.cache import FieldmapCache, file_stamp
+        return FieldmapCache(self.root).key('glm', files,
+                                            file_key=file_stamp, **params)
+
+    def entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def load(self, key):
+        """ Returns the stored fit as a dict (arrays memory-mapped), or None.
+        """
+        entry = self.entry_dir(key)
+        meta_file = os.path.join(entry, 'meta.json')
+        if not os.path.isfile(meta_file):
+            print('glm store miss: %s' % key)
+            return None
+        print('glm store hit: %s' % key)
+        with open(meta_file) as f:
+            fit = json.load(f)
+        fit['affine'] = np.array(fit['affine'])
+        for name in ('index', 'pe', 'sigmasq', 'xtxi'):
+            fit[name] = np.load(os.path.join(entry, name + '.npy'),
+                                mmap_mode='r')
+        return fit
+
+    def save(self, key, shape, affine, index, pe, sigmasq, xtxi, dof):
+        """ Store a fit; `xtxi` is the packed upper triangle of (X'X)^-1,
+        1 row if it is shared or 1 row per voxel.
+
+        The entry is written to a temporary directory and renamed into place.
+        """
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root, exist_ok=True)
+
+        tmp = tempfile.mkdtemp(prefix='.tmp-', dir=self.root)
+        try:
+            arrays = dict(index=np.asarray(index, dtype=np.int64),
+                          pe=np.asarray(pe, dtype=np.float32),
+                          sigmasq=np.asarray(sigmasq, dtype=np.float32),
+                          xtxi=np.asarray(xtxi, dtype=np.float32))
+            for name, value in arrays.items():
+                np.save(os.path.join(tmp, name + '.npy'), value)
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump(dict(shape=list(shape),
+                               affine=np.asarray(affine).tolist(),
+                               dof=int(dof), n_regressors=int(pe.shape[0])),
+                          f)
+            try:
+                os.rename(tmp, self.entry_dir(key))
+            except OSError:
+                # another process stored the same fit first
+                if not os.path.isdir(self.entry_dir(key)):
+                    raise
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+        return self.entry_dir(key)
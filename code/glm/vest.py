@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+""" Readers and writers for FSL's VEST text matrices (design.mat, design.con).
+"""
+
+import numpy as np
+
+
+def read_vest(path):
+    """ Returns (header dict, matrix) of a VEST file.
+
+    Header values are kept as strings, except /ContrastName<i> lines, which
+    are collected into header['ContrastNames'].
+    """
+    header = dict()
+    names = dict()
+    rows = []
+    in_matrix = False
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if in_matrix:
+                rows.append([float(v) for v in line.split()])
+            elif line.startswith('/Matrix'):
+                in_matrix = True
+            elif line.startswith('/ContrastName'):
+                key, _, value = line.partition('\t')
+                if not value:
+                    key, _, value = line.partition(' ')
+                names[int(key[len('/ContrastName'):])] = value.strip()
+            elif line.startswith('/'):
+                fields = line[1:].split(None, 1)
+                header[fields[0]] = fields[1] if len(fields) > 1 else ''
+    if names:
+        header['ContrastNames'] = [names[i] for i in sorted(names)]
+    return header, np.array(rows, dtype=np.float64)
+
+
+def read_design(path):
+    """ (time x regressors) design matrix of a design.mat file.
+    """
+    return read_vest(path)[1]
+
+
+def read_contrasts(path):
+    """ (names, contrasts x regressors matrix) of a design.con file.
+    """
+    header, matrix = read_vest(path)
+    names = header.get('ContrastNames',
+                       ['C%d' % (i + 1) for i in range(matrix.shape[0])])
+    return names, matrix
+
+
+def write_design(path, design):
+    design = np.asarray(design, dtype=np.float64)
+    heights = np.ptp(design, axis=0)
+    with open(path, 'w') as f:
+        f.write('/NumWaves\t%d\n' % design.shape[1])
+        f.write('/NumPoints\t%d\n' % design.shape[0])
+        f.write('/PPheights\t%s\n' % '\t'.join('%e' % h for h in heights))
+        f.write('\n/Matrix\n')
+        for row in design:
+            f.write('%s\n' % '\t'.join('%e' % v for v in row))
+    return path
+
+
+def write_contrasts(path, names, contrasts):
+    contrasts = np.atleast_2d(np.asarray(contrasts, dtype=np.float64))
+    with open(path, 'w') as f:
+        for i, name in enumerate(names, 1):
+            f.write('/ContrastName%d\t%s\n' % (i, name))
+        f.write('/NumWaves\t%d\n' % contrasts.shape[1])
+        f.write('/NumContrasts\t%d\n' % contrasts.shape[0])
+        f.write('/PPheights\t%s\n' % '\t'.join(
+            '%e' % 1. for _ in range(contrasts.shape[0])))
+        f.write('/RequiredEffect\t%s\n' % '\t'.join(
+            '%.3f' % 1. for _ in range(contrasts.shape[0])))
+        f.write('\n/Matrix\n')
+        for row in contrasts:
+            f.write('%s\n' % '\t'.join('%e' % v for v in row))
+    return path
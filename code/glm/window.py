@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+""" Lazy time windows on functional runs.
+
+beh_roi (fslroi <func> <roi> 0 <t_size>) writes a truncated, recompressed
+copy of every run to drop the volumes after the last response. The native
+design and GLM instead read only the first t_size volumes of the original
+run (see glm.fit.load_masked); this module reports what that saves.
+"""
+
+import os
+
+
+def window_savings(in_file, t_size):
+    """ Bytes that the fslroi copy of `in_file` would have cost: reading the
+    whole run, and writing (and storing) the compressed copy, estimated from
+    the compressed size of the run.
+    """
+    import nibabel as nib
+
+    img = nib.load(in_file)
+    nvols = img.shape[3] if len(img.shape) > 3 else 1
+    t_size = min(int(t_size), nvols)
+    volume_bytes = img.dataobj.dtype.itemsize
+    for n in img.shape[:3]:
+        volume_bytes *= n
+    written = int(os.path.getsize(in_file) * float(t_size) / nvols)
+    return dict(file=in_file, nvols=nvols, t_size=t_size,
+                read=nvols * volume_bytes, written=written)
+
+
+def write_window_report(in_files, t_sizes, out_file='window_report.tsv'):
+    """ Per run savings of the lazy window and the session total, as TSV.
+    """
+    if isinstance(in_files, str):
+        in_files, t_sizes = [in_files], [t_sizes]
+
+    rows = [window_savings(f, t) for f, t in zip(in_files, t_sizes)]
+    columns = ['file', 'nvols', 't_size', 'read', 'written']
+    out_file = os.path.abspath(out_file)
+    with open(out_file, 'w') as f:
+        f.write('%s\n' % '\t'.join(columns))
+        for row in rows:
+            f.write('%s\n' % '\t'.join(str(row[c]) for c in columns))
+        f.write('total\t%d\t%d\t%d\t%d\n' % tuple(
+            sum(row[c] for row in rows) for c in columns[1:]))
+
+    mb = 1024. ** 2
+    print('Lazy time window: %d runs, %.1f MB not read, %.1f MB not written '
+          'to disk (%d of %d volumes used)' % (
+              len(rows), sum(r['read'] for r in rows) / mb,
+              sum(r['written'] for r in rows) / mb,
+              sum(r['t_size'] for r in rows),
+              sum(r['nvols'] for r in rows)))
+    return out_file
+
+
+# --------------------------------------------------------- NiPype wrapper
+
+def window_report(in_files, t_sizes):
+    # necessary for importing with NiPype
+    from glm.window import write_window_report
+    return write_window_report(in_files, t_sizes)
+
+
+import nipype.interfaces.utility as niu
+
+
+window_report_interface = niu.Function(
+    input_names=['in_files', 't_sizes'],
+    output_names=['report_file'],
+    function=window_report,
+)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+""" Drop-in replacements for nipype.workflows.fmri.fsl.create_modelfit_workflow
+and create_fixed_effects_flow, where FILMGLS and flameo are replaced by the
+native GLM of glm/fit.py and the fixed effects of glm/fixedfx.py. Inputs and
+outputs have the same names.
+"""
+
+import nipype.interfaces.fsl as fsl
+from nipype.interfaces import utility as niu
+import nipype.pipeline.engine as pe
+
+from glm.fit import native_glm_interface
+from glm.fixedfx import native_fixed_effects_interface
+
+
+def create_modelfit_workflow(name='modelfit', autocorr='ar1',
+                             store_dir=None, design='feat'):
+    """ Level1Design -> FEATModel -> native GLM, per run.
+
+    With design='native', the design matrices are built outside of this
+    workflow (see glm/design.py) and passed in as inputspec.design_files and
+    inputspec.tcon_files; Level1Design and FEATModel are left out. Only the
+    first inputspec.functional_nvols volumes of every run are then fitted,
+    so the functional data need not be truncated beforehand.
+
+    With `store_dir`, fits are kept in a glm.store.GLMStore and runs whose
+    design and data did not change only compute the (new) contrasts.
+
+    Inputs::
+
+         inputspec.session_info : info generated by modelgen.SpecifyModel
+         inputspec.interscan_interval : interscan interval
+         inputspec.contrasts : list of contrasts
+         inputspec.film_threshold : image threshold for the estimation
+         inputspec.model_serial_correlations : prewhiten with `autocorr`
+         inputspec.bases
+         inputspec.design_files : design.mat per run (design='native')
+         inputspec.tcon_files : design.con per run (design='native')
+         inputspec.functional_nvols : volumes to use per run (design='native')
+
+    Outputs::
+
+         outputspec.copes
+         outputspec.varcopes
+         outputspec.dof_file
+         outputspec.tstats
+         outputspec.zfiles
+         outputspec.parameter_estimates
+         outputspec.sigmasquareds
+    """
+    modelfit = pe.Workflow(name=name)
+
+    inputspec = pe.Node(
+        niu.IdentityInterface(fields=[
+            'session_info', 'interscan_interval', 'contrasts',
+            'film_threshold', 'functional_data', 'bases',
+            'model_serial_correlations', 'design_files', 'tcon_files',
+            'functional_nvols'
+        ]),
+        name='inputspec')
+    iterfield = ['design_file', 'in_file', 'tcon_file']
+    if design == 'native':
+        iterfield.append('t_size')
+    modelestimate = pe.MapNode(
+        interface=native_glm_interface,
+        name='modelestimate',
+        iterfield=iterfield)
+    modelestimate.inputs.autocorr = autocorr
+    modelestimate.inputs.store_dir = store_dir
+    outputspec = pe.Node(
+        niu.IdentityInterface(fields=[
+            'copes', 'varcopes', 'dof_file', 'tstats', 'zfiles',
+            'parameter_estimates', 'sigmasquareds'
+        ]),
+        name='outputspec')
+
+    modelfit.connect([
+        (inputspec, modelestimate,
+         [('film_threshold', 'threshold'),
+          ('functional_data', 'in_file'),
+          ('model_serial_correlations', 'serial_correlations')]),
+        (modelestimate, outputspec,
+         [('copes', 'copes'),
+          ('varcopes', 'varcopes'),
+          ('dof_file', 'dof_file'),
+          ('tstats', 'tstats'),
+          ('zstats', 'zfiles'),
+          ('param_estimates', 'parameter_estimates'),
+          ('sigmasquareds', 'sigmasquareds')]),
+    ])
+
+    if design == 'native':
+        modelfit.connect([
+            (inputspec, modelestimate,
+             [('design_files', 'design_file'),
+              ('tcon_files', 'tcon_file'),
+              ('functional_nvols', 't_size')]),
+        ])
+        return modelfit
+
+    assert design == 'feat', 'Unknown design %s' % design
+    modelestimate.inputs.t_size = None
+    level1design = pe.Node(interface=fsl.Level1Design(), name="level1design")
+    modelgen = pe.MapNode(
+        interface=fsl.FEATModel(),
+        name='modelgen',
+        iterfield=['fsf_file', 'ev_files'])
+
+    modelfit.connect([
+        (inputspec, level1design,
+         [('interscan_interval', 'interscan_interval'),
+          ('session_info', 'session_info'),
+          ('contrasts', 'contrasts'),
+          ('bases', 'bases'),
+          ('model_serial_correlations', 'model_serial_correlations')]),
+        (level1design, modelgen,
+         [('fsf_files', 'fsf_file'),
+          ('ev_files', 'ev_files')]),
+        (modelgen, modelestimate,
+         [('design_file', 'design_file'),
+          ('con_file', 'tcon_file')]),
+    ])
+    return modelfit
+
+
+def create_fixed_effects_flow(name='fixedfx', store_dir=None, res4d=True):
+    """ Native counterpart of nipype's create_fixed_effects_flow: all
+    contrasts and runs are combined by a single node (see glm/fixedfx.py).
+
+    Inputs::
+
+         inputspec.copes : list of list of cope files (one list per contrast)
+         inputspec.varcopes : list of list of varcope files (one list per
+                              contrast)
+         inputspec.dof_files : degrees of freedom files for each run
+         inputspec.mask_file : mask
+         inputspec.session : name of the session (e.g. sub-X_ses-Y), the
+                             store of the session is <store_dir>/<session>;
+                             without it, the store is not used
+
+    With `store_dir`, every session keeps the sums over its runs in a
+    glm.fxstore.FixedEffectsStore, so adding (or removing) a run only reads
+    that run. res4d reads the stored contributions of all runs; without
+    it, outputspec.res4d is empty.
+
+    Outputs::
+
+         outputspec.res4d : weighted residuals over runs, per contrast
+         outputspec.copes
+         outputspec.varcopes
+         outputspec.zstats
+         outputspec.tstats
+         outputspec.dof_file
+    """
+    fixed_fx = pe.Workflow(name=name)
+
+    inputspec = pe.Node(
+        niu.IdentityInterface(fields=['copes', 'varcopes', 'dof_files',
+                                      'mask_file', 'session']),
+        name='inputspec')
+    estimate = pe.Node(
+        interface=native_fixed_effects_interface,
+        name='estimate')
+    estimate.inputs.store_dir = store_dir
+    estimate.inputs.res4d = res4d
+    outputspec = pe.Node(
+        niu.IdentityInterface(fields=['res4d', 'copes', 'varcopes', 'zstats',
+                                      'tstats', 'dof_file']),
+        name='outputspec')
+
+    fixed_fx.connect([
+        (inputspec, estimate,
+         [('copes', 'copes'),
+          ('varcopes', 'varcopes'),
+          ('dof_files', 'dof_files'),
+          ('mask_file', 'mask_file'),
+          ('session', 'session')]),
+        (estimate, outputspec,
+         [('res4d', 'res4d'),
+          ('copes', 'copes'),
+          ('varcopes', 'varcopes'),
+          ('zstats', 'zstats'),
+          ('tstats', 'tstats'),
+          ('dof_file', 'dof_file')]),
+    ])
+    return fixed_fx
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+""" Run nodes that do not depend on the iterables once.
+
+NiPype expands the whole graph below an iterable node once per value: with
+preprocessing_workflow iterating over (subject, session, run), every node
+of featpreproc exists once per run, also those whose inputs are the same
+for all runs of a session (input_files of the ref_* templates, dilatemask
+of ref_funcmask, the reference DataSink entries).
+
+run(workflow) runs a workflow with NiPype's generate_expanded_graph wrapped
+by dedupe() (enable() and disable() for the whole process), which walks
+the expanded graph in topological order and merges a node into an earlier
+copy of it (same node of the workflow, same interface and inputs, inputs
+connected from the same, already merged, nodes). The consumers of the
+merged node are connected to the copy that is kept, so the node runs once.
+JoinNodes and nodes with iterables are left as they are.
+"""
+
+from collections import OrderedDict
+
+
+def _static_inputs(node):
+    from nipype.interfaces.base import isdefined
+    inputs = node.inputs.get_traitsfree()
+    return repr(sorted((name, value) for name, value in inputs.items()
+                       if isdefined(value)))
+
+
+def node_signature(node, graph, canonical):
+    """ What a node computes, or None if it must not be merged: its place
+    in the workflow, interface, inputs and (merged) input connections.
+    """
+    from nipype.pipeline.engine import JoinNode, MapNode
+
+    if isinstance(node, JoinNode) or getattr(node, 'iterables', None) or \
+            getattr(node, 'itersource', None):
+        return None
+    connections = []
+    for source, _, data in graph.in_edges(node, data=True):
+        for connect in data.get('connect', []):
+            connections.append((canonical[source]._id, repr(connect)))
+    iterfield = node.iterfield if isinstance(node, MapNode) else None
+    return (node._hierarchy, node.name, type(node).__name__,
+            type(node.interface).__module__, type(node.interface).__name__,
+            repr(iterfield), _static_inputs(node), tuple(sorted(connections)))
+
+
+def dedupe(graph, report=True):
+    """ Merge the duplicate nodes of an expanded graph (in place).
+    Returns (graph, {node name: executions removed}).
+    """
+    import networkx as nx
+
+    canonical = dict()
+    kept = dict()
+    duplicates = []
+    for node in list(nx.topological_sort(graph)):
+        signature = node_signature(node, graph, canonical)
+        if signature is None or signature not in kept:
+            canonical[node] = node
+            if signature is not None:
+                kept[signature] = node
+        else:
+            canonical[node] = kept[signature]
+            duplicates.append(node)
+
+    removed = OrderedDict()
+    for node in duplicates:
+        keep = canonical[node]
+        for _, target, data in list(graph.out_edges(node, data=True)):
+            connect = list(data.get('connect', []))
+            if graph.has_edge(keep, target):
+                existing = graph.get_edge_data(keep, target)
+                existing_connect = existing.setdefault('connect', [])
+                for c in connect:
+                    if c not in existing_connect:
+                        existing_connect.append(c)
+            else:
+                graph.add_edge(keep, target, connect=connect)
+        graph.remove_node(node)
+        name = '%s.%s' % (node._hierarchy, node.name)
+        removed[name] = removed.get(name, 0) + 1
+
+    if report:
+        n_removed = sum(removed.values())
+        print('graph dedup: %d of %d node executions eliminated' % (
+            n_removed, n_removed + graph.number_of_nodes()))
+        for name, count in removed.items():
+            print('  %-60s %4d' % (name, count))
+    return graph, removed
+
+
+_installed = None
+
+
+def enable():
+    """ Deduplicate the expanded graph of every Workflow.run() of this
+    process.
+    """
+    import nipype.pipeline.engine.workflows as workflows
+
+    global _installed
+    if _installed is not None:
+        return
+    original = workflows.generate_expanded_graph
+
+    def generate_expanded_graph(graph_in):
+        graph, _ = dedupe(original(graph_in))
+        return graph
+
+    workflows.generate_expanded_graph = generate_expanded_graph
+    _installed = original
+
+
+def disable():
+    import nipype.pipeline.engine.workflows as workflows
+
+    global _installed
+    if _installed is not None:
+        workflows.generate_expanded_graph = _installed
+        _installed = None
+
+
+def run(workflow, *args, **kwargs):
+    """ workflow.run(*args, **kwargs) with the expanded graph deduplicated;
+    other runs of this process are left as they are.
+    """
+    if _installed is not None:
+        return workflow.run(*args, **kwargs)
+    enable()
+    try:
+        return workflow.run(*args, **kwargs)
+    finally:
+        disable()
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+""" Persistent cache of the file hashes of NiPype's content hashing.
+
+The workflows hash by timestamp (NiPype's default execution.hash_method):
+a node reruns when one of its input files was touched, also if its content
+did not change (e.g. an output written again by a rerun upstream node).
+With hash_method = 'content', NiPype reads every input file of every node
+to decide whether the node is cached, which for the multi-GB NIfTI files
+of a dataset means minutes of I/O before any node runs. enable(workflow)
+(modelfit_workflow.py --hash-cache) sets the content hashing for the nodes
+of a workflow and, here and in the processes running them (PBS jobs),
+replaces nipype's hash_infile by a lookup in
+
+    workingdirs/hashcache.sqlite
+        hashes(dev, ino, size, mtime_ns, algo, digest, seconds, path)
+
+keyed by the stat of the file, so a file is only read again after it
+changed. The digests are the ones NiPype computes (md5 unless asked
+otherwise), so the node hashes are those of NiPype's content hashing (a
+working directory hashed by timestamp reruns its nodes once), but are
+computed in 1 MB chunks, and a file that changes while being hashed is not
+cached.
+
+The key trusts the stat of the file: a file rewritten in place with the same
+size within the mtime resolution of its filesystem keeps its old digest.
+Local filesystems record nanoseconds, but NFS and some cluster filesystems
+only store seconds (or less, depending on the server), so the cache is off
+unless asked for and should not be used on data that is rewritten while a
+workflow runs.
+
+At exit the hit rate and the hashing time saved (the time it took to hash
+the files found in the cache) are reported. The cache can also be filled
+ahead of a run, hashing on a pool of threads (hashlib releases the GIL):
+
+    python -m hashcache warm derivatives/featpreproc
+    python -m hashcache stats
+    python -m hashcache prune
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+ds_root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+CHUNK_SIZE = 1024 ** 2
+
+
+def default_cache_file():
+    return os.path.join(ds_root, 'workingdirs', 'hashcache.sqlite')
+
+
+def _algo(crypto):
+    return crypto().name
+
+
+def file_key(path):
+    """ (dev, ino, size, mtime_ns) of path, or None if it is not a file.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not os.path.isfile(path):
+        return None
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def hash_file(path, crypto=hashlib.md5, chunk_size=CHUNK_SIZE):
+    """ Hex digest of the content of path (as nipype's hash_infile).
+    """
+    h = crypto()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+class HashCache(object):
+    def __init__(self, cache_file=None):
+        self.cache_file = os.path.abspath(cache_file or default_cache_file())
+        if not os.path.isdir(os.path.dirname(self.cache_file)):
+            os.makedirs(os.path.dirname(self.cache_file))
+        self._local = threading.local()
+        self.stats = dict(hits=0, misses=0, hit_bytes=0, miss_bytes=0,
+                          hash_seconds=0., saved_seconds=0.)
+        self._lock = threading.Lock()
+        self._db().executescript('''
+            CREATE TABLE IF NOT EXISTS hashes (
+                dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,
+                algo TEXT, digest TEXT, seconds REAL, path TEXT,
+                PRIMARY KEY (dev, ino, size, mtime_ns, algo));
+        ''')
+
+    def _db(self):
+        """ Connection of this thread and process (workers may be forked).
+        """
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.cache_file, timeout=60)
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def _count(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                self.stats[name] += value
+
+    def lookup(self, key, algo):
+        row = self._db().execute(
+            'SELECT digest, seconds FROM hashes WHERE dev = ? AND ino = ? '
+            'AND size = ? AND mtime_ns = ? AND algo = ?',
+            tuple(key) + (algo,)).fetchone()
+        return row
+
+    def digest(self, path, crypto=hashlib.md5):
+        """ Hex digest of the file path, from the cache if it did not change
+        since it was hashed. None if path is not a file.
+        """
+        key = file_key(path)
+        if key is None:
+            return None
+        algo = _algo(crypto)
+        try:
+            row = self.lookup(key, algo)
+        except sqlite3.Error:
+            row = None
+        if row is not None:
+            self._count(hits=1, hit_bytes=key[2], saved_seconds=row[1])
+            return row[0]
+
+        start = time.time()
+        digest = hash_file(path, crypto)
+        seconds = time.time() - start
+        self._count(misses=1, miss_bytes=key[2], hash_seconds=seconds)
+        if file_key(path) == key:
+            try:
+                with self._db() as db:
+                    db.execute(
+                        'INSERT OR REPLACE INTO hashes VALUES '
+                        '(?, ?, ?, ?, ?, ?, ?, ?)',
+                        tuple(key) + (algo, digest, seconds,
+                                      os.path.abspath(path)))
+            except sqlite3.Error:
+                pass
+        return digest
+
+    def warm(self, paths, n_threads=None, crypto=hashlib.md5):
+        """ Hash the files in paths (files or directories, recursively) that
+        are not in the cache yet, on n_threads threads.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                for root, _, names in os.walk(path):
+                    files.extend(os.path.join(root, n) for n in names)
+            else:
+                files.append(path)
+        # biggest first, for a better balance over the threads
+        files.sort(key=lambda f: -(file_key(f) or (0, 0, 0))[2])
+        with ThreadPoolExecutor(n_threads or os.cpu_count() or 1) as pool:
+            list(pool.map(lambda f: self.digest(f, crypto), files))
+        return len(files)
+
+    def prune(self):
+        """ Remove the entries of files that were removed or changed.
+        """
+        db = self._db()
+        rows = db.execute(
+            'SELECT dev, ino, size, mtime_ns, path FROM hashes').fetchall()
+        stale = [row[:4] for row in rows if file_key(row[4]) != row[:4]]
+        with db:
+            db.executemany('DELETE FROM hashes WHERE dev = ? AND ino = ? AND '
+                           'size = ? AND mtime_ns = ?', stale)
+        return len(stale)
+
+    def summary(self):
+        db = self._db()
+        return db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0), '
+                          'COALESCE(SUM(seconds), 0) FROM hashes').fetchone()
+
+    def report(self):
+        s = self.stats
+        lookups = s['hits'] + s['misses']
+        if not lookups:
+            return
+        print('hash cache: %d files, %.1f%% hits (%.1f GB not read, ~%.1f s '
+              'saved), hashed %.1f GB in %.1f s' % (
+                  lookups, 100. * s['hits'] / lookups,
+                  s['hit_bytes'] / 1024. ** 3, s['saved_seconds'],
+                  s['miss_bytes'] / 1024. ** 3, s['hash_seconds']))
+
+
+# --------------------------------------------------------- NiPype hook
+
+_installed = None
+
+
+def install(cache_file=None, report=True):
+    """ Use a HashCache for NiPype's content hashing in this process (and
+    the workers it forks). Returns the cache.
+    """
+    import atexit
+    import nipype.interfaces.base.specs as specs
+    import nipype.interfaces.base.support as support
+    import nipype.utils.filemanip as filemanip
+
+    global _installed
+    if _installed is not None:
+        return _installed[0]
+    cache = HashCache(cache_file)
+    original = filemanip.hash_infile
+
+    def hash_infile(afile, chunk_len=8192, crypto=hashlib.md5,
+                    raise_notfound=False):
+        if not os.path.isfile(afile):
+            return original(afile, chunk_len, crypto, raise_notfound)
+        return cache.digest(afile, crypto)
+
+    for module in (filemanip, specs, support):
+        module.hash_infile = hash_infile
+    _installed = (cache, original)
+    if report:
+        pid = os.getpid()
+        atexit.register(lambda: os.getpid() == pid and cache.report())
+    return cache
+
+
+class HashSettings(object):
+    """ Hash cache carried by a node: unpickling it (in the process running
+    the node) installs the cache.
+    """
+
+    def __init__(self, cache_file=None):
+        self.cache_file = os.path.abspath(cache_file or default_cache_file())
+
+    def __getstate__(self):
+        return dict(cache_file=self.cache_file)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        install(self.cache_file)
+
+
+def enable(workflow, cache_file=None):
+    """ Decide whether the nodes of workflow are cached by the content of
+    their input files, hashed with the cache here and in the processes
+    running them.
+    """
+    settings = HashSettings(cache_file)
+    install(settings.cache_file)
+    workflow.config['execution']['hash_method'] = 'content'
+    for node in workflow._get_all_nodes():
+        node.hash_cache = settings
+    return workflow
+
+
+def uninstall():
+    import nipype.interfaces.base.specs as specs
+    import nipype.interfaces.base.support as support
+    import nipype.utils.filemanip as filemanip
+
+    global _installed
+    if _installed is None:
+        return
+    for module in (filemanip, specs, support):
+        module.hash_infile = _installed[1]
+    _installed = None
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Persistent cache of the file hashes of NiPype.')
+    parser.add_argument('--cache-file', default=None,
+                        help='Default: workingdirs/hashcache.sqlite.')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('warm', help='Hash files ahead of a run.')
+    p.add_argument('paths', nargs='+')
+    p.add_argument('-j', '--threads', type=int, default=None)
+    sub.add_parser('stats')
+    sub.add_parser('prune', help='Forget removed or changed files.')
+    args = parser.parse_args()
+
+    cache = HashCache(args.cache_file)
+    if args.command == 'warm':
+        start = time.time()
+        n = cache.warm(args.paths, args.threads)
+        print('%d files in %.1f s' % (n, time.time() - start))
+        cache.report()
+    elif args.command == 'prune':
+        print('removed %d entries' % cache.prune())
+    elif args.command == 'stats':
+        n, size, seconds = cache.summary()
+        print('%s: %d files, %.1f GB, %.1f s to hash' % (
+            cache.cache_file, n, size / 1024. ** 3, seconds))
+    else:
+        parser.print_help()
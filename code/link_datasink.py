@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+""" DataSink that links its outputs into derivatives/ instead of copying.
+
+nio.DataSink copies every output, one after the other and in full, so with
+keep_inputs and remove_unnecessary_outputs=False every 4D series of a
+workflow is on disk twice (workingdirs/ and derivatives/) and sinking it
+costs a full read and write. LinkDataSink puts each file in place with the
+cheapest of
+
+  link             a hardlink (same file system)
+  reflink          a copy-on-write clone (FICLONE, e.g. on XFS and Btrfs)
+  copy_file_range  a copy in the kernel (Python >= 3.8)
+  copy             a copy in chunks of 64 MB, on a pool of threads
+
+and transfers the files of a sink in parallel. transfer_mode='reflink'
+never hardlinks (a hardlinked derivative changes with a node output that
+is written in place), transfer_mode='copy' always copies. A destination
+that is the same file as the source, or has its size and modification time
+(which are kept by all methods), is left as it is.
+
+The substitutions and regexp_substitutions are compiled once per sink
+instead of once per file and rule. Each sink reports the bytes it linked,
+cloned and copied.
+"""
+
+import fcntl
+import os
+import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import nipype.interfaces.io as nio
+from nipype.interfaces.base import isdefined, traits
+
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int) of linux/fs.h
+CHUNK_SIZE = 64 * 1024 ** 2
+
+METHODS = ['unchanged', 'link', 'reflink', 'copy_file_range', 'copy']
+
+
+def unchanged(src, dst):
+    """ Whether dst is src, or a copy of it (same size and mtime).
+    """
+    try:
+        s, d = os.stat(src), os.stat(dst)
+    except OSError:
+        return False
+    return (s.st_dev, s.st_ino) == (d.st_dev, d.st_ino) or \
+        (s.st_size, s.st_mtime_ns) == (d.st_size, d.st_mtime_ns)
+
+
+def reflink(src, dst):
+    """ Clone src to dst (copy-on-write). False if the file system can't.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return True
+        except OSError:
+            pass
+    os.remove(dst)
+    return False
+
+
+def copy_data(src, dst, n_threads=4, chunk_size=CHUNK_SIZE):
+    """ Copy the content of src to dst, with copy_file_range if possible or
+    in chunks on n_threads threads. Returns the method used.
+    """
+    size = os.path.getsize(src)
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        copy_file_range = getattr(os, 'copy_file_range', None)
+        if copy_file_range is not None:
+            offset = 0
+            try:
+                while offset < size:
+                    n = copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                        size - offset, offset, offset)
+                    if not n:
+                        break
+                    offset += n
+            except OSError:
+                pass
+            if offset == size:
+                return 'copy_file_range'
+
+        os.ftruncate(fdst.fileno(), size)
+
+        def copy_chunk(offset):
+            end = min(offset + chunk_size, size)
+            while offset < end:
+                data = os.pread(fsrc.fileno(), end - offset, offset)
+                if not data:
+                    raise IOError('%s: unexpected end of file' % src)
+                offset += os.pwrite(fdst.fileno(), data, offset)
+
+        chunks = range(0, size, chunk_size)
+        if len(chunks) > 1 and n_threads > 1:
+            with ThreadPoolExecutor(min(n_threads, len(chunks))) as pool:
+                list(pool.map(copy_chunk, chunks))
+        else:
+            for offset in chunks:
+                copy_chunk(offset)
+    return 'copy'
+
+
+def transfer(src, dst, mode='link', n_threads=4):
+    """ Put the file src at dst, with the cheapest method mode allows
+    ('link': link, reflink or copy; 'reflink': reflink or copy; 'copy').
+    dst is replaced atomically. Returns the method used (see METHODS).
+    """
+    if unchanged(src, dst):
+        return 'unchanged'
+    tmp = os.path.join(os.path.dirname(dst), '.%s.%d.tmp' % (
+        os.path.basename(dst), os.getpid()))
+    try:
+        method = None
+        if mode == 'link':
+            try:
+                os.link(src, tmp)
+                method = 'link'
+            except OSError:
+                # e.g. another file system
+                pass
+        if method is None and mode in ('link', 'reflink') and \
+                reflink(src, tmp):
+            method = 'reflink'
+        if method is None:
+            method = copy_data(src, tmp, n_threads)
+        if method != 'link':
+            shutil.copystat(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        raise
+    return method
+
+
+class LinkDataSinkInputSpec(nio.DataSinkInputSpec):
+    transfer_mode = traits.Enum(
+        'link', 'reflink', 'copy', usedefault=True,
+        desc='link: hardlink, reflink or copy; reflink: reflink or copy; '
+             'copy: always copy')
+    n_threads = traits.Int(
+        4, usedefault=True,
+        desc='files (and chunks of a file) transferred in parallel')
+
+
+class LinkDataSink(nio.DataSink):
+    """ nio.DataSink that links or clones its outputs where it can (see
+    link_datasink.py), with the same inputs and destinations.
+    """
+    input_spec = LinkDataSinkInputSpec
+
+    def _rules(self):
+        substitutions = tuple(self.inputs.substitutions) \
+            if isdefined(self.inputs.substitutions) else ()
+        regexps = tuple(self.inputs.regexp_substitutions) \
+            if isdefined(self.inputs.regexp_substitutions) else ()
+        compiled = getattr(self, '_compiled', None)
+        if compiled is None or compiled[0] != (substitutions, regexps):
+            rules = [(None, key, value) for key, value in substitutions] + \
+                [(re.compile(key), key, value) for key, value in regexps]
+            compiled = self._compiled = ((substitutions, regexps), rules)
+        return compiled[1]
+
+    def _substitute(self, pathstr):
+        # in order, as nio.DataSink: a rule applies to the result of the
+        # rules before it
+        out = pathstr
+        for regexp, key, value in self._rules():
+            if regexp is not None:
+                out = regexp.sub(value, out)
+            elif key in out:
+                out = out.replace(key, value)
+        return out
+
+    def _destinations(self, outdir):
+        """ [(source file, destination)] of all inputs, and the outputs
+        (files and directories) of the sink.
+        """
+        pairs, out_files = [], []
+        for key, files in list(self.inputs._outputs.items()):
+            if not isdefined(files):
+                continue
+            files = files if isinstance(files, list) else [files]
+            if files and isinstance(files[0], list):
+                files = [item for sublist in files for item in sublist]
+            tempoutdir = outdir
+            for d in key.split('.'):
+                if d[0] == '@':
+                    continue
+                tempoutdir = os.path.join(tempoutdir, d)
+
+            for src in files:
+                src = os.path.abspath(src)
+                if not os.path.isfile(src):
+                    src = os.path.join(src, '')
+                dst = self._substitute(os.path.join(tempoutdir,
+                                                    self._get_dst(src)))
+                if os.path.isfile(src):
+                    pairs.append((src, dst))
+                    out_files.append(dst)
+                elif os.path.isdir(src):
+                    if os.path.exists(dst) and self.inputs.remove_dest_dir:
+                        shutil.rmtree(dst)
+                    for root, _, names in os.walk(src):
+                        rel = os.path.relpath(root, src)
+                        pairs.extend((os.path.join(root, name),
+                                      os.path.normpath(
+                                          os.path.join(dst, rel, name)))
+                                     for name in names)
+                    out_files.append(dst)
+        return pairs, out_files
+
+    def _list_outputs(self):
+        s3_flag, _ = self._check_s3_base_dir()
+        if s3_flag or isdefined(self.inputs.local_copy):
+            return super(LinkDataSink, self)._list_outputs()
+
+        start = time.time()
+        outdir = self.inputs.base_directory \
+            if isdefined(self.inputs.base_directory) else '.'
+        if isdefined(self.inputs.container):
+            outdir = os.path.join(outdir, self.inputs.container)
+        outdir = os.path.abspath(outdir)
+
+        pairs, out_files = self._destinations(outdir)
+        for path in set(os.path.dirname(dst) for _, dst in pairs):
+            os.makedirs(path, exist_ok=True)
+
+        mode, n_threads = self.inputs.transfer_mode, self.inputs.n_threads
+        with ThreadPoolExecutor(max(1, n_threads)) as pool:
+            methods = list(pool.map(
+                lambda pair: transfer(pair[0], pair[1], mode, n_threads),
+                pairs))
+
+        stats = dict((method, [0, 0]) for method in METHODS)
+        for (src, _), method in zip(pairs, methods):
+            stats[method][0] += 1
+            stats[method][1] += os.path.getsize(src)
+        self._transfer_stats = stats
+        print('%s: %d files in %.1f s; %s' % (
+            type(self).__name__, len(pairs), time.time() - start,
+            ', '.join('%s %d (%.2f GB)' % (method, n, size / 1024. ** 3)
+                      for method, (n, size) in
+                      ((m, stats[m]) for m in METHODS) if n)))
+
+        outputs = self.output_spec().get()
+        outputs['out_file'] = out_files
+        return outputs
@@ -0,0 +1,2 @@
+
+from masked.filters import native_filter_interface
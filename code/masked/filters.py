@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+""" Native intensity normalisation and temporal filtering on masked series.
+
+Replaces featpreproc's meanscale (fslmaths -mul 10000/median), highpass
+(fslmaths -bptf sigma -1), meanfunc4/addmean (adding back the temporal mean
+removed by bptf as of FSL 5.0.7) and meanfunc3 (-Tmean) by one pass over the
+voxels inside the dilated mask, reading the run once.
+"""
+
+import os
+
+import numpy as np
+
+
+def median_scale(values, median, target=10000.):
+    """ Scale (time x voxels) values in place so that `median` (the median
+    of the run inside the brain, as medianval) becomes `target`.
+    """
+    values *= np.float32(target / median)
+    return values
+
+
+def highpass(values, sigma, add_mean=True, block_size=4096):
+    """ bptf high-pass of (time x voxels) values in place, with `sigma` in
+    volumes (as fslmaths -bptf). With add_mean, the temporal mean is kept.
+    """
+    from glm.design import highpass_matrix
+
+    if not sigma or sigma <= 0:
+        return values
+    matrix = highpass_matrix(values.shape[0], float(sigma)).astype(np.float32)
+    for start in range(0, values.shape[1], block_size):
+        block = values[:, start:start + block_size]
+        mean = block.mean(axis=0)
+        block[...] = matrix.dot(block)
+        if add_mean:
+            block += mean
+    return values
+
+
+def filter_series(in_file, mask_file, median, highpass_sigma,
+                  out_dir=None, dtype='float32', write_nifti=True):
+    """ Intensity normalise and high-pass in_file (NIfTI or masked series)
+    inside mask_file.
+
+    Writes <base>_gms_tempfilt_maths.masked (see masked/series.py) and, with
+    write_nifti, the same as NIfTI for FSL stages, and the temporal mean
+    <base>_gms_mean.nii.gz. Returns (masked series, NIfTI or None, mean).
+    """
+    import nibabel as nib
+    from masked.series import (geometry, is_masked, load_series,
+                               mask_index, read_masked, save_series,
+                               series_path, to_nifti)
+
+    if out_dir is None:
+        out_dir = os.getcwd()
+    if is_masked(in_file):
+        series = load_series(in_file)
+        index, shape, affine, tr = (series.index, series.shape,
+                                    series.affine, series.tr)
+    else:
+        shape, affine = geometry(in_file)
+        index = mask_index(mask_file, shape)
+        tr = float(nib.load(in_file).header.get_zooms()[3])
+    values = read_masked(in_file, index)
+
+    median_scale(values, median)
+    mean = values.mean(axis=0)
+    highpass(values, highpass_sigma)
+
+    out_path = series_path(in_file, out_dir, '_gms_tempfilt_maths')
+    save_series(out_path, values, index, shape, affine, dtype, tr)
+
+    mean_file = out_path[:-len('_tempfilt_maths.masked')] + '_mean.nii.gz'
+    volume = np.zeros(int(np.prod(shape)), dtype=np.float32)
+    volume[index] = mean
+    nib.save(nib.Nifti1Image(volume.reshape(shape), affine), mean_file)
+
+    nifti_file = None
+    if write_nifti:
+        nifti_file = to_nifti(out_path)
+    return out_path, nifti_file, mean_file
+
+
+# --------------------------------------------------------- NiPype wrapper
+
+def native_filter(in_file, mask_file, median, highpass_sigma, dtype):
+    # necessary for importing with NiPype
+    from masked.filters import filter_series
+    return filter_series(in_file, mask_file, median, highpass_sigma,
+                         dtype=dtype)
+
+
+import nipype.interfaces.utility as niu
+
+
+native_filter_interface = niu.Function(
+    input_names=['in_file', 'mask_file', 'median', 'highpass_sigma',
+                 'dtype'],
+    output_names=['masked_file', 'out_file', 'mean_file'],
+    function=native_filter,
+)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+""" Compact masked time series.
+
+Only the voxels inside the (dilated) functional mask matter after
+preprocessing, which is a small fraction of the 1 mm field of view. A
+masked series is a directory:
+
+    <name>.masked/index.npy    flat (C order) indices of the voxels in the
+                               mask, int64
+    <name>.masked/data.npy     (time x voxels) float32, or int16 scaled per
+                               voxel: value = data * slope + inter
+    <name>.masked/scale.npy    (2 x voxels) float32 slope and inter (int16)
+    <name>.masked/meta.json    shape, affine, dtype and TR
+
+The arrays are memory mapped, so reading a time window or a block of voxels
+only touches that part of the file. Convert from and to NIfTI with:
+
+    python -m masked.series from-nifti func.nii.gz mask.nii.gz func.masked
+    python -m masked.series to-nifti func.masked func.nii.gz
+    python -m masked.series info func.masked
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+
+SUFFIX = '.masked'
+DTYPES = ['float32', 'int16']
+
+
+def is_masked(path):
+    """ Whether `path` is a masked series (rather than e.g. a NIfTI file).
+    """
+    return os.path.isfile(os.path.join(str(path), 'meta.json'))
+
+
+def series_path(in_file, out_dir=None, suffix=''):
+    """ <out_dir>/<basename of in_file without extension><suffix>.masked
+    """
+    base = os.path.basename(in_file)
+    for ext in ('.nii.gz', '.nii', SUFFIX):
+        if base.endswith(ext):
+            base = base[:-len(ext)]
+            break
+    if out_dir is None:
+        out_dir = os.getcwd()
+    return os.path.abspath(os.path.join(out_dir, base + suffix + SUFFIX))
+
+
+class MaskedSeries(object):
+    def __init__(self, path, mode='r'):
+        self.path = os.path.abspath(path)
+        with open(os.path.join(self.path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.shape = tuple(meta['shape'])
+        self.affine = np.array(meta['affine'])
+        self.dtype = meta['dtype']
+        self.tr = meta.get('tr')
+        self.index = np.load(os.path.join(self.path, 'index.npy'),
+                             mmap_mode='r')
+        self.data = np.load(os.path.join(self.path, 'data.npy'),
+                            mmap_mode=mode)
+        self.slope = self.inter = None
+        if self.dtype == 'int16':
+            self.slope, self.inter = np.load(
+                os.path.join(self.path, 'scale.npy'))
+
+    @property
+    def nvols(self):
+        return self.data.shape[0]
+
+    def values(self, start=None, stop=None, voxels=None):
+        """ float32 (time x voxels) values of volumes start:stop, of all
+        voxels or the columns `voxels` (slice or indices).
+        """
+        if voxels is None:
+            voxels = slice(None)
+        out = np.array(self.data[start:stop, voxels], dtype=np.float32)
+        if self.slope is not None:
+            out *= self.slope[voxels]
+            out += self.inter[voxels]
+        return out
+
+    def volume(self, values):
+        """ 3D (or 4D for time x voxels) volume with `values` at the mask.
+        """
+        values = np.asarray(values)
+        n = int(np.prod(self.shape))
+        if values.ndim == 1:
+            out = np.zeros(n, dtype=values.dtype)
+            out[self.index] = values
+            return out.reshape(self.shape)
+        out = np.zeros((n, values.shape[0]), dtype=values.dtype)
+        out[self.index] = values.T
+        return out.reshape(self.shape + (-1,))
+
+
+def load_series(path):
+    return MaskedSeries(path)
+
+
+def _quantize(values):
+    """ int16 data and (2 x voxels) slope, inter of (time x voxels) values.
+    """
+    lo = values.min(axis=0)
+    hi = values.max(axis=0)
+    inter = (hi + lo) / 2.
+    slope = (hi - lo) / (2 * 32767.)
+    slope[slope == 0] = 1.
+    data = np.round((values - inter) / slope).astype(np.int16)
+    return data, np.stack([slope, inter]).astype(np.float32)
+
+
+def save_series(out_path, values, index, shape, affine, dtype='float32',
+                tr=None):
+    """ Write (time x voxels) `values` at the flat `index` of a 3D volume
+    with `shape` as a masked series. Returns out_path.
+    """
+    assert dtype in DTYPES, 'Unknown dtype %s' % dtype
+    out_path = os.path.abspath(out_path)
+    values = np.asarray(values, dtype=np.float32).reshape(-1, len(index))
+
+    tmp = out_path + '.tmp'
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, 'index.npy'),
+            np.asarray(index, dtype=np.int64))
+    if dtype == 'int16':
+        data, scale = _quantize(values)
+        np.save(os.path.join(tmp, 'data.npy'), data)
+        np.save(os.path.join(tmp, 'scale.npy'), scale)
+    else:
+        np.save(os.path.join(tmp, 'data.npy'), values)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(dict(shape=[int(n) for n in shape[:3]],
+                       affine=np.asarray(affine).tolist(),
+                       dtype=dtype, tr=tr), f)
+
+    if os.path.isdir(out_path):
+        shutil.rmtree(out_path)
+    os.rename(tmp, out_path)
+    return out_path
+
+
+def mask_index(mask_file, shape=None):
+    """ Flat indices of the voxels > 0 in mask_file (all voxels if None).
+    """
+    import nibabel as nib
+    if mask_file is None:
+        return np.arange(int(np.prod(shape)))
+    mask = np.asanyarray(nib.load(mask_file).dataobj) > 0
+    if shape is not None:
+        assert mask.shape[:3] == tuple(shape[:3]), \
+            'Mask %s does not match shape %s' % (mask_file, shape)
+    return np.flatnonzero(mask)
+
+
+def from_nifti(in_file, mask_file, out_path=None, dtype='float32',
+               block_size=32):
+    """ Masked series of the 3D/4D NIfTI in_file inside mask_file, read
+    `block_size` volumes at a time. Returns the path of the series.
+    """
+    import nibabel as nib
+
+    img = nib.load(in_file)
+    shape = img.shape[:3]
+    index = mask_index(mask_file, shape)
+    if out_path is None:
+        out_path = series_path(in_file)
+
+    values = read_masked(in_file, index, block_size=block_size)
+
+    tr = None
+    if len(img.shape) > 3:
+        tr = float(img.header.get_zooms()[3])
+    return save_series(out_path, values, index, shape, img.affine, dtype, tr)
+
+
+def to_nifti(in_path, out_file=None):
+    """ NIfTI (float32) of a masked series, zero outside the mask.
+    """
+    import nibabel as nib
+
+    series = load_series(in_path)
+    if out_file is None:
+        out_file = series_path(in_path)[:-len(SUFFIX)] + '.nii.gz'
+    values = series.values()
+    data = series.volume(values[0] if series.nvols == 1 else values)
+    img = nib.Nifti1Image(data, series.affine)
+    if series.tr is not None and data.ndim == 4:
+        img.header.set_zooms(img.header.get_zooms()[:3] + (series.tr,))
+    nib.save(img, out_file)
+    return os.path.abspath(out_file)
+
+
+def read_masked(in_file, index=None, start=None, stop=None, block_size=32):
+    """ (time x voxels) float32 values of a masked series or NIfTI file at
+    the flat `index` (all voxels of the mask or volume if None). Voxels of
+    `index` outside the mask of a masked series are 0. NIfTI files are
+    read `block_size` volumes at a time.
+    """
+    import nibabel as nib
+
+    if is_masked(in_file):
+        series = load_series(in_file)
+        if index is None or np.array_equal(series.index, index):
+            return series.values(start, stop)
+        nvols = len(range(series.nvols)[start:stop])
+        out = np.zeros((nvols, len(index)), dtype=np.float32)
+        pos = np.searchsorted(series.index, index)
+        pos = np.minimum(pos, len(series.index) - 1)
+        found = series.index[pos] == index
+        out[:, found] = series.values(start, stop, pos[found])
+        return out
+
+    img = nib.load(in_file)
+    if index is None:
+        index = np.arange(int(np.prod(img.shape[:3])))
+    if len(img.shape) == 3:
+        volume = np.asanyarray(img.dataobj).reshape(-1)
+        return np.asarray(volume[index], dtype=np.float32)[None]
+
+    # read a few volumes at a time, keeping only the voxels of `index`
+    volumes = range(img.shape[3])[start:stop]
+    out = np.empty((len(volumes), len(index)), dtype=np.float32)
+    for i in range(0, len(volumes), block_size):
+        block = volumes[i:i + block_size]
+        data = np.asanyarray(img.dataobj[..., block.start:block.stop])
+        out[i:i + len(block)] = data.reshape(-1, len(block))[index].T
+    return out
+
+
+def geometry(in_file):
+    """ (shape, affine) of a masked series or NIfTI file.
+    """
+    import nibabel as nib
+    if is_masked(in_file):
+        series = load_series(in_file)
+        return series.shape, series.affine
+    img = nib.load(in_file)
+    return img.shape[:3], img.affine
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Convert between NIfTI and masked time series.')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('from-nifti')
+    p.add_argument('in_file')
+    p.add_argument('mask_file')
+    p.add_argument('out_path', nargs='?')
+    p.add_argument('--dtype', choices=DTYPES, default='float32')
+    p = sub.add_parser('to-nifti')
+    p.add_argument('in_path')
+    p.add_argument('out_file', nargs='?')
+    p = sub.add_parser('info')
+    p.add_argument('in_path')
+    args = parser.parse_args()
+
+    if args.command == 'from-nifti':
+        print(from_nifti(args.in_file, args.mask_file, args.out_path,
+                         args.dtype))
+    elif args.command == 'to-nifti':
+        print(to_nifti(args.in_path, args.out_file))
+    elif args.command == 'info':
+        series = load_series(args.in_path)
+        n = int(np.prod(series.shape))
+        size = sum(os.path.getsize(os.path.join(series.path, f))
+                   for f in os.listdir(series.path))
+        print('%s: %d volumes, %d of %d voxels (%.1f%%), %s, %.1f MB' % (
+            series.path, series.nvols, len(series.index), n,
+            100. * len(series.index) / n, series.dtype, size / 1024. ** 2))
+    else:
+        parser.print_help()
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+
+""" Run chains of fslmaths nodes as one fslmaths command.
+
+A node of ImageMaths, BinaryMaths, ApplyMask, ErodeImage, ... reads the
+whole (4D) image, applies its operation and writes it again, and the next
+fslmaths node reads it back, e.g. highpass -> addmean of featpreproc or
+dilmask -> erode of skull_strip_functionals. fslmaths applies any number
+of operations in the order they are given,
+
+    fslmaths in -bptf 25.0 -1 -add mean in_gms_tempfilt_add
+
+so fuse(workflow) (the --fuse option of preprocessing_workflow.py and
+skull_strip_functionals.py) replaces every linear chain of such nodes by a
+FusedMaths node running the operations of all of them, without the
+intermediate images. Two nodes are chained when the out_file of the first is the in_file
+of the second and is not used anywhere else, both are Nodes (or MapNodes
+iterating over in_file) and neither changes the geometry (-Tmean, ...).
+The fused node has the name of the last node of the chain and writes the
+same file, so the connections, DataSink substitutions and the rest of the
+workflow do not change. The other inputs of stage i of the chain are
+inputs s<i>_<name> of the fused node.
+
+As all operations now run in one process, the intermediate images are no
+longer rounded to the datatype of the input (fslmaths calculates in float);
+-dt of the first node and -odt of the last one are kept.
+
+Every fused node reports the (uncompressed) bytes that were not written and
+read again (runtime.bytes_avoided of its result), and at exit the totals
+are reported per chain.
+"""
+
+import atexit
+import glob
+import importlib
+import os
+import re
+from collections import OrderedDict
+
+import nipype.interfaces.fsl as fsl
+from nipype.interfaces.base import (DynamicTraitedSpec, File, TraitedSpec,
+                                    isdefined, traits)
+from nipype.interfaces.fsl.base import FSLCommand, FSLCommandInputSpec
+import nipype.interfaces.fsl.maths as maths
+from nipype.interfaces.fsl.maths import MathsCommand
+
+
+# operations that change the geometry of the image
+GEOMETRY_CLASSES = (maths.MeanImage, maths.MaxImage, maths.MinImage,
+                    maths.MedianImage, maths.StdImage, maths.PercentileImage,
+                    maths.AR1Image, maths.MaxnImage)
+_geometry_op_re = re.compile(r'-[TXYZ](mean|std|max|maxn|min|median|perc|ar1)'
+                             r'\b|-roi\b|-subsamp2')
+
+# inputs of a stage that the fused command sets itself
+STAGE_SKIP = ['in_file', 'out_file', 'internal_datatype', 'output_datatype',
+              'out_data_type', 'suffix', 'args', 'environ', 'output_type']
+
+
+def _stage_suffix(interface):
+    """ Suffix the interface adds to the name of its output.
+    """
+    if isinstance(interface, fsl.ImageMaths):
+        suffix = interface.inputs.suffix
+        return suffix if isdefined(suffix) else '_maths'
+    if isinstance(interface, (fsl.UnaryMaths, fsl.BinaryMaths)):
+        return '_' + interface.inputs.operation
+    return interface._suffix
+
+
+def image_bytes(path):
+    """ Size of the data of an image in memory (as fslmaths writes it,
+    uncompressed).
+    """
+    import nibabel as nb
+    import numpy as np
+
+    img = nb.load(path)
+    return int(np.prod(img.shape)) * img.get_data_dtype().itemsize
+
+
+class FusedMathsInputSpec(DynamicTraitedSpec, FSLCommandInputSpec):
+    in_file = File(exists=True, mandatory=True, argstr='%s', position=2,
+                   desc='image the first stage operates on')
+    stages = traits.List(
+        traits.Tuple(traits.Str, traits.Str, traits.Dict), mandatory=True,
+        desc='(module, class, static inputs) of the interface of every stage')
+    out_file = File(genfile=True, argstr='%s', position=-2, hash_files=False,
+                    desc='image to write')
+
+
+class FusedMathsOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='image written after all stages')
+
+
+class FusedMaths(FSLCommand):
+    """ The operations of a chain of fslmaths interfaces in one fslmaths
+    command (see fuse()).
+    """
+    _cmd = 'fslmaths'
+    input_spec = FusedMathsInputSpec
+    output_spec = FusedMathsOutputSpec
+
+    def __init__(self, stage_fields=None, **inputs):
+        stage_fields = stage_fields or []
+        dynamic = dict((k, inputs.pop(k)) for k in list(inputs)
+                       if k in stage_fields)
+        super(FusedMaths, self).__init__(**inputs)
+        for name in stage_fields:
+            self.inputs.add_trait(name, traits.Any)
+        self.inputs.trait_set(trait_change_notify=False, **dynamic)
+
+    def _stage_interfaces(self):
+        """ The interfaces of the stages, with their static and connected
+        inputs.
+        """
+        out = []
+        dynamic = self.inputs.get()
+        for i, (module, name, static) in enumerate(self.inputs.stages):
+            interface = getattr(importlib.import_module(module), name)(
+                **static)
+            prefix = 's%d_' % i
+            for field, value in dynamic.items():
+                if field.startswith(prefix) and isdefined(value):
+                    setattr(interface.inputs, field[len(prefix):], value)
+            out.append(interface)
+        return out
+
+    def _parse_inputs(self, skip=None):
+        stages = self._stage_interfaces()
+        args = []
+        internal = getattr(stages[0].inputs, 'internal_datatype', None)
+        if isdefined(internal) and internal is not None:
+            args.append('-dt %s' % internal)
+        args.append(self.inputs.in_file)
+        for interface in stages:
+            # ImageMaths._parse_inputs ignores skip
+            args.extend(FSLCommand._parse_inputs(interface, skip=STAGE_SKIP))
+        args.append(self._list_outputs(stages)['out_file'])
+        last = stages[-1].inputs
+        for field in ('output_datatype', 'out_data_type'):
+            odt = getattr(last, field, None)
+            if odt is not None and isdefined(odt):
+                args.append('-odt %s' % odt)
+        return args
+
+    def _run_interface(self, runtime):
+        runtime = super(FusedMaths, self)._run_interface(runtime)
+        n_stages = len(self.inputs.stages)
+        try:
+            # every intermediate image is written and read once
+            runtime.bytes_avoided = \
+                2 * (n_stages - 1) * image_bytes(self.inputs.in_file)
+        except Exception:
+            runtime.bytes_avoided = 0
+        runtime.stdout = (runtime.stdout or '') + (
+            '\nfused %d fslmaths stages: %.1f MB of intermediate I/O avoided'
+            % (n_stages, runtime.bytes_avoided / 1024. ** 2))
+        return runtime
+
+    def _list_outputs(self, stages=None):
+        outputs = self.output_spec().get()
+        outputs['out_file'] = self.inputs.out_file
+        if not isdefined(outputs['out_file']):
+            suffix = ''.join(_stage_suffix(interface) for interface in
+                             (stages or self._stage_interfaces()))
+            outputs['out_file'] = self._gen_fname(self.inputs.in_file,
+                                                  suffix=suffix)
+        outputs['out_file'] = os.path.abspath(outputs['out_file'])
+        return outputs
+
+    def _gen_filename(self, name):
+        if name == 'out_file':
+            return self._list_outputs()['out_file']
+        return None
+
+
+# --------------------------------------------------------- Workflow pass
+
+def _defined(node, name):
+    if name not in node.inputs.trait_names():
+        return False
+    return isdefined(getattr(node.inputs, name))
+
+
+def fusable(node):
+    """ Whether node runs a single fslmaths operation that keeps the
+    geometry of the image.
+    """
+    from nipype.pipeline.engine import MapNode, Node
+
+    if type(node) not in (Node, MapNode) or \
+            getattr(node, 'iterables', None) or \
+            getattr(node, 'itersource', None):
+        return False
+    interface = node.interface
+    if not isinstance(interface, (fsl.ImageMaths, MathsCommand)) or \
+            isinstance(interface, GEOMETRY_CLASSES) or \
+            _defined(node, 'args'):
+        return False
+    if isinstance(interface, fsl.ImageMaths) and \
+            _defined(node, 'op_string') and \
+            _geometry_op_re.search(node.inputs.op_string):
+        return False
+    if isinstance(node, MapNode) and 'in_file' not in node.iterfield:
+        return False
+    return True
+
+
+def _next_stage(graph, node, pinned):
+    """ The node that node can be fused into, or None.
+    """
+    out_edges = list(graph.out_edges(node, data=True))
+    if len(out_edges) != 1:
+        return None
+    _, target, data = out_edges[0]
+    if data.get('connect') != [('out_file', 'in_file')] or \
+            target in pinned or not fusable(target) or \
+            type(target) is not type(node) or \
+            _defined(node, 'out_file') or \
+            _defined(node, 'output_datatype') or \
+            _defined(node, 'out_data_type') or \
+            _defined(target, 'internal_datatype'):
+        return None
+    return target
+
+
+def _pinned_nodes(workflow, pinned=None):
+    """ Nodes of subworkflows connected directly from outside of them
+    (e.g. 'featpreproc.highpass.out_file'), which can't be replaced.
+    """
+    from nipype.pipeline.engine import Workflow
+
+    pinned = set() if pinned is None else pinned
+    for source, target, data in workflow._graph.edges(data=True):
+        for source_field, target_field in data.get('connect', []):
+            if isinstance(source_field, tuple):
+                source_field = source_field[0]
+            for wf, field in ((source, source_field),
+                              (target, target_field)):
+                if isinstance(wf, Workflow) and '.' in field:
+                    pinned.add(wf.get_node(field.rsplit('.', 1)[0]))
+    for node in workflow._graph.nodes():
+        if isinstance(node, Workflow):
+            _pinned_nodes(node, pinned)
+    return pinned
+
+
+def _fuse_chain(workflow, chain):
+    from nipype.pipeline.engine import MapNode, Node
+
+    graph = workflow._graph
+    last = chain[-1]
+    stages, stage_fields, iterfield = [], [], ['in_file']
+    connections = []
+    for i, node in enumerate(chain):
+        static = dict((name, value) for name, value in
+                      node.inputs.get_traitsfree().items()
+                      if isdefined(value) and name not in
+                      ('in_file', 'out_file', 'environ', 'output_type'))
+        stages.append((type(node.interface).__module__,
+                       type(node.interface).__name__, static))
+        for source, _, data in graph.in_edges(node, data=True):
+            if i > 0 and source is chain[i - 1]:
+                continue
+            for source_field, field in data.get('connect', []):
+                name = 'in_file' if i == 0 and field == 'in_file' \
+                    else 's%d_%s' % (i, field)
+                if name != 'in_file':
+                    stage_fields.append(name)
+                if isinstance(node, MapNode) and field in node.iterfield \
+                        and name not in iterfield:
+                    iterfield.append(name)
+                connections.append((source, source_field, name))
+    out_connections = [(target, data.get('connect', [])) for _, target, data
+                       in graph.out_edges(last, data=True)]
+
+    interface = FusedMaths(stage_fields=stage_fields, stages=stages)
+    if _defined(chain[0], 'in_file'):
+        interface.inputs.in_file = chain[0].inputs.in_file
+    if _defined(last, 'out_file'):
+        interface.inputs.out_file = last.inputs.out_file
+    if _defined(last, 'output_type'):
+        interface.inputs.output_type = last.inputs.output_type
+    if isinstance(last, MapNode):
+        fused = MapNode(interface, iterfield=iterfield, name=last.name,
+                        serial=last._serial, nested=last.nested)
+    else:
+        fused = Node(interface, name=last.name)
+    for attr in ('plugin_args', 'overwrite', 'run_without_submitting'):
+        setattr(fused, attr, getattr(last, attr))
+
+    workflow.remove_nodes(chain)
+    workflow.add_nodes([fused])
+    for source, source_field, name in connections:
+        workflow.connect(source, source_field, fused, name)
+    for target, connect in out_connections:
+        workflow.connect([(fused, target, connect)])
+    return fused
+
+
+_fused = OrderedDict()   # workflow name -> [(base_dir, fused node name)]
+
+
+def fuse(workflow, report=True):
+    """ Replace the chains of fslmaths nodes of workflow and its
+    subworkflows by FusedMaths nodes (in place). Returns {'workflow.node':
+    [names of the fused nodes]}.
+    """
+    import networkx as nx
+    from nipype.pipeline.engine import Workflow
+
+    pinned = _pinned_nodes(workflow)
+    chains = OrderedDict()
+
+    def fuse_workflow(wf, hierarchy):
+        graph = wf._graph
+        next_stage = dict()
+        for node in graph.nodes():
+            if not isinstance(node, Workflow) and node not in pinned and \
+                    fusable(node):
+                target = _next_stage(graph, node, pinned)
+                if target is not None:
+                    next_stage[node] = target
+        heads = set(next_stage) - set(next_stage.values())
+        for node in list(nx.topological_sort(graph)):
+            if isinstance(node, Workflow):
+                fuse_workflow(node, hierarchy + [node.name])
+            elif node in heads:
+                chain = [node]
+                while chain[-1] in next_stage:
+                    chain.append(next_stage[chain[-1]])
+                _fuse_chain(wf, chain)
+                chains['.'.join(hierarchy + [chain[-1].name])] = \
+                    [n.name for n in chain]
+
+    fuse_workflow(workflow, [workflow.name])
+    if report:
+        print('maths fusion: %d chains, %d fslmaths nodes fused' % (
+            len(chains), sum(len(c) for c in chains.values())))
+        for name, chain in chains.items():
+            print('  %-50s %s' % (name, ' -> '.join(chain)))
+        if chains and workflow.name not in _fused:
+            pid = os.getpid()
+            atexit.register(lambda: os.getpid() == pid and
+                            print_report(workflow.base_dir or os.getcwd(),
+                                         workflow.name, chains))
+    _fused[workflow.name] = chains
+    return chains
+
+
+def bytes_avoided(base_dir, workflow_name, node_name):
+    """ ([bytes avoided], number of results) of the results of the fused
+    node node_name (in every iteration) in the working directory.
+    """
+    from nipype.utils.filemanip import loadpkl
+
+    pattern = os.path.join(base_dir, workflow_name, '**', node_name,
+                           'result_%s.pklz' % node_name)
+    total, n = 0, 0
+    for path in glob.glob(pattern, recursive=True):
+        try:
+            runtime = loadpkl(path).runtime
+        except Exception:
+            continue
+        # a list for MapNodes
+        for r in (runtime if isinstance(runtime, list) else [runtime]):
+            value = getattr(r, 'bytes_avoided', None)
+            if value is not None:
+                total += value
+                n += 1
+    return total, n
+
+
+def print_report(base_dir, workflow_name, chains):
+    print('maths fusion: intermediate I/O avoided per chain')
+    for name, chain in chains.items():
+        total, n = bytes_avoided(base_dir, workflow_name, chain[-1])
+        print('  %-50s %5d runs %10.1f MB' % (name, n, total / 1024. ** 2))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Report the I/O avoided by the fused fslmaths nodes of '
+                    'a working directory.')
+    parser.add_argument('base_dir', help='e.g. workingdirs')
+    parser.add_argument('workflow', help='e.g. level1flow')
+    parser.add_argument('nodes', nargs='+', help='e.g. addmean')
+    args = parser.parse_args()
+
+    print_report(args.base_dir, args.workflow,
+                 OrderedDict((n, [n]) for n in args.nodes))
@@ -17,24 +17,65 @@ from builtins import str
 from builtins import range
 
 import os                                     # system functions
-import nipype.interfaces.io as nio            # Data i/o
 import nipype.interfaces.fsl as fsl           # fsl
 from nipype.interfaces import utility as niu  # Utilities
 import nipype.pipeline.engine as pe           # pypeline engine
-import nipype.algorithms.modelgen as model    # model generation
-import nipype.algorithms.rapidart as ra       # artifact detection
+from nhp_bids import lazy_import, write_graph
+model = lazy_import('nipype.algorithms.modelgen')  # model generation
+ra = lazy_import('nipype.algorithms.rapidart')     # artifact detection
 
 import nipype.workflows.fmri.fsl as fslflows
+import glm
+from bids_index import IndexedSelectFiles
+from link_datasink import LinkDataSink
 
 import preprocessing_workflow as preproc
-from filter_numbers import FilterNumsTask
+from filter_numbers import scrubbing_interface
 
 from nipype import config, logging
 
 ds_root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 data_dir = ds_root
 
-def create_workflow(contrasts, combine_runs=True):
+def create_workflow(contrasts, combine_runs=True, glm_method='film',
+                    design_method='feat', fixedfx_method='flameo',
+                    merge_outliers=0,
+                    container='derivatives/modelfit',
+                    fx_store=True, fx_res4d=True, use_masked=False,
+                    roi_masks=None, roi_mode='mean',
+                    roi_cache_dir=os.path.join(ds_root, 'derivatives',
+                                               'roi-cache'),
+                    glm_store_dir=os.path.join(ds_root, 'derivatives',
+                                               'glm-store')):
+    """ glm_method is 'film' (FSL's FILMGLS) or 'native' (see glm/fit.py).
+    The native GLM keeps its fits in glm_store_dir (if set), so a rerun with
+    other contrasts only computes the contrasts.
+
+    design_method is 'feat' (SpecifyModel, Level1Design and FEATModel) or
+    'native' (see glm/design.py), which requires the native GLM. The native
+    design also replaces beh_roi's truncated copies of the runs by a lazy
+    time window (see glm/window.py).
+
+    fixedfx_method is 'flameo' (fslmerge + flameo per contrast) or 'native'
+    (see glm/fixedfx.py). With fx_store, the native fixed effects keep
+    running sums per session in <container>/fx-store/<sub>_<ses> (of the
+    name of the first run, see glm/fxstore.py), so adding a run to the CSV
+    only reads the new run. Without fx_res4d the native fixed effects skip
+    the residuals, which need the contributions of all runs.
+
+    With use_masked (and the native design), the native GLM reads the masked
+    series written by `preprocessing_workflow.py --filters native` instead
+    of the NIfTI runs, where available (see masked/series.py).
+
+    With roi_masks (ROI masks or label images), only the ROIs are fitted,
+    on their mean time course or their voxels (roi_mode 'mean' or 'voxels'),
+    and per-ROI beta and contrast tables are written instead of images
+    (see glm/roi.py). The ROI time courses of every run are cached in
+    roi_cache_dir. This requires the native design.
+
+    Outlier volumes at most merge_outliers apart share a scrubbing regressor
+    (0: one regressor per outlier, see filter_numbers.py).
+    """
 
     level1_workflow = pe.Workflow(name='level1flow')
     # ===================================================================
@@ -132,12 +173,29 @@ def create_workflow(contrasts, combine_runs=True):
 
     fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
 
-    modelfit = fslflows.create_modelfit_workflow()
-
-    if combine_runs:
-        fixed_fx = fslflows.create_fixed_effects_flow()
+    if glm_method == 'native':
+        modelfit = glm.create_modelfit_workflow(store_dir=glm_store_dir,
+                                                design=design_method)
     else:
+        assert glm_method == 'film', 'Unknown glm_method %s' % glm_method
+        assert design_method == 'feat', \
+            'The native design requires the native GLM'
+        modelfit = fslflows.create_modelfit_workflow()
+
+    if roi_masks:
+        assert design_method == 'native', \
+            'The ROI mode requires the native design'
+
+    if not combine_runs or roi_masks:
         fixed_fx = None
+    elif fixedfx_method == 'native':
+        fixed_fx = glm.create_fixed_effects_flow(
+            store_dir=os.path.join(ds_root, container, 'fx-store')
+            if fx_store else None, res4d=fx_res4d)
+    else:
+        assert fixedfx_method == 'flameo', \
+            'Unknown fixedfx_method %s' % fixedfx_method
+        fixed_fx = fslflows.create_fixed_effects_flow()
 
     """
     Artifact detection is done in preprocessing workflow.
@@ -176,7 +234,27 @@ def create_workflow(contrasts, combine_runs=True):
     def num_copes(files):
         return len(files)
 
-    if fixed_fx is not None:
+    def session_name(funcs):
+        import os
+        import re
+        if isinstance(funcs, str):
+            funcs = [funcs]
+        match = re.search(r'(sub-[a-zA-Z0-9]+)_(ses-[a-zA-Z0-9]+)_',
+                          os.path.basename(funcs[0]))
+        return '_'.join(match.groups()) if match else None
+
+    if fixed_fx is not None and fixedfx_method == 'native':
+        level1_workflow.connect([
+            (inputnode, fixed_fx,
+             [('ref_funcmask', 'inputspec.mask_file'),
+              (('funcs', session_name), 'inputspec.session')]),
+            (modelfit, fixed_fx,
+            [(('outputspec.copes', sort_copes), 'inputspec.copes'),
+            ('outputspec.dof_file', 'inputspec.dof_files'),
+            (('outputspec.varcopes', sort_copes), 'inputspec.varcopes'),
+            ])
+        ])
+    elif fixed_fx is not None:
         level1_workflow.connect([
             (inputnode, fixed_fx,
              [('ref_funcmask', 'flameo.mask_file')]),  # To-do: use reference mask!!!
@@ -195,9 +273,9 @@ def create_workflow(contrasts, combine_runs=True):
     # -------------------------------------------------------------------
     # Datasink
 
-    outputfiles = pe.Node(nio.DataSink(
+    outputfiles = pe.Node(LinkDataSink(
         base_directory=ds_root,
-        container='derivatives/modelfit',
+        container=container,
         parameterization=True),
         name="output_files")
 
@@ -229,13 +307,14 @@ def create_workflow(contrasts, combine_runs=True):
         # (r'/_undistort_masks[0-9]+/', r'/func/'),
         # (r'/_undistort[0-9]+/', r'/func/'),
     ]
-    level1_workflow.connect([
-        (modelfit, outputfiles,
-         [(('outputspec.copes', sort_copes), 'copes'),
-          ('outputspec.dof_file', 'dof_files'),
-          (('outputspec.varcopes', sort_copes), 'varcopes'),
-          ]),
-    ])
+    if not roi_masks:
+        level1_workflow.connect([
+            (modelfit, outputfiles,
+             [(('outputspec.copes', sort_copes), 'copes'),
+              ('outputspec.dof_file', 'dof_files'),
+              (('outputspec.varcopes', sort_copes), 'varcopes'),
+              ]),
+        ])
     if fixed_fx is not None:
         level1_workflow.connect([
             (fixed_fx, outputfiles,
@@ -262,7 +341,7 @@ def create_workflow(contrasts, combine_runs=True):
     iterables on this node to perform two different extents of smoothing.
     """
 
-    featinput = level1_workflow.get_node('modelfit.inputspec')
+    featinput = modelfit.get_node('inputspec')
     # featinput.iterables = ('fwhm', [5., 10.])
     featinput.inputs.fwhm = 2.0
 
@@ -283,10 +362,11 @@ def create_workflow(contrasts, combine_runs=True):
     """
 
     # from timeevents.curvetracing import calc_curvetracing_events
-    from timeevents import process_time_events
+    from timeevents import process_time_events_handles
 
+    # out_events are handles of the events of every run (see artifacts.py)
     timeevents = pe.MapNode(
-        interface=process_time_events,  # calc_curvetracing_events,
+        interface=process_time_events_handles,  # calc_curvetracing_events,
         iterfield=('event_log', 'in_nvols', 'TR'),
         name='timeevents')
 
@@ -298,10 +378,10 @@ def create_workflow(contrasts, combine_runs=True):
             funcs = [funcs]
 
         for func in funcs:
+            # the shape comes from the header, the data is not read
             func_img = nib.load(func)
-            header = func_img.header
             try:
-                nvols.append(func_img.get_data().shape[3])
+                nvols.append(func_img.shape[3])
             except IndexError as e:
                 # if shape only has 3 dimensions, then it is only 1 volume
                 nvols.append(1)
@@ -329,6 +409,22 @@ def create_workflow(contrasts, combine_runs=True):
             TRs.append(TR)
         return(TRs)
 
+    def masked_funcs(funcs):
+        # the masked series written next to highpassed_files by
+        # preprocessing_workflow.py --filters native, if it exists
+        from masked.series import is_masked
+
+        if isinstance(funcs, str):
+            funcs = [funcs]
+
+        out = []
+        for func in funcs:
+            series = func.replace(
+                '/highpassed_files/', '/highpassed_masked/').replace(
+                '.nii.gz', '.masked')
+            out.append(series if is_masked(series) else func)
+        return out
+
     level1_workflow.connect([
         (inputnode, timeevents,
          [(('funcs', get_nvols), 'in_nvols'),
@@ -336,50 +432,41 @@ def create_workflow(contrasts, combine_runs=True):
           ]),
         (input_events, timeevents,
          [('out_files', 'event_log')]),
-        (inputnode, modelspec,
-         [('motion_parameters', 'realignment_parameters')]),
-        (modelspec, modelfit,
-         [('session_info', 'inputspec.session_info')]),
     ])
 
-    # Ignore volumes after last good response
-    filter_outliers = pe.MapNode(
-        interface=FilterNumsTask(),
-        name='filter_outliers',
-        iterfield=('in_file','max_number')
+    # Ignore volumes after last good response, and turn the remaining
+    # outliers of all runs into scrubbing regressors
+    scrubbing = pe.Node(
+        interface=scrubbing_interface,
+        name='scrubbing',
     )
+    scrubbing.inputs.merge_adjacent = merge_outliers
 
     level1_workflow.connect([
-        (inputnode, filter_outliers,
-         [('motion_outlier_files', 'in_file')]),
-        (filter_outliers, modelspec,
-         [('out_file', 'outlier_files')]),
-        (timeevents, filter_outliers,
-         [('out_nvols', 'max_number')]),
+        (inputnode, scrubbing,
+         [('motion_outlier_files', 'in_files'),
+          ('motion_parameters', 'motion_parameters'),
+          ]),
+        (timeevents, scrubbing,
+         [('out_nvols', 'max_numbers')]),
     ])
 
     def evt_info(cond_events):
+        from artifacts import load_events
+        from nipype.interfaces.base import Bunch
         output = []
 
         # for each run
         for ev in cond_events:
-            from nipype.interfaces.base import Bunch
-            from copy import deepcopy
-            names = []
-
-            for name in ev.keys():
-                if ev[name].shape[0] > 0:
-                    names.append(name)
-
-            onsets = [deepcopy(ev[name].time) if ev[name].shape[0] > 0 else [] for name in names]
-            durations = [deepcopy(ev[name].dur) if ev[name].shape[0] > 0 else [] for name in names]
-            amplitudes = [deepcopy(ev[name].amplitude) if ev[name].shape[0] > 0 else [] for name in names]
+            # loading the handle gives fresh arrays, which need no deepcopy
+            ev = load_events(ev)
+            names = [name for name in ev.keys() if len(ev[name]['time']) > 0]
 
             run_results = Bunch(
                 conditions=names,
-                onsets=[deepcopy(ev[name].time) for name in names],
-                durations=[deepcopy(ev[name].dur) for name in names],
-                amplitudes=[deepcopy(ev[name].amplitude) for name in names])
+                onsets=[ev[name]['time'].tolist() for name in names],
+                durations=[ev[name]['dur'].tolist() for name in names],
+                amplitudes=[ev[name]['amplitude'].tolist() for name in names])
 
             output.append(run_results)
         return output
@@ -398,6 +485,97 @@ def create_workflow(contrasts, combine_runs=True):
     modelfit.config['execution'] = dict(
         crashdump_dir=os.path.abspath('.'))
 
+    if design_method == 'native':
+        from glm.design import build_design_interface
+        from glm.window import window_report_interface
+
+        design = pe.Node(interface=build_design_interface, name='design')
+        design.inputs.contrasts = contrasts
+        design.inputs.highpass_cutoff = hpcutoff_s
+        functional_data = ('funcs', masked_funcs) if use_masked else 'funcs'
+
+        # Ignore volumes after subject has finished working for the run,
+        # by only reading the first out_nvols volumes of each run (instead
+        # of writing truncated copies with beh_roi)
+        window_report = pe.Node(interface=window_report_interface,
+                                name='window_report')
+
+        level1_workflow.connect([
+            (timeevents, design,
+             [('out_events', 'cond_events'),
+              ('out_nvols', 'nvols'),
+              ]),
+            (inputnode, design,
+             [(('funcs', get_TR), 'TR'),
+              ('motion_parameters', 'motion_parameters'),
+              ]),
+            (scrubbing, design,
+             [('scrubbing_files', 'scrubbing_files')]),
+            (inputnode, window_report,
+             [('funcs', 'in_files'),
+              ]),
+            (timeevents, window_report,
+             [('out_nvols', 't_sizes'),
+              ]),
+            (window_report, outputfiles,
+             [('report_file', 'window_report'),
+              ]),
+        ])
+
+        if roi_masks:
+            # Quick preview: fit the ROIs only and write tables
+            from glm.roi import roi_glm_interface, roi_combine_interface
+
+            roi_glm = pe.MapNode(
+                interface=roi_glm_interface,
+                iterfield=['in_file', 'design_file', 'tcon_file', 't_size'],
+                name='roi_glm')
+            roi_glm.inputs.roi_files = [os.path.abspath(f)
+                                        for f in roi_masks]
+            roi_glm.inputs.mode = roi_mode
+            roi_glm.inputs.autocorr = 'ar1'
+            roi_glm.inputs.cache_dir = roi_cache_dir
+            roi_combine = pe.Node(interface=roi_combine_interface,
+                                  name='roi_combine')
+
+            level1_workflow.connect([
+                (design, roi_glm,
+                 [('design_files', 'design_file'),
+                  ('con_files', 'tcon_file'),
+                  ]),
+                (inputnode, roi_glm,
+                 [(functional_data, 'in_file'),
+                  ]),
+                (timeevents, roi_glm,
+                 [('out_nvols', 't_size'),
+                  ]),
+                (roi_glm, roi_combine,
+                 [('stats_file', 'stats_files'),
+                  ]),
+                (roi_glm, outputfiles,
+                 [('betas_file', 'roi.runs.@betas'),
+                  ('stats_file', 'roi.runs.@stats'),
+                  ]),
+                (roi_combine, outputfiles,
+                 [('stats_file', 'roi'),
+                  ]),
+            ])
+            return(level1_workflow)
+
+        level1_workflow.connect([
+            (design, modelfit,
+             [('design_files', 'inputspec.design_files'),
+              ('con_files', 'inputspec.tcon_files'),
+              ]),
+            (inputnode, modelfit,
+             [(functional_data, 'inputspec.functional_data'),
+              ]),
+            (timeevents, modelfit,
+             [('out_nvols', 'inputspec.functional_nvols'),
+              ]),
+        ])
+        return(level1_workflow)
+
     # Ignore volumes after subject has finished working for the run
     beh_roi = pe.MapNode(
         fsl.ExtractROI(t_min=0),
@@ -405,24 +583,28 @@ def create_workflow(contrasts, combine_runs=True):
         iterfield=['in_file', 't_size'])
 
     level1_workflow.connect([
-        (timeevents, modelspec,
-         [(('out_events', evt_info), 'subject_info'),
-          ]),
         (inputnode, beh_roi,
          [('funcs', 'in_file'),
           ]),
         (timeevents, beh_roi,
          [('out_nvols', 't_size'),
           ]),
-        (beh_roi, modelspec,
-         [('roi_file', 'functional_runs'),
-          ]),
         (beh_roi, modelfit,
          [('roi_file', 'inputspec.functional_data'),
           ]),
         (beh_roi, outputfiles,
          [('roi_file', 'roi_file'),
           ]),
+        (scrubbing, modelspec,
+         [('confound_files', 'realignment_parameters')]),
+        (timeevents, modelspec,
+         [(('out_events', evt_info), 'subject_info'),
+          ]),
+        (beh_roi, modelspec,
+         [('roi_file', 'functional_runs'),
+          ]),
+        (modelspec, modelfit,
+         [('session_info', 'inputspec.session_info')]),
         # (inputnode, datasource, [('in_data', 'base_directory')]),
         # (infosource, datasource, [('subject_id', 'subject_id')]),
         # (infosource, modelspec, [(('subject_id', subjectinfo), 'subject_info')]),
@@ -449,11 +631,35 @@ generate any output. To actually run the analysis on the data the
 ``nipype.pipeline.engine.Pipeline.Run`` function needs to be called.
 """
 
-def run_workflow(csv_file, use_pbs, contrasts_name, template):
-    workflow = pe.Workflow(name='run_level1flow')
+def run_workflow(csv_file, use_pbs, contrasts_name, template, **kwargs):
+    """ Run the level-1 workflow for one or more contrasts modules; kwargs
+    are passed on to create_workflow.
+
+    With several modules, the results of each go to
+    derivatives/modelfit/<module>, with the working directory
+    workingdirs/run_level1flow_<module>. With the native GLM, only the first
+    module fits the runs, the others compute their contrasts from the stored
+    fits.
+    """
+    if isinstance(contrasts_name, str):
+        contrasts_name = [contrasts_name]
+
+    for name in contrasts_name:
+        if len(contrasts_name) == 1:
+            run_contrasts(csv_file, use_pbs, name, template, **kwargs)
+        else:
+            run_contrasts(csv_file, use_pbs, name, template,
+                          container='derivatives/modelfit/' + name,
+                          workflow_name='run_level1flow_' + name, **kwargs)
+
+
+def run_contrasts(csv_file, use_pbs, contrasts_name, template,
+                  container='derivatives/modelfit',
+                  workflow_name='run_level1flow', hash_cache=False,
+                  **kwargs):
+    workflow = pe.Workflow(name=workflow_name)
     workflow.base_dir = os.path.abspath('./workingdirs')
 
-    from nipype import config, logging
     config.update_config(
         {'logging':
          {'log_directory': os.path.join(workflow.base_dir, 'logs'),
@@ -469,7 +675,6 @@ def run_workflow(csv_file, use_pbs, contrasts_name, template):
     workflow.stop_on_first_crash = True
     workflow.remove_unnecessary_outputs = False
     workflow.keep_inputs = True
-    workflow.hash_method = 'content'
 
     """
     Setup the contrast structure that needs to be evaluated. This is a list of
@@ -488,7 +693,7 @@ def run_workflow(csv_file, use_pbs, contrasts_name, template):
         raise RuntimeError('Unknown contrasts: %s. Must exist as a Python'
                            ' module in contrasts directory!' % contrasts_name)
 
-    modelfit = create_workflow(contrasts)
+    modelfit = create_workflow(contrasts, container=container, **kwargs)
 
     import bids_templates as bt
 
@@ -553,8 +758,8 @@ def run_workflow(csv_file, use_pbs, contrasts_name, template):
     }
 
     inputfiles = pe.Node(
-        nio.SelectFiles(templates,
-                        base_directory=data_dir),
+        IndexedSelectFiles(templates,
+                           base_directory=data_dir),
         name='in_files')
 
     workflow.connect([
@@ -615,16 +820,20 @@ def run_workflow(csv_file, use_pbs, contrasts_name, template):
 
     modelfit.inputs.inputspec.fwhm = 2.0
     modelfit.inputs.inputspec.highpass = 50
-    modelfit.write_graph(simple_form=True)
-    modelfit.write_graph(graph2use='orig', format='png', simple_form=True)
+    write_graph(modelfit, simple_form=True)
+    write_graph(modelfit, graph2use='orig', format='png', simple_form=True)
     # modelfit.write_graph(graph2use='detailed', format='png', simple_form=False)
 
     workflow.stop_on_first_crash = True
     workflow.keep_inputs = True
     workflow.remove_unnecessary_outputs = False
-    workflow.write_graph(simple_form=True)
-    workflow.write_graph(graph2use='colored', format='png', simple_form=True)
+    write_graph(workflow, simple_form=True)
+    write_graph(workflow, graph2use='colored', format='png', simple_form=True)
     # workflow.write_graph(graph2use='detailed', format='png', simple_form=False)
+    if hash_cache:
+        # hash the inputs by content, reading only the files that changed
+        import hashcache
+        hashcache.enable(workflow)
     if use_pbs:
         workflow.run(plugin='PBS', plugin_args={'template':
                                                 os.path.expanduser(template)})
@@ -640,10 +849,57 @@ if __name__ == '__main__':
     parser.add_argument('--csv', dest='csv_file', required=True,
                         help='CSV file with subjects, sessions, and runs.')
     parser.add_argument('--contrasts', dest='contrasts_name', required=True,
-                        help='Contrasts to use.')
+                        nargs='+',
+                        help='Contrasts to use (one or more modules).')
     parser.add_argument('--pbs', dest='use_pbs', action='store_true',
                         help='Whether to use pbs plugin.')
     parser.add_argument('--template', default='~/NHP-BIDS/pbs-template.sh',
                         help='PBS template')
+    parser.add_argument('--glm', dest='glm_method', default='film',
+                        choices=['film', 'native'],
+                        help='First-level GLM: FSL FILMGLS or the native '
+                             'vectorized GLM (glm/fit.py).')
+    parser.add_argument('--design', dest='design_method', default='feat',
+                        choices=['feat', 'native'],
+                        help='Design matrices: SpecifyModel/Level1Design/'
+                             'FEATModel or native (glm/design.py, requires '
+                             '--glm native).')
+    parser.add_argument('--fixedfx', dest='fixedfx_method', default='flameo',
+                        choices=['flameo', 'native'],
+                        help='Fixed effects over runs: flameo or native '
+                             '(glm/fixedfx.py).')
+    parser.add_argument('--no-fx-store', dest='fx_store',
+                        action='store_false',
+                        help='Recombine all runs with --fixedfx native '
+                             'instead of updating the running sums per '
+                             'session (glm/fxstore.py).')
+    parser.add_argument('--no-fx-res4d', dest='fx_res4d',
+                        action='store_false',
+                        help='With --fixedfx native, do not write the '
+                             'residuals over runs, which read every run.')
+    parser.add_argument('--roi-mask', dest='roi_masks', nargs='+',
+                        help='Only fit these ROI masks or label images and '
+                             'write per-ROI tables (glm/roi.py); requires '
+                             '--design native.')
+    parser.add_argument('--roi-mode', choices=['mean', 'voxels'],
+                        default='mean',
+                        help='Fit the mean time course of every ROI or all '
+                             'its voxels.')
+    parser.add_argument('--masked', dest='use_masked', action='store_true',
+                        help='With --design native, let the GLM read the '
+                             'masked series of preprocessing_workflow.py '
+                             '--filters native (masked/series.py).')
+    parser.add_argument('--hash-cache', action='store_true',
+                        help='Decide which nodes are cached by the content '
+                             'of their input files instead of their '
+                             'timestamps, looking up unchanged files in '
+                             'workingdirs/hashcache.sqlite (hashcache.py). '
+                             'Files are keyed by their stat, so a file '
+                             'rewritten within the mtime resolution of its '
+                             'filesystem (seconds on some NFS servers) is '
+                             'missed.')
+    parser.add_argument('--merge-outliers', type=int, default=0,
+                        help='Outliers at most this many volumes apart share '
+                             'a scrubbing regressor (0: one per outlier).')
     args = parser.parse_args()
     run_workflow(**vars(args))
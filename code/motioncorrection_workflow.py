@@ -7,18 +7,20 @@ import os                                    # system functions
 import nipype.interfaces.io as nio           # Data i/o
 import nipype.interfaces.utility as util     # utility
 import nipype.pipeline.engine as pe          # pypeline engine
-import nipype.algorithms.modelgen as model   # model generation
-import nipype.algorithms.rapidart as ra      # artifact detection
+from nhp_bids import lazy_import, write_graph
+model = lazy_import('nipype.algorithms.modelgen')  # model generation
+ra = lazy_import('nipype.algorithms.rapidart')     # artifact detection
 import nipype.interfaces.fsl as fsl          # fsl
-import nipype.interfaces.afni as afni        # afni
+afni = lazy_import('nipype.interfaces.afni')       # afni
 from nipype.interfaces.utility import IdentityInterface
 
 from nipype.pipeline.engine import Workflow, Node, MapNode
 
 from nipype import config
-config.enable_debug_mode()
 
 from mc.afni_allin_slices import AFNIAllinSlices
+from link_datasink import LinkDataSink
+import resultcache
 
 
 def create_workflow_fsl():
@@ -141,7 +143,9 @@ def create_workflow_allin_slices(name='motion_correction', iterfield=['in_file']
     #  * out_transform_matrix
 
 
-def run_workflow():
+def run_workflow(result_cache=False):
+    config.enable_debug_mode()
+
     # ------------------ Specify variables
     ds_root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 
@@ -195,7 +199,7 @@ def run_workflow():
 
     # ------------------ Output Files
     # Datasink
-    outputfiles = Node(nio.DataSink(
+    outputfiles = Node(LinkDataSink(
         base_directory=ds_root,
         container=output_dir,
         parameterization=True),
@@ -247,8 +251,21 @@ def run_workflow():
     workflow.stop_on_first_crash = True
     workflow.keep_inputs = True
     workflow.remove_unnecessary_outputs = False
-    workflow.write_graph()
+    write_graph(workflow)
+    if result_cache:
+        # outputs of identical commands are shared with the other workflows
+        resultcache.enable(workflow)
     workflow.run()
 
 if __name__ == '__main__':
-    run_workflow()
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Motion correction of the functionals with AFNI.')
+    parser.add_argument('--result-cache', action='store_true',
+                        help='Link the outputs of commands that already ran '
+                             'with the same inputs, in this or another '
+                             'workflow, instead of running them again '
+                             '(resultcache.py).')
+    args = parser.parse_args()
+
+    run_workflow(**vars(args))
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+""" Single entry point for the workflow scripts.
+
+    python nhp_bids.py <command> [arguments of the script]
+    python nhp_bids.py --write-graph preprocess --csv runs.csv --pbs
+    python nhp_bids.py --profile-startup modelfit --csv runs.csv \
+        --contrasts ctcheckerboard
+
+runs the script of <command> (see COMMANDS) as if it was started directly,
+e.g. `nhp_bids.py preprocess --csv runs.csv` is `preprocessing_workflow.py
+--csv runs.csv`.
+
+Starting a script should cost as little as possible before the workflow
+runs (on a PBS node every second counts). This module only imports the
+standard library, and provides the helpers used by the scripts for that:
+
+  lazy_import    a module that is only imported when one of its attributes
+                 is used (e.g. the interfaces of AFNI or rapidart that are
+                 imported but not used by most workflows)
+  fsl_version    fsl.Info.version(), probed once and kept in
+                 $NHP_FSL_VERSION for the processes started from here
+  write_graph    workflow.write_graph(), only with --write-graph or
+                 NHP_WRITE_GRAPH=1 (rendering with Graphviz is slow)
+
+With --gc, the working directory of the workflow is collected after it ran
+successfully (see workdir_gc.py).
+
+With --profile-startup, the time spent importing every module and building
+the graph (creating interfaces, nodes and connections, per calling module)
+is reported when the workflow would start running, and the script stops
+there.
+"""
+
+import importlib
+import os
+import runpy
+import sys
+import time
+import types
+from collections import OrderedDict
+
+
+code_dir = os.path.dirname(os.path.realpath(__file__))
+
+COMMANDS = OrderedDict([
+    ('minimal', 'bids_minimal_processing'),
+    ('resample', 'resample_isotropic_workflow'),
+    ('resample-t1', 'resample_t1_isotropic_workflow'),
+    ('fmap-mask', 'transform_manual_fmap_mask'),
+    ('undistort', 'undistort_workflow'),
+    ('skullstrip', 'skull_strip_functionals'),
+    ('manualmask', 'transform_manualmask'),
+    ('motioncorrection', 'motioncorrection_workflow'),
+    ('preprocess', 'preprocessing_workflow'),
+    ('modelfit', 'modelfit_workflow'),
+    ('gc', 'workdir_gc'),
+])
+
+
+class LazyModule(types.ModuleType):
+    """ Placeholder of a module that imports it on first attribute access.
+    """
+
+    def __init__(self, name):
+        super(LazyModule, self).__init__(name)
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self.__dict__['_module'] is None:
+            self.__dict__['_module'] = importlib.import_module(self.__name__)
+        return self.__dict__['_module']
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+
+def lazy_import(name):
+    """ Module `name`, imported when first used (or now if it already is).
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
+
+def fsl_version():
+    """ FSL version string (None without FSL), probed once per pipeline.
+    """
+    version = os.environ.get('NHP_FSL_VERSION')
+    if version is None:
+        import nipype.interfaces.fsl as fsl
+        version = fsl.Info.version() or ''
+        os.environ['NHP_FSL_VERSION'] = version
+    return version or None
+
+
+def write_graph(workflow, **kwargs):
+    """ workflow.write_graph(**kwargs) if graphs were asked for.
+    """
+    if os.environ.get('NHP_WRITE_GRAPH', '0') not in ('', '0'):
+        return workflow.write_graph(**kwargs)
+
+
+# --------------------------------------------------------- Startup profile
+
+class StartupProfile(object):
+    """ Times the imports (as a finder on sys.meta_path, wrapping the
+    loaders) and the construction of interfaces, nodes and connections by
+    module, until the first Workflow.run(), which exits instead.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.imports = OrderedDict()  # module -> (inclusive, own) seconds
+        self.builds = OrderedDict()   # module -> (calls, seconds)
+        self._stack = []
+        self._imported = 0.
+        self._building = False
+        self._patched = []
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+        from nipype.interfaces.base import BaseInterface
+        from nipype.pipeline.engine import Node, Workflow
+        for cls, method in ((BaseInterface, '__init__'), (Node, '__init__'),
+                            (Workflow, '__init__'), (Workflow, 'connect')):
+            original = cls.__dict__[method]
+            self._patched.append((cls, method, original))
+            setattr(cls, method, self._timed(original))
+        self._patched.append((Workflow, 'run', Workflow.__dict__['run']))
+        Workflow.run = lambda workflow, *args, **kwargs: self._stop(workflow)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+        for cls, method, original in reversed(self._patched):
+            setattr(cls, method, original)
+        self._patched = []
+
+    def find_spec(self, name, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        loader = spec.loader
+        if loader is None or isinstance(loader, type) or \
+                not hasattr(loader, 'exec_module'):
+            return spec
+
+        exec_module = loader.exec_module
+
+        def timed_exec_module(module):
+            self._stack.append(0.)
+            start = time.time()
+            try:
+                exec_module(module)
+            finally:
+                total = time.time() - start
+                children = self._stack.pop()
+                if self._stack:
+                    self._stack[-1] += total
+                else:
+                    self._imported += total
+                self.imports[name] = (total, total - children)
+
+        loader.exec_module = timed_exec_module
+        return spec
+
+    def _timed(self, func):
+        """ func, with its time added to the first module outside of
+        NiPype calling it (only for the outermost of nested calls, e.g.
+        MapNode -> Node).
+        """
+        profile = self
+
+        def timed(*args, **kwargs):
+            if profile._building:
+                return func(*args, **kwargs)
+            frame = sys._getframe(1)
+            while frame.f_back is not None and frame.f_globals.get(
+                    '__name__', '').split('.')[0] == 'nipype':
+                frame = frame.f_back
+            caller = frame.f_globals.get('__name__', '?')
+            profile._building = True
+            start, imported = time.time(), profile._imported
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile._building = False
+                # without the modules imported on the way
+                elapsed = time.time() - start - (profile._imported - imported)
+                calls, seconds = profile.builds.get(caller, (0, 0.))
+                profile.builds[caller] = (calls + 1, seconds + elapsed)
+        return timed
+
+    def _stop(self, workflow):
+        self.uninstall()
+        self.report()
+        print('\n--profile-startup: not running %s' % workflow.name)
+        sys.exit(0)
+
+    def report(self, n_slowest=15):
+        elapsed = time.time() - self.start
+        imported = self._imported
+        built = sum(seconds for _, seconds in self.builds.values())
+        packages = OrderedDict()
+        for name, (_, own) in self.imports.items():
+            package = name.split('.')[0]
+            packages[package] = packages.get(package, 0.) + own
+
+        print('startup: %.2f s; imports %.2f s (%d modules), interfaces, '
+              'nodes and connections %.2f s, other %.2f s'
+              % (elapsed, imported, len(self.imports), built,
+                 elapsed - imported - built))
+        print('\nimport time per package (s):')
+        for package, own in sorted(packages.items(),
+                                   key=lambda p: -p[1])[:n_slowest]:
+            print('  %-40s %8.3f' % (package, own))
+        print('\nslowest modules, own / with imports (s):')
+        for name, (total, own) in sorted(self.imports.items(),
+                                         key=lambda m: -m[1][1]
+                                         )[:n_slowest]:
+            print('  %-40s %8.3f %8.3f' % (name, own, total))
+        if self.builds:
+            print('\ngraph building per module, calls / time (s):')
+            for name, (calls, seconds) in sorted(self.builds.items(),
+                                                 key=lambda b: -b[1][1]):
+                print('  %-40s %8d %8.3f' % (name, calls, seconds))
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Run one of the NHP-BIDS workflows.',
+        epilog='Commands: %s' % ', '.join(
+            '%s (%s.py)' % c for c in COMMANDS.items()))
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='Report the import and graph building time '
+                             'and stop before running the workflow.')
+    parser.add_argument('--write-graph', action='store_true',
+                        help='Render the graphs of the workflow.')
+    parser.add_argument('--gc', action='store_true',
+                        help='Collect the working directory after a '
+                             'successful run (workdir_gc.py).')
+    parser.add_argument('--gc-keep-last', type=int, default=None,
+                        help='With --gc, keep the outputs of the N most '
+                             'recent runs of every node.')
+    parser.add_argument('--gc-max-gb', type=float, default=None,
+                        help='With --gc, keep at most this many GB of '
+                             'outputs.')
+    parser.add_argument('command', choices=list(COMMANDS))
+    parser.add_argument('args', nargs=argparse.REMAINDER,
+                        help='Arguments of the script.')
+    args = parser.parse_args(argv)
+
+    if args.write_graph:
+        os.environ['NHP_WRITE_GRAPH'] = '1'
+    if code_dir not in sys.path:
+        sys.path.insert(0, code_dir)
+
+    module = COMMANDS[args.command]
+    if args.gc:
+        import workdir_gc
+        workdir_gc.install(keep_last=args.gc_keep_last,
+                           max_gb=args.gc_max_gb)
+    profile = None
+    if args.profile_startup:
+        profile = StartupProfile()
+        profile.install()
+
+    sys.argv = [os.path.join(code_dir, module + '.py')] + args.args
+    try:
+        runpy.run_module(module, run_name='__main__', alter_sys=True)
+    finally:
+        if profile is not None:
+            # the script did not start a workflow
+            profile.uninstall()
+    if profile is not None:
+        profile.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -24,5 +24,7 @@ workon mri-py3
 export PYTHONPATH=$PYTHONPATH:~/NHP-BIDS/code
 export PATH=$PATH:~/NHP-BIDS/code/mc/
 export FSLOUTPUTTYPE=NIFTI_GZ
+# node-local scratch of the commands (staging.py)
+export NHP_STAGE_DIR=${TMPDIR:-/tmp}/nhp-stage
 
 cd NHP-BIDS
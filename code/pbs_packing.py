@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+
+""" PBS plugin that packs the ready nodes of a workflow into few batch jobs.
+
+NiPype's PBS plugin submits every node as a job of its own, and every job
+waits in the queue and runs the template (modules, virtualenv, cd) before
+it runs the node, which for SelectFiles, dilatemask, getthreshold and the
+like takes a fraction of that. PackedPBSPlugin collects the nodes that are
+ready in a round of the scheduler and packs them, by estimated cost, into
+
+    <batch>/pack_<n>.json            the pyscripts (one per node) of a job
+    <batch>/batchscript_pack_<n>.sh  template + python pbs_packing.py run
+    <batch>/pack_<n>.timing.json     queue wait, setup and node run times
+
+The job runs its nodes on a pool of n_procs processes (the ppn of the
+template by default). A node costs what it took in the previous runs
+(<dataset>/workingdirs/pbs-packing/costs.json, or $NHP_PACK_COSTS), by
+node name and interface class, else the DEFAULT_COSTS of its interface.
+Packs hold up to pack_seconds of nodes per process, and a node estimated
+to take longer gets a job of its own. The results of a pack are read when
+its job is done; a staged node (staging.py) has copied its outputs back
+before its result is saved. At the end of the run the plugin prints the
+jobs submitted for the nodes and the time spent waiting in the queue and
+setting up versus running nodes.
+
+    workflow.run(plugin=PackedPBSPlugin(plugin_args={
+        'template': 'code/pbs/template.sh', 'pack_seconds': 3600}))
+
+plugin_args 'queue': 'local' runs the jobs as local processes (at most
+'local_slots' at a time, each started 'local_delay' seconds after it was
+submitted) instead of with qsub, to try a workflow without PBS.
+"""
+
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from nipype.pipeline.plugins.base import SGELikeBatchManagerBase, logger
+from nipype.pipeline.plugins.tools import create_pyscript
+
+
+ds_root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# seconds, by interface class, before a node has run
+DEFAULT_COSTS = {
+    'IdentityInterface': 1,
+    'Function': 10,
+    'Merge': 1,
+    'Select': 1,
+    'Rename': 1,
+    'SelectFiles': 5,
+    'IndexedSelectFiles': 5,
+    'DataSink': 30,
+    'LinkDataSink': 10,
+    'ImageStats': 15,
+    'ImageMaths': 60,
+}
+DEFAULT_COST = 600
+MAX_PACK_NODES = 64
+
+
+def costs_file(path=None):
+    if path is None:
+        path = os.environ.get('NHP_PACK_COSTS',
+                              os.path.join(ds_root, 'workingdirs',
+                                           'pbs-packing', 'costs.json'))
+    return os.path.abspath(path)
+
+
+def _node_keys(node):
+    """ Keys of the costs of a node, most specific first: node name and
+    interface, interface. The subnodes of a MapNode (_<name><i>) share the
+    name of the MapNode; the MapNode itself (which collects their results)
+    has a key of its own.
+    """
+    from nipype.pipeline.engine import MapNode
+
+    interface = type(node.interface).__name__
+    if isinstance(node, MapNode):
+        return ('%s:%s[map]' % (node.name, interface),)
+    name = re.sub(r'^_(.+?)\d+$', r'\1', node.name)
+    return '%s:%s' % (name, interface), interface
+
+
+class CostModel(object):
+    """ Mean run time of the last runs, by node name and interface. """
+
+    window = 20
+
+    def __init__(self, path=None):
+        self.path = costs_file(path)
+        try:
+            with open(self.path) as f:
+                self.means = json.load(f)
+        except (IOError, ValueError):
+            self.means = dict()
+
+    def estimate(self, node):
+        for key in _node_keys(node):
+            if key in self.means:
+                return self.means[key][1]
+        return DEFAULT_COSTS.get(type(node.interface).__name__,
+                                 DEFAULT_COST)
+
+    def update(self, keys, seconds):
+        for key in keys:
+            n, mean = self.means.get(key, (0, 0.))
+            n = min(n + 1, self.window)
+            self.means[key] = [n, mean + (seconds - mean) / n]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = '%s.%d' % (self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.means, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+def pack(items, n_procs, pack_seconds, max_nodes=MAX_PACK_NODES):
+    """ Group (cost, item) into packs of at most pack_seconds per process
+    (first fit, most costly first). An item costing more than pack_seconds
+    is a pack of its own. Returns [[item]].
+    """
+    budget = pack_seconds * n_procs
+    packs = []  # [total cost, [item]]
+    for cost, item in sorted(items, key=lambda x: -x[0]):
+        if cost < pack_seconds:
+            for p in packs:
+                if p[0] + cost <= budget and len(p[1]) < max_nodes:
+                    p[0] += cost
+                    p[1].append(item)
+                    break
+            else:
+                packs.append([cost, [item]])
+        else:
+            packs.append([budget, [item]])
+    return [p[1] for p in packs]
+
+
+# ------------------------------------------------------------- queues
+
+class PBSQueue(object):
+    """ qsub and qstat. """
+
+    def __init__(self, qsub_args='', retries=2, retry_timeout=2):
+        self.qsub_args = qsub_args
+        self.retries = retries
+        self.retry_timeout = retry_timeout
+
+    def submit(self, scriptfile, name):
+        path = os.path.dirname(scriptfile)
+        args = self.qsub_args or ''
+        if '-o' not in args:
+            args += ' -o %s' % path
+        if '-e' not in args:
+            args += ' -e %s' % path
+        cmd = 'qsub %s -N %s %s' % (args, name[:15], scriptfile)
+        for attempt in range(self.retries + 1):
+            proc = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE,
+                                  universal_newlines=True)
+            if proc.returncode == 0:
+                return proc.stdout.split('.')[0].strip()
+            time.sleep(self.retry_timeout)
+        raise RuntimeError('Could not submit %s: %s' % (scriptfile,
+                                                         proc.stderr))
+
+    def is_pending(self, jobid):
+        proc = subprocess.run(['qstat', '-f', jobid], stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, universal_newlines=True)
+        if 'Job has finished' in proc.stderr or \
+                'job_state = C' in proc.stdout:
+            return False
+        return 'Unknown Job Id' not in proc.stderr
+
+
+class LocalQueue(object):
+    """ Stand-in for PBS: runs the batch scripts with bash, at most slots
+    at a time, each at least delay seconds after it was submitted.
+    """
+
+    def __init__(self, slots=2, delay=0.):
+        self.slots = slots
+        self.delay = delay
+        self._queued = OrderedDict()  # jobid: (scriptfile, submitted)
+        self._running = dict()  # jobid: Popen
+        self._n = 0
+
+    def submit(self, scriptfile, name):
+        self._n += 1
+        jobid = 'local.%d' % self._n
+        self._queued[jobid] = (scriptfile, time.time())
+        return jobid
+
+    def _start(self):
+        for jobid, (scriptfile, submitted) in list(self._queued.items()):
+            running = [p for p in self._running.values() if p.poll() is None]
+            if len(running) >= self.slots or \
+                    time.time() < submitted + self.delay:
+                break
+            del self._queued[jobid]
+            env = dict(os.environ, PBS_JOBID=jobid)
+            with open(scriptfile + '.o', 'w') as out, \
+                    open(scriptfile + '.e', 'w') as err:
+                self._running[jobid] = subprocess.Popen(
+                    ['bash', scriptfile], stdout=out, stderr=err, env=env,
+                    cwd=os.path.dirname(scriptfile))
+
+    def is_pending(self, jobid):
+        self._start()
+        if jobid in self._queued:
+            return True
+        return self._running[jobid].poll() is None
+
+
+# ------------------------------------------------------------- plugin
+
+class PackedPBSPlugin(SGELikeBatchManagerBase):
+    """ PBS plugin submitting packs of ready nodes (see pbs_packing.py).
+
+    plugin_args: template, qsub_args, n_procs (processes per job; default
+    the ppn of the template), pack_seconds (default 3600), max_pack_nodes,
+    costs (cost file), queue ('pbs' or 'local'), local_slots, local_delay.
+    """
+
+    def __init__(self, **kwargs):
+        plugin_args = kwargs.get('plugin_args') or dict()
+        super(PackedPBSPlugin, self).__init__('#PBS -V\n', **kwargs)
+        ppn = re.search(r'^#PBS .*ppn=(\d+)', self._template, re.M)
+        self._n_procs = int(plugin_args.get(
+            'n_procs', ppn.group(1) if ppn else os.cpu_count()))
+        self._pack_seconds = float(plugin_args.get('pack_seconds', 3600))
+        self._max_pack_nodes = int(plugin_args.get('max_pack_nodes',
+                                                   MAX_PACK_NODES))
+        self._costs = CostModel(plugin_args.get('costs'))
+        if plugin_args.get('queue', 'pbs') == 'local':
+            self._queue = LocalQueue(plugin_args.get('local_slots', 2),
+                                     plugin_args.get('local_delay', 0.))
+        else:
+            self._queue = PBSQueue(self._qsub_args)
+        self._ready = []  # (cost, (taskid, node, pyscript))
+        self._packs = dict()  # pack file: {jobid, nodes, done, ...}
+        self._task_pack = dict()  # taskid: pack file
+        self._n_tasks = 0
+        self._n_packs = 0
+        self._done = []
+
+    def _submit_job(self, node, updatehash=False):
+        # packed and submitted at the end of the round
+        self._n_tasks += 1
+        taskid = 'node.%d' % self._n_tasks
+        pyscript = self._unique_pyscript(
+            create_pyscript(node, updatehash=updatehash), taskid)
+        self._pending[taskid] = node.output_dir()
+        self._ready.append((self._costs.estimate(node),
+                            (taskid, node, pyscript)))
+        return taskid
+
+    @staticmethod
+    def _unique_pyscript(pyscript, taskid):
+        # pyscript_<time>_<node id>.py and node_<...>.pklz are the same for
+        # nodes with the same id (the subnodes of a MapNode under each
+        # iterable) submitted within a second; they wait for their job here
+        batch_dir, name = os.path.split(pyscript)
+        suffix = name[len('pyscript_'):-len('.py')]
+        unique = '%s.%s' % (suffix, taskid)
+        with open(pyscript) as f:
+            script = f.read()
+        os.replace(os.path.join(batch_dir, 'node_%s.pklz' % suffix),
+                   os.path.join(batch_dir, 'node_%s.pklz' % unique))
+        unique_pyscript = os.path.join(batch_dir, 'pyscript_%s.py' % unique)
+        with open(unique_pyscript, 'w') as f:
+            f.write(script.replace(suffix, unique))
+        os.remove(pyscript)
+        return unique_pyscript
+
+    def _send_procs_to_workers(self, updatehash=False, graph=None):
+        super(PackedPBSPlugin, self)._send_procs_to_workers(
+            updatehash=updatehash, graph=graph)
+        ready, self._ready = self._ready, []
+        if not ready:
+            return
+        # nodes with qsub arguments of their own are not packed
+        own = [item for item in ready
+               if item[1][1].plugin_args.get('qsub_args')]
+        packs = pack([item for item in ready if item not in own],
+                     self._n_procs, self._pack_seconds,
+                     self._max_pack_nodes) + [[item[1]] for item in own]
+        for nodes in packs:
+            self._submit_pack(nodes)
+        logger.info('Submitted %d nodes in %d jobs', len(ready), len(packs))
+
+    def _submit_pack(self, nodes):
+        batch_dir = os.path.dirname(nodes[0][2])
+        self._n_packs += 1
+        name = 'pack_%d_%d' % (os.getpid(), self._n_packs)
+        packfile = os.path.join(batch_dir, name + '.json')
+        with open(packfile, 'w') as f:
+            json.dump(dict(
+                pyscripts=[pyscript for _, _, pyscript in nodes],
+                n_procs=self._n_procs,
+                submitted=time.time()), f, indent=1)
+
+        # the job start is taken after the directives, before the setup
+        lines = self._template.rstrip('\n').split('\n')
+        n_header = 0
+        while n_header < len(lines) and (
+                not lines[n_header].strip() or
+                lines[n_header].startswith('#')):
+            n_header += 1
+        lines.insert(n_header, 'export NHP_PACK_START=$(date +%s.%N)')
+        lines.append('%s %s run %s' % (
+            sys.executable, os.path.realpath(__file__), packfile))
+        scriptfile = os.path.join(batch_dir, 'batchscript_%s.sh' % name)
+        with open(scriptfile, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        node = nodes[0][1]
+        qsub_args = node.plugin_args.get('qsub_args')
+        queue = self._queue
+        if qsub_args and isinstance(queue, PBSQueue):
+            args = qsub_args if node.plugin_args.get('overwrite') else \
+                '%s %s' % (queue.qsub_args or '', qsub_args)
+            queue = PBSQueue(args, queue.retries, queue.retry_timeout)
+        jobid = queue.submit(scriptfile, 'pk.%s' % node.name)
+        self._packs[packfile] = dict(
+            jobid=jobid, done=False,
+            keys=dict((pyscript, _node_keys(node))
+                      for _, node, pyscript in nodes))
+        for taskid, _, _ in nodes:
+            self._task_pack[taskid] = packfile
+        logger.debug('submitted pack %s (%d nodes) as job %s', packfile,
+                     len(nodes), jobid)
+
+    def _is_pending(self, taskid):
+        packfile = self._task_pack[taskid]
+        info = self._packs[packfile]
+        if not info['done']:
+            if self._queue.is_pending(info['jobid']):
+                return True
+            info['done'] = True
+            self._pack_finished(packfile, info)
+        return False
+
+    def _pack_finished(self, packfile, info):
+        try:
+            with open(packfile[:-len('.json')] + '.timing.json') as f:
+                timing = json.load(f)
+        except (IOError, ValueError):
+            # e.g. the job was killed
+            return
+        for pyscript, seconds in timing['nodes'].items():
+            if pyscript in info['keys']:
+                self._costs.update(info['keys'][pyscript], seconds)
+        self._done.append(timing)
+
+    def _clear_task(self, taskid):
+        super(PackedPBSPlugin, self)._clear_task(taskid)
+        del self._task_pack[taskid]
+
+    def _postrun_check(self):
+        super(PackedPBSPlugin, self)._postrun_check()
+        if self._done:
+            self._costs.save()
+        print_report(self._done)
+
+
+def print_report(timings):
+    """ Queue wait versus compute time of the packs of a run. """
+    if not timings:
+        return
+    n_nodes = sum(len(t['nodes']) for t in timings)
+    wait = [t['start'] - t['submitted'] for t in timings]
+    setup = [t['runner_start'] - t['start'] for t in timings]
+    wall = sum(t['end'] - t['start'] for t in timings)
+    compute = sum(sum(t['nodes'].values()) for t in timings)
+    print('packed PBS: %d nodes in %d jobs (%d fewer jobs)' % (
+        n_nodes, len(timings), n_nodes - len(timings)))
+    print('  queue wait  %8.1f min (mean %.1f, max %.1f per job)' % (
+        sum(wait) / 60., sum(wait) / 60. / len(wait), max(wait) / 60.))
+    print('  job setup   %8.1f min' % (sum(setup) / 60.))
+    print('  job time    %8.1f min' % (wall / 60.))
+    print('  node time   %8.1f min (processes of the jobs)' % (
+        compute / 60.))
+
+
+# ------------------------------------------------------------- runner
+
+def run_pack(packfile):
+    """ Run the pyscripts of a pack (in a batch job) on a pool of
+    processes and write the timing of the job next to it.
+    """
+    runner_start = time.time()
+    with open(packfile) as f:
+        pack_info = json.load(f)
+    start = float(os.environ.get('NHP_PACK_START', runner_start))
+    pyscripts = pack_info['pyscripts']
+
+    def run(pyscript):
+        t = time.time()
+        with open(pyscript[:-len('.py')] + '.out', 'w') as out:
+            returncode = subprocess.call([sys.executable, pyscript],
+                                         stdout=out, stderr=subprocess.STDOUT,
+                                         cwd=os.path.dirname(pyscript))
+        seconds = time.time() - t
+        print('%-60s %8.1f s%s' % (os.path.basename(pyscript), seconds,
+                                   ' (exit %d)' % returncode
+                                   if returncode else ''))
+        sys.stdout.flush()
+        return seconds
+
+    n_procs = min(len(pyscripts), pack_info['n_procs'] or os.cpu_count())
+    with ThreadPoolExecutor(max(1, n_procs)) as pool:
+        seconds = list(pool.map(run, pyscripts))
+
+    timing = dict(submitted=pack_info['submitted'], start=start,
+                  runner_start=runner_start, end=time.time(),
+                  nodes=dict(zip(pyscripts, seconds)))
+    tmp = '%s.%d' % (packfile, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(timing, f, indent=1)
+    os.replace(tmp, packfile[:-len('.json')] + '.timing.json')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Packed PBS jobs of NiPype nodes.')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('run', help='Run the nodes of a pack (in its job).')
+    p.add_argument('packfile')
+    p = sub.add_parser('costs', help='Print the estimated node costs.')
+    p.add_argument('--costs', default=None,
+                   help='Default: workingdirs/pbs-packing/costs.json.')
+    p = sub.add_parser('report', help='Queue wait versus compute time of '
+                                      'the packs of a batch directory.')
+    p.add_argument('batch_dir')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run_pack(args.packfile)
+    elif args.command == 'costs':
+        model = CostModel(args.costs)
+        for key, (n, mean) in sorted(model.means.items(),
+                                     key=lambda x: -x[1][1]):
+            print('%-60s %10.1f s (%d runs)' % (key, mean, n))
+    elif args.command == 'report':
+        timings = []
+        for name in sorted(os.listdir(args.batch_dir)):
+            if name.endswith('.timing.json'):
+                with open(os.path.join(args.batch_dir, name)) as f:
+                    timings.append(json.load(f))
+        print_report(timings)
+    else:
+        parser.print_help()
@@ -11,9 +11,9 @@ After this, modelfit_workflow.py should be ran (may be renamed).
 
 from builtins import range
 
-import nipype.interfaces.io as nio           # Data i/o
 import nipype.pipeline.engine as pe          # pypeline engine
-import nipype.algorithms.modelgen as model   # model specification
+from nhp_bids import fsl_version, lazy_import, write_graph
+model = lazy_import('nipype.algorithms.modelgen')  # model specification
 from nipype.interfaces.base import Bunch
 from nipype.interfaces.base import Undefined # to disable use_norm
 import os                                    # system functions
@@ -23,7 +23,16 @@ import nipype.interfaces.fsl as fsl          # fsl
 import nipype.interfaces.utility as util     # utility
 from nipype.workflows.fmri.fsl.preprocess import create_susan_smooth
 from nipype import LooseVersion
-
+from nipype import config
+
+import masked
+from bids_index import IndexedSelectFiles
+from link_datasink import LinkDataSink
+import graph_dedup
+import maths_fusion
+from pbs_packing import PackedPBSPlugin
+import resultcache
+import staging
 import transform_manualmask
 import motioncorrection_workflow
 import undistort_workflow
@@ -37,7 +46,16 @@ def getmeanscale(medianvals):
     return ['-mul %.10f' % (10000. / val) for val in medianvals]
 
 
-def create_workflow():
+def create_workflow(manualmask_method='premc', filters='fsl'):
+    """ manualmask_method='premc' transforms the reference mask to each run
+    with the (inverted) matrix of the pre-motion-correction, 'flirt' runs a
+    separate FLIRT registration per run (see transform_manualmask.py).
+
+    filters='fsl' scales and high-passes the runs with fslmaths, 'native'
+    does both in one pass over the voxels in the dilated mask and also
+    writes the result as a masked series to highpassed_masked (see
+    masked/filters.py).
+    """
     featpreproc = pe.Workflow(name="featpreproc")
 
     featpreproc.base_dir = os.path.join(ds_root, 'workingdirs')
@@ -124,8 +142,8 @@ def create_workflow():
     }
 
     inputfiles = pe.Node(
-        nio.SelectFiles(templates,
-                        base_directory=data_dir), name="input_files")
+        IndexedSelectFiles(templates,
+                           base_directory=data_dir), name="input_files")
 
     featpreproc.connect(
         [(inputnode, inputfiles,
@@ -146,7 +164,7 @@ def create_workflow():
 
     # ------------------ Output Files
     # Datasink
-    outputfiles = pe.Node(nio.DataSink(
+    outputfiles = pe.Node(LinkDataSink(
         base_directory=ds_root,
         container='derivatives/featpreproc',
         parameterization=True),
@@ -171,6 +189,7 @@ def create_workflow():
         (r'/_maskfunc[0-9]+/', r'/func/'),
         (r'/_mc[0-9]+/', r'/func/'),
         (r'/_meanfunc[0-9]+/', r'/func/'),
+        (r'/_native_filter[0-9]+/', r'/func/'),
         (r'/_outliers[0-9]+/', r'/func/'),
         (r'_run_id_[0-9][0-9]', r''),
     ]
@@ -209,7 +228,8 @@ def create_workflow():
     # --------------------------------------------------------
     # should just be used as input to motion correction,
     # after mc, all functionals should be aligned to reference
-    transmanmask_mc = transform_manualmask.create_workflow()
+    transmanmask_mc = transform_manualmask.create_workflow(
+        method=manualmask_method)
 
     # - - - - - - Connections - - - - - - -
     featpreproc.connect(
@@ -267,10 +287,6 @@ def create_workflow():
            ('ref_func', 'in.ref_func'),
            ('ref_funcmask', 'in.ref_func_weights'),
           ]),
-         (transmanmask_mc, pre_mc,
-          [
-           ('funcreg.out_file', 'in.funcs_masks'),  # use mask as weights
-         ]),
          (pre_mc, outputnode,
           [
            ('mc.out_file', 'pre_motion_corrected'),
@@ -304,9 +320,6 @@ def create_workflow():
              # image.
              ('ref_funcmask', 'in.ref_func_weights'),
            ]),
-         (transmanmask_mc, mc, [
-             ('funcreg.out_file', 'in.funcs_masks'),  # use mask as weights
-         ]),
          (mc, outputnode, [
              ('mc.out_file', 'motion_corrected'),
              ('mc.oned_file', 'motion_parameters.oned_file'),
@@ -319,6 +332,21 @@ def create_workflow():
          ]),
     ])
 
+    if manualmask_method == 'premc':
+        # the run -> reference matrix of the pre-motion-correction is
+        # inverted to bring the reference mask into the space of each run
+        featpreproc.connect(pre_mc, 'mc.oned_matrix_save',
+                            transmanmask_mc, 'in.premc_matrix')
+    else:
+        featpreproc.connect(
+            [(transmanmask_mc, pre_mc,
+              [('funcreg.out_file', 'in.funcs_masks'),  # use mask as weights
+               ]),
+             (transmanmask_mc, mc,
+              [('funcreg.out_file', 'in.funcs_masks'),  # use mask as weights
+               ]),
+             ])
+
     #  |~. _ | _| _ _  _  _    _ _  _ _ _  __|_. _  _
     #  |~|(/_|(_|| | |(_||_)  (_(_)| | (/_(_ | |(_)| |
     #                    |
@@ -712,6 +740,33 @@ def create_workflow():
     featpreproc.connect(inputnode, ('fwhm', chooseindex), selectnode, 'index')
     featpreproc.connect(selectnode, 'out', outputfiles, 'smoothed_files')
 
+    if filters == 'native':
+        """
+        Scale the median value of the run to 10000, high-pass and compute the
+        mean in one pass (see masked/filters.py).
+        """
+        native_filter = pe.MapNode(interface=masked.native_filter_interface,
+                                   iterfield=['in_file', 'median'],
+                                   name='native_filter')
+        native_filter.inputs.dtype = 'float32'
+        featpreproc.connect([
+            (selectnode, native_filter, [('out', 'in_file')]),
+            (dilatemask, native_filter, [('out_file', 'mask_file')]),
+            (medianval, native_filter, [('out_stat', 'median')]),
+            (inputnode, native_filter, [('highpass', 'highpass_sigma')]),
+            (native_filter, outputnode,
+             [('out_file', 'highpassed_files'),
+              ('mean_file', 'mean_highpassed')]),
+            (native_filter, outputfiles,
+             [('mean_file', 'mean'),
+              ('masked_file', 'highpassed_masked')]),
+        ])
+        featpreproc.connect(outputnode, 'highpassed_files',
+                            outputfiles, 'highpassed_files')
+        return(featpreproc)
+
+    assert filters == 'fsl', 'Unknown filters %s' % filters
+
     """
     Scale the median value of the run is set to 10000.
     """
@@ -745,8 +800,8 @@ def create_workflow():
     featpreproc.connect(meanscale, 'out_file', highpass, 'in_file')
 
     version = 0
-    if fsl.Info.version() and \
-            LooseVersion(fsl.Info.version()) > LooseVersion('5.0.6'):
+    if fsl_version() and \
+            LooseVersion(fsl_version()) > LooseVersion('5.0.6'):
         version = 507
 
     if version < 507:
@@ -798,13 +853,19 @@ def create_workflow():
 #
 # ===================================================================
 
-def run_workflow(run_num=None, session=None, csv_file=None, use_pbs=False):
+def run_workflow(run_num=None, session=None, csv_file=None, use_pbs=False,
+                 filters='fsl', dedup=False, fuse=False, stage=False,
+                 pack=True, local_queue=False, result_cache=False):
+    # debug mode used to be enabled as a side effect of importing
+    # motioncorrection_workflow and transform_manualmask
+    config.enable_debug_mode()
+
     # Using the name "level1flow" should allow the workingdirs file to be used
     #  by the fmri_workflow pipeline.
     workflow = pe.Workflow(name='level1flow')
     workflow.base_dir = os.path.abspath('./workingdirs')
 
-    featpreproc = create_workflow()
+    featpreproc = create_workflow(filters=filters)
 
     inputnode = pe.Node(niu.IdentityInterface(fields=[
         'subject_id',
@@ -849,8 +910,8 @@ def run_workflow(run_num=None, session=None, csv_file=None, use_pbs=False):
             '.nii.gz',
     }
     inputfiles = pe.Node(
-        nio.SelectFiles(templates,
-                        base_directory=data_dir), name="input_files")
+        IndexedSelectFiles(templates,
+                           base_directory=data_dir), name="input_files")
 
     workflow.connect([
         (inputnode, inputfiles,
@@ -871,12 +932,31 @@ def run_workflow(run_num=None, session=None, csv_file=None, use_pbs=False):
     featpreproc.inputs.inputspec.highpass = 50  # FWHM in seconds
     workflow.keep_inputs = True
     workflow.remove_unnecessary_outputs = False
-    workflow.write_graph()
-    if use_pbs:
-        workflow.run(plugin='PBS', plugin_args={'template': '/home/jonathan/NHP-BIDS/code/pbs/template.sh'})
+    if fuse:
+        # e.g. highpass -> addmean as one fslmaths command
+        maths_fusion.fuse(workflow)
+    write_graph(workflow)
+    if result_cache:
+        # outputs of identical commands are shared with the other workflows
+        resultcache.enable(workflow)
+    if stage:
+        # run the commands on the node-local disk of the job
+        staging.enable(workflow)
+    # with dedup, run the nodes that don't depend on the run once per session
+    run = graph_dedup.run if dedup else pe.Workflow.run
+    template = '/home/jonathan/NHP-BIDS/code/pbs/template.sh'
+    if local_queue:
+        # the jobs of the packed PBS plugin as local processes
+        run(workflow, plugin=PackedPBSPlugin(plugin_args={'queue': 'local'}))
+    elif use_pbs and pack:
+        # the nodes that are ready at the same time in few jobs
+        run(workflow, plugin=PackedPBSPlugin(
+            plugin_args={'template': template}))
+    elif use_pbs:
+        run(workflow, plugin='PBS', plugin_args={'template': template})
     else:
         #workflow.stop_on_first_crash = True
-        workflow.run()
+        run(workflow)
 
 
 if __name__ == '__main__':
@@ -890,6 +970,35 @@ if __name__ == '__main__':
                         help='CSV file with subjects, sessions, and runs.')
     parser.add_argument('--pbs', dest='use_pbs', action='store_true',
             help='Whether to use pbs plugin.')
+    parser.add_argument('--filters', default='fsl', choices=['fsl', 'native'],
+                        help='Intensity normalisation and high-pass with '
+                             'fslmaths or natively on masked series '
+                             '(masked/filters.py).')
+
+    parser.add_argument('--dedup', action='store_true',
+                        help='Run the nodes that do not depend on the run '
+                             'once per session instead of once per run '
+                             '(graph_dedup.py).')
+    parser.add_argument('--fuse', action='store_true',
+                        help='Run chains of fslmaths nodes as one fslmaths '
+                             'command, without the intermediate images '
+                             '(maths_fusion.py).')
+    parser.add_argument('--stage', action='store_true',
+                        help='Run the command line nodes on local scratch '
+                             '(staging.py), e.g. with --pbs: their inputs '
+                             'are copied there and their outputs copied '
+                             'back and verified.')
+    parser.add_argument('--no-pack', dest='pack', action='store_false',
+                        help='With --pbs, submit every node as a job of its '
+                             'own instead of packing them (pbs_packing.py).')
+    parser.add_argument('--local-queue', action='store_true',
+                        help='Run the packed PBS jobs as local processes, '
+                             'without PBS.')
+    parser.add_argument('--result-cache', action='store_true',
+                        help='Link the outputs of commands that already ran '
+                             'with the same inputs, in this or another '
+                             'workflow, instead of running them again '
+                             '(resultcache.py).')
 
     args = parser.parse_args()
 
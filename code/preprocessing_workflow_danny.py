@@ -24,6 +24,10 @@ import nipype.interfaces.utility as util     # utility
 from nipype.workflows.fmri.fsl.preprocess import create_susan_smooth
 from nipype import LooseVersion
 
+from link_datasink import LinkDataSink
+import graph_dedup
+import maths_fusion
+import resultcache
 import transform_manualmask
 import motioncorrection_workflow
 import undistort_workflow
@@ -146,7 +150,7 @@ def create_workflow():
 
     # ------------------ Output Files
     # Datasink
-    outputfiles = pe.Node(nio.DataSink(
+    outputfiles = pe.Node(LinkDataSink(
         base_directory=ds_root,
         container='derivatives/featpreproc',
         parameterization=True),
@@ -798,7 +802,8 @@ def create_workflow():
 #
 # ===================================================================
 
-def run_workflow(run_num=None, session=None, csv_file=None, use_pbs=False):
+def run_workflow(run_num=None, session=None, csv_file=None, use_pbs=False,
+                 dedup=False, fuse=False, result_cache=False):
     # Using the name "level1flow" should allow the workingdirs file to be used
     #  by the fmri_workflow pipeline.
     workflow = pe.Workflow(name='level1flow')
@@ -872,11 +877,19 @@ def run_workflow(run_num=None, session=None, csv_file=None, use_pbs=False):
     #workflow.stop_on_first_crash = True
     workflow.keep_inputs = True
     workflow.remove_unnecessary_outputs = False
+    if fuse:
+        # e.g. highpass -> addmean as one fslmaths command
+        maths_fusion.fuse(workflow)
     workflow.write_graph()
+    if result_cache:
+        # outputs of identical commands are shared with the other workflows
+        resultcache.enable(workflow)
+    # with dedup, run the nodes that don't depend on the run once per session
+    run = graph_dedup.run if dedup else pe.Workflow.run
     if use_pbs:
-        workflow.run(plugin='PBS', plugin_args={'template': '/home/jonathan/NHP-BIDS/code/pbs/template.sh'})
+        run(workflow, plugin='PBS', plugin_args={'template': '/home/jonathan/NHP-BIDS/code/pbs/template.sh'})
     else:
-        workflow.run()
+        run(workflow)
 
 
 if __name__ == '__main__':
@@ -890,6 +903,19 @@ if __name__ == '__main__':
                         help='CSV file with subjects, sessions, and runs.')
     parser.add_argument('--pbs', dest='use_pbs', action='store_true',
             help='Whether to use pbs plugin.')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Run the nodes that do not depend on the run '
+                             'once per session instead of once per run '
+                             '(graph_dedup.py).')
+    parser.add_argument('--fuse', action='store_true',
+                        help='Run chains of fslmaths nodes as one fslmaths '
+                             'command, without the intermediate images '
+                             '(maths_fusion.py).')
+    parser.add_argument('--result-cache', action='store_true',
+                        help='Link the outputs of commands that already ran '
+                             'with the same inputs, in this or another '
+                             'workflow, instead of running them again '
+                             '(resultcache.py).')
 
     args = parser.parse_args()
 
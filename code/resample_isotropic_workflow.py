@@ -4,17 +4,22 @@
 # http://miykael.github.io/nipype-beginner-s-guide/firstSteps.html#input-output-stream
 import os                                    # system functions
 
-import nipype.interfaces.io as nio           # Data i/o
 import nipype.interfaces.utility as niu      # utility
 import nipype.pipeline.engine as pe          # pypeline engine
-import nipype.algorithms.modelgen as model   # model generation
-import nipype.algorithms.rapidart as ra      # artifact detection
+from nhp_bids import lazy_import, write_graph
+model = lazy_import('nipype.algorithms.modelgen')  # model generation
+ra = lazy_import('nipype.algorithms.rapidart')     # artifact detection
 from nipype.interfaces.utility import IdentityInterface
 
 from nipype.pipeline.engine import Workflow, Node, MapNode
 
+from bids_index import IndexedSelectFiles
+from link_datasink import LinkDataSink
+import resultcache
 
-def run_workflow(session=None, csv_file=None, use_pbs=False):
+
+def run_workflow(session=None, csv_file=None, use_pbs=False,
+                 result_cache=False):
     inputnode = pe.Node(niu.IdentityInterface(fields=[
         'subject_id',
         'session_id',
@@ -74,12 +79,12 @@ def run_workflow(session=None, csv_file=None, use_pbs=False):
                 'sub-{subject_id}_ses-{session_id}_*.nii.gz',
     }
     inputfiles = Node(
-        nio.SelectFiles(templates,
-                        base_directory=data_dir), name="input_files")
+        IndexedSelectFiles(templates,
+                           base_directory=data_dir), name="input_files")
 
     # ------------------ Output Files
     # Datasink
-    outputfiles = Node(nio.DataSink(
+    outputfiles = Node(LinkDataSink(
         base_directory=ds_root,
         container=output_dir,
         parameterization=True),
@@ -156,7 +161,10 @@ def run_workflow(session=None, csv_file=None, use_pbs=False):
     isotropic_flow.stop_on_first_crash = False  # True
     isotropic_flow.keep_inputs = True
     isotropic_flow.remove_unnecessary_outputs = False
-    isotropic_flow.write_graph()
+    write_graph(isotropic_flow)
+    if result_cache:
+        # outputs of identical commands are shared with the other workflows
+        resultcache.enable(isotropic_flow)
     outgraph = isotropic_flow.run()
 
 
@@ -170,6 +178,11 @@ if __name__ == '__main__':
                         help='CSV file with subjects, sessions, and runs.')
     parser.add_argument('--pbs', dest='use_pbs', action='store_true',
             help='Whether to use pbs plugin.')
+    parser.add_argument('--result-cache', action='store_true',
+                        help='Link the outputs of commands that already ran '
+                             'with the same inputs, in this or another '
+                             'workflow, instead of running them again '
+                             '(resultcache.py).')
 
     args = parser.parse_args()
 
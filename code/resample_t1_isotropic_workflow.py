@@ -7,11 +7,13 @@ import os                                    # system functions
 import nipype.interfaces.io as nio           # Data i/o
 import nipype.interfaces.utility as niu      # utility
 import nipype.pipeline.engine as pe          # pypeline engine
-import nipype.algorithms.modelgen as model   # model generation
-import nipype.algorithms.rapidart as ra      # artifact detection
+from nhp_bids import lazy_import, write_graph
+model = lazy_import('nipype.algorithms.modelgen')  # model generation
+ra = lazy_import('nipype.algorithms.rapidart')     # artifact detection
 from nipype.interfaces.utility import IdentityInterface
 
 from nipype.pipeline.engine import Workflow, Node, MapNode
+from link_datasink import LinkDataSink
 
 
 def run_workflow(session=None, csv_file=None, use_pbs=False):
@@ -79,7 +81,7 @@ def run_workflow(session=None, csv_file=None, use_pbs=False):
 
     # ------------------ Output Files
     # Datasink
-    outputfiles = Node(nio.DataSink(
+    outputfiles = Node(LinkDataSink(
         base_directory=ds_root,
         container=output_dir,
         parameterization=True),
@@ -157,7 +159,7 @@ def run_workflow(session=None, csv_file=None, use_pbs=False):
     isotropic_flow.stop_on_first_crash = False  # True
     isotropic_flow.keep_inputs = True
     isotropic_flow.remove_unnecessary_outputs = False
-    isotropic_flow.write_graph()
+    write_graph(isotropic_flow)
     outgraph = isotropic_flow.run()
 
 
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+
+""" Result cache of command line interfaces shared by all workflows.
+
+The scripts use their own working directories (workingdirs/...), so the
+same computation (e.g. dilatemask of the same ref_funcmask, FLIRT of the
+same median, the isotropic resampling of an image) runs again for every
+entry point that needs it. With a workflow enabled (enable(), the
+--result-cache option of the scripts), a command line interface first looks
+up
+
+    <root>/<xx>/<key>/meta.json    relative output files, stdout, stderr
+    <root>/<xx>/<key>/files/...    the output files
+    <root>/index.sqlite            entries(key, interface, size, seconds,
+                                   created, last_used, hits)
+
+where key is the SHA1 of the interface class, its inputs (input files by
+name and the MD5 of their content, read for every lookup: a digest cached
+by the stat of the file, as hashcache.py does, could be stale and link the
+outputs of other inputs) and the version of the tool (of the module
+defining the class for interfaces outside NiPype). A hit links
+the outputs into the node directory (hardlink, else reflink, else copy)
+instead of running the command. The outputs of a run are stored as copies
+of their own (a reflink where the file system has them), which are made
+read-only so that a hardlink to them cannot be changed in place; the files
+of the node directory that ran the command stay as they are. Commands run
+on local scratch (staging.py) are not stored, which would copy all their
+outputs to the shared cache while the job waits.
+
+Only interfaces whose outputs are files in the node directory are cached.
+The least recently used entries are evicted when the cache grows beyond
+its size budget ($NHP_RESULT_CACHE_GB, default 200 GB; 0 disables the
+cache).
+
+The root is $NHP_RESULT_CACHE or <dataset>/workingdirs/result-cache, on the
+same file system as the working directories for the hardlinks. Nodes carry
+the settings with them (also when pickled for a PBS job), so every process
+running one uses the cache.
+
+    python -m resultcache stats
+    python -m resultcache evict --max-gb 100
+    python -m resultcache clear
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import threading
+import time
+
+
+ds_root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+DEFAULT_MAX_GB = 200.
+
+
+def cache_root(root=None):
+    if root is None:
+        root = os.environ.get('NHP_RESULT_CACHE',
+                              os.path.join(ds_root, 'workingdirs',
+                                           'result-cache'))
+    return os.path.abspath(root)
+
+
+def default_max_bytes():
+    return int(float(os.environ.get('NHP_RESULT_CACHE_GB',
+                                    DEFAULT_MAX_GB)) * 1024 ** 3)
+
+
+def link_or_copy(src, dst, link=True):
+    """ Hardlink src to dst, or a reflink if they are on different file
+    systems (or not link), or a copy. Returns how ('link', 'reflink' or
+    'copy').
+    """
+    if link:
+        try:
+            os.link(src, dst)
+            return 'link'
+        except OSError:
+            pass
+    try:
+        subprocess.check_call(['cp', '--reflink=always', src, dst],
+                              stderr=subprocess.DEVNULL)
+        return 'reflink'
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+
+def _normalise(value):
+    """ Hashed inputs with files as (basename, content hash): the directory
+    a file is in (another node directory) does not change the result.
+    """
+    from hashcache import hash_file
+
+    if isinstance(value, tuple) and len(value) == 2 and \
+            isinstance(value[0], str) and os.path.isfile(value[0]):
+        return (os.path.basename(value[0]), hash_file(value[0]))
+    if isinstance(value, (list, tuple)):
+        return type(value)(_normalise(v) for v in value)
+    return value
+
+
+def _source_digest(cls):
+    """ Content hash of the module of cls, for interfaces outside NiPype
+    (the version of e.g. mc/afni_allin_slices.py).
+    """
+    import inspect
+    import sys
+    module = sys.modules.get(cls.__module__)
+    filename = getattr(module, '__file__', None)
+    if not filename or cls.__module__.split('.')[0] == 'nipype':
+        return None
+    filename = inspect.getsourcefile(module) or filename
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def interface_key(interface):
+    """ Key of the result of interface with its current inputs.
+    """
+    # the files are hashed by _normalise
+    hashed, _ = interface.inputs.get_hashval(hash_method='timestamp')
+    cls = type(interface)
+    try:
+        version = interface.version
+    except Exception:
+        version = None
+    payload = repr(('%s.%s' % (cls.__module__, cls.__name__),
+                    _normalise(hashed), version, _source_digest(cls)))
+    return hashlib.sha1(payload.encode('UTF-8')).hexdigest()
+
+
+def _output_files(outputs, cwd):
+    """ Relative paths of the output files in cwd, or None if an output is
+    outside of cwd or not a file.
+    """
+    files = []
+
+    def collect(value):
+        if isinstance(value, (list, tuple)):
+            return all(collect(v) for v in value)
+        if not isinstance(value, str) or not os.path.exists(value):
+            # undefined or optional outputs, numbers
+            return True
+        path = os.path.abspath(value)
+        if not path.startswith(cwd + os.sep) or not os.path.isfile(path):
+            return False
+        files.append(path[len(cwd) + 1:])
+        return True
+
+    for value in outputs.values():
+        if not collect(value):
+            return None
+    return sorted(set(files))
+
+
+def _staged(cwd):
+    """ Whether cwd is the local copy of a node directory (staging.py). """
+    import sys
+    staging = sys.modules.get('staging')
+    if staging is None or staging._installed is None:
+        return False
+    return staging._under(cwd, staging._installed[0].work_root)
+
+
+class ResultCache(object):
+    def __init__(self, root=None, max_bytes=None):
+        self.root = cache_root(root)
+        self.max_bytes = default_max_bytes() if max_bytes is None \
+            else int(max_bytes)
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        self.stats = dict(hits=0, misses=0, stored=0, linked_bytes=0,
+                          saved_seconds=0.)
+        self._local = threading.local()
+        self._db().executescript('''
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY, interface TEXT, size INTEGER,
+                seconds REAL, created REAL, last_used REAL,
+                hits INTEGER DEFAULT 0);
+            CREATE INDEX IF NOT EXISTS entries_last_used
+                ON entries (last_used);
+        ''')
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(os.path.join(self.root, 'index.sqlite'),
+                                 timeout=60)
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def _entry(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def fetch(self, key, cwd):
+        """ Link the outputs of key into cwd and return its meta data, or
+        None if it is not in the cache.
+        """
+        entry = self._entry(key)
+        try:
+            with open(os.path.join(entry, 'meta.json')) as f:
+                meta = json.load(f)
+            for rel in meta['files']:
+                dst = os.path.join(cwd, rel)
+                if not os.path.isdir(os.path.dirname(dst)):
+                    os.makedirs(os.path.dirname(dst))
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                link_or_copy(os.path.join(entry, 'files', rel), dst)
+        except (OSError, ValueError):
+            # not cached, or evicted while linking
+            self.stats['misses'] += 1
+            return None
+
+        self.stats['hits'] += 1
+        self.stats['linked_bytes'] += meta['size']
+        self.stats['saved_seconds'] += meta['seconds']
+        try:
+            with self._db() as db:
+                db.execute('UPDATE entries SET last_used = ?, '
+                           'hits = hits + 1 WHERE key = ?',
+                           (time.time(), key))
+        except sqlite3.Error:
+            pass
+        return meta
+
+    def store(self, key, interface_name, cwd, files, runtime, seconds):
+        """ Keep the output files of a run in the cache.
+        """
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            return
+        tmp = '%s.%d.tmp' % (entry, os.getpid())
+        size = 0
+        for rel in files:
+            dst = os.path.join(tmp, 'files', rel)
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            # not a hardlink: the node directory keeps its writable files
+            link_or_copy(os.path.join(cwd, rel), dst, link=False)
+            os.chmod(dst, 0o444)
+            size += os.path.getsize(dst)
+        meta = dict(interface=interface_name, files=files, size=size,
+                    seconds=seconds, stdout=runtime.stdout,
+                    stderr=runtime.stderr,
+                    merged=getattr(runtime, 'merged', None))
+        if not os.path.isdir(tmp):
+            os.makedirs(tmp)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # stored by another process in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        self.stats['stored'] += 1
+        now = time.time()
+        try:
+            with self._db() as db:
+                db.execute('INSERT OR REPLACE INTO entries VALUES '
+                           '(?, ?, ?, ?, ?, ?, 0)',
+                           (key, interface_name, size, seconds, now, now))
+        except sqlite3.Error:
+            return
+        self.evict()
+
+    def evict(self, max_bytes=None):
+        """ Remove the least recently used entries until the cache is at most
+        max_bytes. Returns (entries removed, bytes freed).
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        db = self._db()
+        total = db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        removed, freed = 0, 0
+        if total <= max_bytes:
+            return removed, freed
+        rows = db.execute(
+            'SELECT key, size FROM entries ORDER BY last_used').fetchall()
+        for key, size in rows:
+            if total - freed <= max_bytes:
+                break
+            with db:
+                db.execute('DELETE FROM entries WHERE key = ?', (key,))
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+            removed += 1
+            freed += size
+        return removed, freed
+
+    def clear(self):
+        return self.evict(0)
+
+    def summary(self):
+        return self._db().execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(hits), 0),'
+            ' COALESCE(SUM(hits * seconds), 0) FROM entries').fetchone()
+
+    def report(self):
+        s = self.stats
+        lookups = s['hits'] + s['misses']
+        if not lookups:
+            return
+        print('result cache: %d lookups, %d hits (%.1f%%), %d stored; '
+              'linked %.1f GB instead of ~%.1f s of computation' % (
+                  lookups, s['hits'], 100. * s['hits'] / lookups,
+                  s['stored'], s['linked_bytes'] / 1024. ** 3,
+                  s['saved_seconds']))
+
+
+# --------------------------------------------------------- NiPype hook
+
+_installed = None
+
+
+def install(root=None, max_bytes=None):
+    """ Let the command line interfaces run in this process use the cache.
+    """
+    import atexit
+    from nipype.interfaces.base import CommandLine
+
+    global _installed
+    if _installed is not None:
+        return _installed[0]
+    cache = ResultCache(root, max_bytes)
+    original = CommandLine._run_interface
+
+    def _run_interface(self, runtime, *args, **kwargs):
+        cwd = os.path.abspath(runtime.cwd)
+        try:
+            key = interface_key(self)
+        except Exception:
+            # e.g. missing inputs: let the interface report it
+            return original(self, runtime, *args, **kwargs)
+
+        meta = cache.fetch(key, cwd)
+        if meta is not None:
+            runtime.cmdline = self.cmdline
+            runtime.stdout = meta['stdout']
+            runtime.stderr = meta['stderr']
+            runtime.merged = meta['merged']
+            runtime.returncode = 0
+            runtime.success_codes = kwargs.get(
+                'correct_return_codes', args[0] if args else (0,))
+            runtime.result_cache = key
+            return runtime
+
+        start = time.time()
+        runtime = original(self, runtime, *args, **kwargs)
+        seconds = time.time() - start
+        if runtime.returncode in getattr(runtime, 'success_codes', (0,)) \
+                and not _staged(cwd):
+            files = _output_files(self._list_outputs(), cwd)
+            if files is not None:
+                cache.store(key, type(self).__name__, cwd, files, runtime,
+                            seconds)
+        return runtime
+
+    CommandLine._run_interface = _run_interface
+    _installed = (cache, original)
+    pid = os.getpid()
+    atexit.register(lambda: os.getpid() == pid and cache.report())
+    return cache
+
+
+class CacheSettings(object):
+    """ Settings of the result cache carried by a node: unpickling it (in
+    the process running the node) installs the cache.
+    """
+
+    def __init__(self, root=None, max_bytes=None):
+        self.root = cache_root(root)
+        self.max_bytes = max_bytes
+
+    def __getstate__(self):
+        return dict(root=self.root, max_bytes=self.max_bytes)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        install(self.root, self.max_bytes)
+
+
+def enable(workflow, root=None, max_bytes=None):
+    """ Use the result cache for the nodes of workflow (and its
+    subworkflows), here and in the processes running them.
+    """
+    if max_bytes is None:
+        max_bytes = default_max_bytes()
+    if not max_bytes:
+        return workflow
+    settings = CacheSettings(root, max_bytes)
+    install(settings.root, max_bytes)
+    for node in workflow._get_all_nodes():
+        node.result_cache = settings
+    return workflow
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Result cache of command line interfaces.')
+    parser.add_argument('--root', default=None,
+                        help='Default: workingdirs/result-cache.')
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser('stats')
+    p = sub.add_parser('evict', help='Remove the least recently used '
+                                     'entries beyond a size.')
+    p.add_argument('--max-gb', type=float, default=None)
+    sub.add_parser('clear')
+    args = parser.parse_args()
+
+    cache = ResultCache(args.root)
+    if args.command == 'stats':
+        n, size, hits, saved = cache.summary()
+        print('%s: %d results, %.1f of %.1f GB, %d hits (~%.1f s saved)' % (
+            cache.root, n, size / 1024. ** 3, cache.max_bytes / 1024. ** 3,
+            hits, saved))
+    elif args.command in ('evict', 'clear'):
+        max_bytes = 0 if args.command == 'clear' else (
+            None if args.max_gb is None else args.max_gb * 1024 ** 3)
+        removed, freed = cache.evict(max_bytes)
+        print('removed %d results, %.1f GB' % (removed, freed / 1024. ** 3))
+    else:
+        parser.print_help()
@@ -7,18 +7,22 @@ import os                                    # system functions
 import nipype.interfaces.io as nio           # Data i/o
 import nipype.interfaces.utility as util     # utility
 import nipype.pipeline.engine as pe          # pypeline engine
-import nipype.algorithms.modelgen as model   # model generation
-import nipype.algorithms.rapidart as ra      # artifact detection
+from nhp_bids import lazy_import, write_graph
+import maths_fusion
+model = lazy_import('nipype.algorithms.modelgen')  # model generation
+ra = lazy_import('nipype.algorithms.rapidart')     # artifact detection
 import nipype.interfaces.fsl as fsl          # fsl
 from nipype.interfaces.utility import IdentityInterface
 
 from nipype.pipeline.engine import Workflow, Node, MapNode
+from link_datasink import LinkDataSink
 
 from nipype import config
-config.enable_debug_mode()
 
 
-def run_workflow():
+def run_workflow(fuse=False):
+    config.enable_debug_mode()
+
     # ------------------ Specify variables
     ds_root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 
@@ -60,7 +64,7 @@ def run_workflow():
 
     # ------------------ Output Files
     # Datasink
-    outputfiles = Node(nio.DataSink(
+    outputfiles = Node(LinkDataSink(
         base_directory=ds_root,
         container=output_dir,
         parameterization=True),
@@ -121,8 +125,20 @@ def run_workflow():
     workflow.stop_on_first_crash = True
     workflow.keep_inputs = True
     workflow.remove_unnecessary_outputs = False
-    workflow.write_graph()
+    if fuse:
+        # dilmask -> erode as one fslmaths command
+        maths_fusion.fuse(workflow)
+    write_graph(workflow)
     workflow.run()
 
 if __name__ == '__main__':
-    run_workflow()
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Skull strip the functionals with their manual masks.')
+    parser.add_argument('--fuse', action='store_true',
+                        help='Run chains of fslmaths nodes as one fslmaths '
+                             'command, without the intermediate images '
+                             '(maths_fusion.py).')
+    args = parser.parse_args()
+
+    run_workflow(**vars(args))
@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+
+""" Run command line nodes on node-local scratch instead of the shared tree.
+
+Under the PBS plugin every node of a job reads its inputs from, and writes
+its outputs and temporary files to, ~/NHP-BIDS over the network (for
+AFNIAllinSlices thousands of slices per run). With a workflow enabled
+(enable()), a command line interface whose node directory is in the
+shared tree runs in
+
+    <stage>/work/<node directory>      the command's working directory
+    <stage>/inputs/<input file>        copies of its input files
+
+where <stage> is $NHP_STAGE_DIR, else $TMPDIR, else the system temporary
+directory (plus /nhp-stage), resolved in the process running the node. The
+input files (inputs of the interface that are files in the shared tree,
+$NHP_STAGE_SHARED or the dataset, with their related files, e.g. .hdr of
+an .img) are copied in parallel; a copy that is already staged with the
+same size and modification time is used as it is. Commands writing their
+temporary files to the working directory (afni_allin_slices.py) keep them
+on the local disk.
+
+After the command the files of its outputs are copied back to the node
+directory in parallel, with an MD5 of the data checked against a reread of
+the copy and an atomic rename, and the paths in the result are those in
+the shared tree. The copies are done before NiPype saves the result of the
+node: a job killed while copying (walltime, preemption) leaves the node
+without a result, so it runs again, and a copy that cannot be verified
+fails the node. Each process prints the files staged, found staged and
+copied back when it exits.
+
+To try it without a cluster, use one directory for the shared tree and
+another one for the local disk:
+
+    NHP_STAGE_SHARED=/data/shared NHP_STAGE_DIR=/data/local \\
+        python preprocessing_workflow.py --stage ...
+
+selftest does so with a node whose job is killed while it copies its
+outputs back, and checks that the node has no result and runs again:
+
+    python -m staging [--stage-dir DIR] selftest [--shared DIR]
+    python -m staging clean [--stage-dir DIR]
+"""
+
+import glob
+import hashlib
+import os
+import shutil
+import signal
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from nipype.interfaces.base import (CommandLine, CommandLineInputSpec, File,
+                                    TraitedSpec)
+
+from link_datasink import CHUNK_SIZE, transfer
+
+
+ds_root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+N_THREADS = 8
+COPY_RETRIES = 3
+
+
+def stage_root(root=None):
+    if root is None:
+        root = os.environ.get('NHP_STAGE_DIR')
+    if root is None:
+        root = os.path.join(os.environ.get('TMPDIR', tempfile.gettempdir()),
+                            'nhp-stage')
+    return os.path.abspath(root)
+
+
+def shared_root(root=None):
+    if root is None:
+        root = os.environ.get('NHP_STAGE_SHARED', ds_root)
+    return os.path.realpath(root)
+
+
+def _under(path, root):
+    return path.startswith(os.path.join(root, ''))
+
+
+def _map_paths(value, fn):
+    if isinstance(value, str):
+        return fn(value)
+    if isinstance(value, (list, tuple)):
+        return type(value)(_map_paths(v, fn) for v in value)
+    if isinstance(value, dict):
+        return dict((k, _map_paths(v, fn)) for k, v in value.items())
+    return value
+
+
+def _paths(value):
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            yield from _paths(v)
+    elif isinstance(value, dict):
+        for v in value.values():
+            yield from _paths(v)
+
+
+def file_md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        fadvise = getattr(os, 'posix_fadvise', None)
+        if fadvise is not None:
+            # read it back from the file system, not from the page cache
+            fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_verified(src, dst, tmp_dir, retries=COPY_RETRIES):
+    """ Copy src to dst, checking the MD5 of the data read from src against
+    that of the copy read back, and rename the copy (written in tmp_dir, on
+    the file system of dst) to dst. Returns the number of bytes copied.
+    """
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp = os.path.join(tmp_dir, '%s.%d.%d' % (
+        os.path.basename(dst), os.getpid(), threading.get_ident()))
+    for attempt in range(retries):
+        try:
+            digest = hashlib.md5()
+            with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+                for chunk in iter(lambda: fsrc.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    fdst.write(chunk)
+                fdst.flush()
+                os.fsync(fdst.fileno())
+            if file_md5(tmp) == digest.hexdigest():
+                shutil.copystat(src, tmp)
+                os.replace(tmp, dst)
+                return os.path.getsize(dst)
+        finally:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+    raise IOError('%s: copy to %s did not match after %d attempts' % (
+        src, dst, retries))
+
+
+class Stager(object):
+    def __init__(self, root=None, shared=None):
+        self.root = stage_root(root)
+        self.shared = shared_root(shared)
+        self.work_root = os.path.join(self.root, 'work')
+        self.inputs_root = os.path.join(self.root, 'inputs')
+        self._pool = ThreadPoolExecutor(N_THREADS)
+        self._lock = threading.Lock()
+        self._active = False
+        self.stats = dict((k, [0, 0]) for k in
+                          ('staged', 'already staged', 'copied back'))
+        self.failed = []
+
+    def _count(self, what, path):
+        with self._lock:
+            self.stats[what][0] += 1
+            self.stats[what][1] += os.path.getsize(path)
+
+    def local(self, path):
+        """ Where a file of the shared tree is staged. """
+        return self.inputs_root + path
+
+    def shared_path(self, path):
+        for root in (self.work_root, self.inputs_root):
+            if _under(path, root):
+                return path[len(root):]
+        return path
+
+    # ------------------------------------------------------------ inputs
+
+    def stage_inputs(self, interface):
+        """ Point the file inputs of interface at local copies. Returns the
+        original values and the local copies.
+        """
+        from nipype.interfaces.base import isdefined
+        from nipype.utils.filemanip import get_related_files
+
+        originals, files = dict(), set()
+        for name, value in interface.inputs.get_traitsfree().items():
+            if not isdefined(value):
+                continue
+            found = [os.path.realpath(p) for p in _paths(value)
+                     if os.path.isabs(p) and os.path.isfile(p)]
+            found = [p for p in found if _under(p, self.shared)]
+            if found:
+                originals[name] = value
+                for path in found:
+                    files.update(p for p in get_related_files(path)
+                                 if os.path.isfile(p))
+
+        def stage(path):
+            local = self.local(path)
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+            method = transfer(path, local, 'copy')
+            self._count('already staged' if method == 'unchanged'
+                        else 'staged', local)
+
+        list(self._pool.map(stage, sorted(files)))
+
+        def to_local(path):
+            if os.path.isabs(path) and os.path.realpath(path) in files:
+                return self.local(os.path.realpath(path))
+            return path
+
+        for name, value in originals.items():
+            setattr(interface.inputs, name, _map_paths(value, to_local))
+        return originals, set(self.local(p) for p in files)
+
+    # ----------------------------------------------------------- outputs
+
+    def _output_files(self, outputs, staged):
+        """ [(local file, shared file)] of the outputs on local disk. """
+        from nipype.utils.filemanip import get_related_files
+
+        pairs = []
+        for path in _paths(outputs):
+            if not (os.path.isabs(path) and _under(path, self.root)) or \
+                    path in staged:
+                continue
+            if os.path.isdir(path):
+                files = [os.path.join(d, name)
+                         for d, _, names in os.walk(path) for name in names]
+            else:
+                files = [p for p in get_related_files(path)
+                         if os.path.isfile(p)]
+            pairs.extend((p, self.shared_path(p)) for p in files
+                         if p not in staged)
+        return sorted(set(pairs))
+
+    def copy_back(self, pairs, node_dir, local_dir):
+        """ Copy pairs back to the shared tree, the files in parallel, then
+        remove local_dir. Raises if a copy cannot be verified.
+        """
+        tmp_dir = os.path.join(node_dir, '_staging')
+        # the partial copies of a job killed while copying
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        def copy(pair):
+            src, dst = pair
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            copy_verified(src, dst, tmp_dir)
+            self._count('copied back', dst)
+
+        try:
+            list(self._pool.map(copy, pairs))
+        except Exception as e:
+            self.failed.append((node_dir, e))
+            raise
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        shutil.rmtree(local_dir, ignore_errors=True)
+
+    def copy_all_back(self, local_dir, node_dir):
+        """ Whatever a failed command left, for the crash report. """
+        for d, _, names in os.walk(local_dir):
+            for name in names:
+                src = os.path.join(d, name)
+                dst = self.shared_path(src)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                transfer(src, dst, 'copy')
+        print('staging: copied %s back to %s' % (local_dir, node_dir))
+
+    # --------------------------------------------------------------- run
+
+    def run(self, interface, original, args, kwargs):
+        node_dir = os.path.realpath(str(kwargs.get('cwd') or os.getcwd()))
+        if self._active or not _under(node_dir, self.shared):
+            return original(interface, *args, **kwargs)
+
+        cwd = os.getcwd()
+        local_dir = self.work_root + node_dir
+        shutil.rmtree(local_dir, ignore_errors=True)
+        os.makedirs(local_dir)
+        originals, staged = self.stage_inputs(interface)
+        if 'cwd' in kwargs:
+            kwargs['cwd'] = local_dir
+        self._active = True
+        os.chdir(local_dir)
+        try:
+            result = original(interface, *args, **kwargs)
+        except BaseException:
+            self.copy_all_back(local_dir, node_dir)
+            raise
+        finally:
+            os.chdir(cwd)
+            self._active = False
+            for name, value in originals.items():
+                setattr(interface.inputs, name, value)
+
+        runtime = result.runtime
+        if getattr(runtime, 'traceback', None):
+            self.copy_all_back(local_dir, node_dir)
+        elif result.outputs is not None:
+            values = result.outputs.get()
+            self.copy_back(self._output_files(values, staged), node_dir,
+                           local_dir)
+            changed = dict()
+            for name, value in values.items():
+                mapped = _map_paths(value, self.shared_path)
+                if mapped != value:
+                    changed[name] = mapped
+            result.outputs.trait_set(**changed)
+        else:
+            shutil.rmtree(local_dir, ignore_errors=True)
+        if isinstance(result.inputs, dict):
+            result.inputs = _map_paths(result.inputs, self.shared_path)
+        runtime.cwd = node_dir
+        if isinstance(getattr(runtime, 'cmdline', None), str):
+            runtime.cmdline = runtime.cmdline.replace(
+                self.inputs_root + os.sep, os.sep).replace(
+                self.work_root + os.sep, os.sep)
+        return result
+
+    def report(self):
+        if not any(n for n, _ in self.stats.values()) and not self.failed:
+            return
+        print('staging (%s): %s' % (
+            self.root, ', '.join('%s %d files (%.2f GB)' % (
+                what, n, size / 1024. ** 3)
+                for what, (n, size) in self.stats.items())))
+        for node_dir, e in self.failed:
+            print('  FAILED to copy back %s: %s' % (node_dir, e))
+
+
+# --------------------------------------------------------- NiPype hook
+
+_installed = None
+
+
+def install(root=None, shared=None):
+    """ Run the command line interfaces of this process on local scratch.
+    """
+    import atexit
+
+    global _installed
+    if _installed is not None:
+        return _installed[0]
+    stager = Stager(root, shared)
+    original = CommandLine.run
+
+    def run(self, *args, **kwargs):
+        return stager.run(self, original, args, kwargs)
+
+    CommandLine.run = run
+    _installed = (stager, original)
+    pid = os.getpid()
+    atexit.register(lambda: os.getpid() == pid and stager.report())
+    return stager
+
+
+def uninstall():
+    global _installed
+    if _installed is not None:
+        CommandLine.run = _installed[1]
+        _installed = None
+
+
+class StageSettings(object):
+    """ Staging settings carried by a node: unpickling it (in the process
+    running the node) installs the staging there. The stage directory is
+    that of the process, unless given.
+    """
+
+    def __init__(self, root=None, shared=None):
+        self.root = root
+        self.shared = shared_root(shared)
+
+    def __getstate__(self):
+        return dict(root=self.root, shared=self.shared)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        install(self.root, self.shared)
+
+
+def enable(workflow, root=None, shared=None):
+    """ Stage the command line nodes of workflow (and its subworkflows)
+    here and in the processes running them.
+    """
+    settings = StageSettings(root, shared)
+    install(root, settings.shared)
+    for node in workflow._get_all_nodes():
+        node.staging = settings
+    return workflow
+
+
+# ---------------------------------------------------------- self test
+
+class _CopyInputSpec(CommandLineInputSpec):
+    in_file = File(exists=True, mandatory=True, argstr='%s', position=0)
+    out_file = File('copy.dat', usedefault=True, argstr='%s', position=1)
+
+
+class _CopyOutputSpec(TraitedSpec):
+    out_file = File(exists=True)
+
+
+class _Copy(CommandLine):
+    """ cp, the command of the self test. """
+    _cmd = 'cp'
+    input_spec = _CopyInputSpec
+    output_spec = _CopyOutputSpec
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs['out_file'] = os.path.abspath(self.inputs.out_file)
+        return outputs
+
+
+def _killed_copy(src, dst, tmp_dir, retries=COPY_RETRIES):
+    """ Half of copy_verified, then the end of a job killed by PBS. """
+    os.makedirs(tmp_dir, exist_ok=True)
+    with open(src, 'rb') as fsrc, \
+            open(os.path.join(tmp_dir, os.path.basename(dst)), 'wb') as fdst:
+        fdst.write(fsrc.read(os.path.getsize(src) // 2))
+        fdst.flush()
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def selftest(root=None, shared=None):
+    """ Run a node of the shared directory on the local one (temporary
+    directories unless given), with its job killed while it copies its
+    outputs back, then again. Returns whether the killed job left the node
+    without result or output and the node ran again.
+    """
+    import multiprocessing
+    import nipype.pipeline.engine as pe
+
+    tmp_dirs = []
+    if root is None:
+        root = tempfile.mkdtemp(prefix='nhp-local-')
+        tmp_dirs.append(root)
+    if shared is None:
+        shared = tempfile.mkdtemp(prefix='nhp-shared-')
+        tmp_dirs.append(shared)
+    shared = shared_root(shared)
+    data = os.path.join(shared, 'data.bin')
+    with open(data, 'wb') as f:
+        f.write(os.urandom(1024 ** 2))
+    node_dir = os.path.join(shared, 'workingdirs', 'staging_selftest',
+                            'copy')
+    out_file = os.path.join(node_dir, 'copy.dat')
+    shutil.rmtree(node_dir, ignore_errors=True)
+
+    def run():
+        workflow = pe.Workflow(name='staging_selftest',
+                               base_dir=os.path.join(shared, 'workingdirs'))
+        workflow.add_nodes([pe.Node(_Copy(in_file=data), name='copy')])
+        enable(workflow, root, shared)
+        workflow.run()
+
+    def killed_job():
+        globals()['copy_verified'] = _killed_copy
+        run()
+
+    job = multiprocessing.get_context('fork').Process(target=killed_job)
+    job.start()
+    job.join()
+
+    def results():
+        return glob.glob(os.path.join(node_dir, 'result_*.pklz'))
+
+    checks = [
+        ('job killed', job.exitcode == -signal.SIGKILL),
+        ('no result', not results()),
+        ('no output', not os.path.exists(out_file)),
+    ]
+    run()
+    checks += [
+        ('ran again', bool(results()) and
+         _installed[0].stats['copied back'][0] == 1),
+        ('output verified', os.path.isfile(out_file) and
+         file_md5(out_file) == file_md5(data)),
+        ('no partial copies', not os.path.exists(
+            os.path.join(node_dir, '_staging'))),
+    ]
+    uninstall()
+    for what, ok in checks:
+        print('%-20s %s' % (what, 'ok' if ok else 'FAILED'))
+    for tmp_dir in tmp_dirs:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return all(ok for _, ok in checks)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Node-local staging of command line nodes.')
+    parser.add_argument('--stage-dir', default=None,
+                        help='Default: $NHP_STAGE_DIR or $TMPDIR/nhp-stage.')
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser('clean', help='Remove the staged inputs and working '
+                                 'directories.')
+    p = sub.add_parser('selftest', help='Kill a staged job while it copies '
+                                        'its outputs back and check that '
+                                        'its node runs again.')
+    p.add_argument('--shared', default=None,
+                   help='Directory standing in for the shared tree. '
+                        'Default: a temporary directory, as the stage '
+                        'directory.')
+    args = parser.parse_args()
+
+    root = stage_root(args.stage_dir)
+    if args.command == 'selftest':
+        import sys
+        sys.exit(0 if selftest(args.stage_dir, args.shared) else 1)
+    elif args.command == 'clean':
+        shutil.rmtree(root, ignore_errors=True)
+        print('removed %s' % root)
+    else:
+        parser.print_help()
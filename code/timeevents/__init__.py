@@ -1,2 +1,3 @@
 
-from timeevents.process import process_time_events
+from timeevents.process import (process_time_events,
+                                process_time_events_handles)
@@ -15,6 +15,14 @@ def process_events(event_log, TR, in_nvols):
 
     return process_events_for_task(event_log, TR, in_nvols)
 
+
+def process_events_to_handles(event_log, TR, in_nvols):
+    # necessary for importing with NiPype
+    from artifacts import save_events
+    from timeevents.process import process_events
+    cond_events, end_time_s, nvols = process_events(event_log, TR, in_nvols)
+    return save_events(cond_events), end_time_s, nvols
+
 import nipype.interfaces.utility as niu
 
 
@@ -23,3 +31,11 @@ process_time_events = niu.Function(
     output_names=['out_events', 'out_end_time_s', 'out_nvols'],
     function=process_events,
 )
+
+# as process_time_events, with out_events the handle of the events (see
+# artifacts.py) instead of the DataFrames
+process_time_events_handles = niu.Function(
+    input_names=['event_log', 'TR', 'in_nvols'],
+    output_names=['out_events', 'out_end_time_s', 'out_nvols'],
+    function=process_events_to_handles,
+)
@@ -7,17 +7,20 @@ import os                                    # system functions
 import nipype.interfaces.io as nio           # Data i/o
 import nipype.interfaces.utility as util     # utility
 import nipype.pipeline.engine as pe          # pypeline engine
-import nipype.algorithms.modelgen as model   # model generation
-import nipype.algorithms.rapidart as ra      # artifact detection
+from nhp_bids import lazy_import, write_graph
+model = lazy_import('nipype.algorithms.modelgen')  # model generation
+ra = lazy_import('nipype.algorithms.rapidart')     # artifact detection
 import nipype.interfaces.fsl as fsl          # fsl
+afni = lazy_import('nipype.interfaces.afni')       # afni
 from nipype.interfaces.utility import IdentityInterface
 
 from nipype.pipeline.engine import Workflow, Node, MapNode
 
 from nipype import config
-config.enable_debug_mode()
 
 from nipype.interfaces.base import File
+from link_datasink import LinkDataSink
+import resultcache
 
 
 class ApplyXFMInputSpecRefName(fsl.preprocess.ApplyXFMInputSpec):
@@ -36,7 +39,16 @@ class ApplyXFMRefName(fsl.FLIRT):
 ds_root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 
 
-def create_workflow():
+def create_workflow(method='flirt'):
+    """ Transform the manual mask (in the space of manualmask_func_ref) to
+    every functional.
+
+    method='flirt' registers each functional to manualmask_func_ref with
+    FLIRT and applies the inverted matrix. method='premc' skips the
+    registration and inverts premc_matrix instead: the run -> reference
+    matrix (oned_matrix_save) that the pre-motion-correction already
+    computed with 3dAllineate.
+    """
     workflow = Workflow(
         name='transform_manual_mask')
 
@@ -46,8 +58,43 @@ def create_workflow():
         'manualmask',
         'manualmask_func_ref',
         'funcs',
+        'premc_matrix',
     ]), name='in')
 
+    if method == 'premc':
+        def inverse_matvec(matrices):
+            if isinstance(matrices, str):
+                matrices = [matrices]
+            return [[(m, 'I')] for m in matrices]
+
+        # The 3dAllineate matrix maps reference (base) coordinates to the
+        # run's (source) coordinates. With the run as base, -1Dmatrix_apply
+        # needs the inverse: run -> reference coordinates.
+        invert = MapNode(afni.CatMatvec(oneline=True,
+                                        out_file='ref_to_func.aff12.1D'),
+                         name='invert',
+                         iterfield=['in_file'],
+                         )
+        workflow.connect(inputs, ('premc_matrix', inverse_matvec),
+                         invert, 'in_file')
+
+        # Transform the manualmask to be aligned with func
+        funcreg = MapNode(afni.Allineate(
+                              final_interpolation='nearestneighbour',
+                              outputtype='NIFTI_GZ'),
+                          name='funcreg',
+                          iterfield=['in_matrix', 'reference'],
+                          )
+        workflow.connect(invert, 'out_file',
+                         funcreg, 'in_matrix')
+        workflow.connect(inputs, 'manualmask',
+                         funcreg, 'in_file')
+        workflow.connect(inputs, 'funcs',
+                         funcreg, 'reference')
+        return workflow
+
+    assert method == 'flirt', 'Unknown method %s' % method
+
     # Find the transformation matrix func_ref -> func
     # First find transform from func to manualmask's ref func
     findtrans = MapNode(fsl.FLIRT(),
@@ -85,7 +132,9 @@ def create_workflow():
     return workflow
 
 
-def run_workflow():
+def run_workflow(result_cache=False):
+    config.enable_debug_mode()
+
     # ------------------ Specify variables
     subject_list = ['eddy']
     session_list = ['20170511']
@@ -127,7 +176,7 @@ def run_workflow():
 
     # ------------------ Output Files
     # Datasink
-    outputfiles = Node(nio.DataSink(
+    outputfiles = Node(LinkDataSink(
         base_directory=ds_root,
         container=output_dir,
         parameterization=True),
@@ -179,8 +228,21 @@ def run_workflow():
     wrapper.stop_on_first_crash = True
     wrapper.keep_inputs = True
     wrapper.remove_unnecessary_outputs = False
-    wrapper.write_graph()
+    write_graph(wrapper)
+    if result_cache:
+        # outputs of identical commands are shared with the other workflows
+        resultcache.enable(wrapper)
     wrapper.run()
 
 if __name__ == '__main__':
-    run_workflow()
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Transform the manual masks to the functionals.')
+    parser.add_argument('--result-cache', action='store_true',
+                        help='Link the outputs of commands that already ran '
+                             'with the same inputs, in this or another '
+                             'workflow, instead of running them again '
+                             '(resultcache.py).')
+    args = parser.parse_args()
+
+    run_workflow(**vars(args))
@@ -8,8 +8,9 @@ import nipype.interfaces.io as nio           # Data i/o
 import nipype.interfaces.fsl as fsl          # fsl
 import nipype.interfaces.utility as util     # utility
 import nipype.pipeline.engine as pe          # pypeline engine
-import nipype.algorithms.modelgen as model   # model generation
-import nipype.algorithms.rapidart as ra      # artifact detection
+from nhp_bids import lazy_import, write_graph
+model = lazy_import('nipype.algorithms.modelgen')  # model generation
+ra = lazy_import('nipype.algorithms.rapidart')     # artifact detection
 from nipype.interfaces.utility import IdentityInterface
 
 from nipype.interfaces.fsl.preprocess import PRELUDE
@@ -20,10 +21,33 @@ from nipype.pipeline.engine import Workflow, Node, MapNode, JoinNode
 
 from nipype import config
 
+from fieldmap import calc_vsm_interface, apply_vsm_interface
+from fieldmap import prepare_fieldmap_interface
+from fieldmap import native_unwrap_interface
+from link_datasink import LinkDataSink
+
 # This pipeline depends on transform_manual_fmap_mask
 
+ds_root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def create_workflow(unwarp_direction='y', vsm_method='fugue',
+                    use_fmap_cache=False, unwrap_method='prelude',
+                    cache_dir=os.path.join(ds_root, 'derivatives',
+                                           'fieldmap-cache')):
+    """ vsm_method='fugue' runs FUGUE separately for functionals and masks,
+    vsm_method='native' computes the voxel shift map once per fieldmap
+    (cached in cache_dir with use_fmap_cache) and applies it to functionals and masks together,
+    with linear interpolation and without FUGUE's mask_file and
+    asym_se_time, so its results differ slightly.
 
-def create_workflow(unwarp_direction='y'):
+    With use_fmap_cache, the fieldmap derivatives (radians, unwrapped, rad/s,
+    unmasked) are looked up in cache_dir instead of being recomputed by every
+    run.
+
+    unwrap_method='native' replaces PRELUDE by the DCT-based unwrapper of
+    fieldmap/unwrap.py.
+    """
     workflow = Workflow(
         name='func_unwarp')
 
@@ -42,64 +66,92 @@ def create_workflow(unwarp_direction='y'):
         'funcmasks',
     ]), name='out')
 
-    # --- --- --- --- --- --- --- Convert to radians --- --- --- --- --- ---
-
-    # fslmaths $FUNCDIR/"$SUB"_B0_phase -div 100 -mul 3.141592653589793116
-    #     -odt float $FUNCDIR/"$SUB"_B0_phase_rescaled
-
-    # in_file --> out_file
-    phase_radians = Node(fsl.ImageMaths(
-        op_string='-mul 3.141592653589793116 -div 100',
-        out_data_type='float',
-        suffix='_radians',
-    ), name='phaseRadians')
-
-    workflow.connect(inputs, 'fmap_phasediff', phase_radians, 'in_file')
-
-    # --- --- --- --- --- --- --- Unwrap Fieldmap --- --- --- --- --- ---
-    # --- Unwrap phase
-    # prelude -p $FUNCDIR/"$SUB"_B0_phase_rescaled
-    #         -a $FUNCDIR/"$SUB"_B0_magnitude
-    #         -o $FUNCDIR/"$SUB"_fmri_B0_phase_rescaled_unwrapped
-    #         -m $FUNCDIR/"$SUB"_B0_magnitude_brain_mask
-    #  magnitude_file, phase_file [, mask_file] --> unwrapped_phase_file
-    unwrap = MapNode(
-        PRELUDE(),
-        name='unwrap',
-        iterfield=['mask_file'],
-    )
-
-    workflow.connect([
-        (inputs, unwrap, [('fmap_magnitude', 'magnitude_file')]),
-        (inputs, unwrap, [('fmap_mask', 'mask_file')]),
-        (phase_radians, unwrap, [('out_file', 'phase_file')]),
-    ])
-
-    # --- --- --- --- --- --- --- Convert to Radians / Sec --- --- --- --- ---
-    # fslmaths $FUNCDIR/"$SUB"_B0_phase_rescaled_unwrapped
-    #          -mul 200 $FUNCDIR/"$SUB"_B0_phase_rescaled_unwrapped
-    rescale = MapNode(
-        fsl.ImageMaths(op_string='-mul 200'),
-        name='rescale',
-        iterfield=['in_file'],
-    )
-
-    workflow.connect(unwrap, 'unwrapped_phase_file',
-                     rescale, 'in_file')
-
-    # --- --- --- --- --- --- --- Unmask fieldmap --- --- --- --- ---
-
-    unmask_phase = MapNode(
-        FUGUE(
-            save_unmasked_fmap=True,
-            unwarp_direction=unwarp_direction,
-        ),
-        name='unmask_phase',
-        iterfield=['mask_file', 'fmap_in_file'],
-    )
-
-    workflow.connect(rescale, 'out_file', unmask_phase, 'fmap_in_file')
-    workflow.connect(inputs, 'fmap_mask', unmask_phase, 'mask_file')
+    if use_fmap_cache:
+        # The radians / unwrap / rad/s / unmask chain only depends on the
+        # fieldmap, so it is computed once per fieldmap and looked up by
+        # every other run (see fieldmap/prepare.py).
+        prepare_fmap = MapNode(
+            prepare_fieldmap_interface,
+            name='prepare_fmap',
+            iterfield=['mask'],
+        )
+        prepare_fmap.inputs.unwarp_direction = unwarp_direction
+        prepare_fmap.inputs.cache_dir = cache_dir
+        prepare_fmap.inputs.unwrap_method = unwrap_method
+
+        workflow.connect([
+            (inputs, prepare_fmap, [('fmap_phasediff', 'phasediff'),
+                                    ('fmap_magnitude', 'magnitude'),
+                                    ('fmap_mask', 'mask')]),
+        ])
+        unmasked_fmap = (prepare_fmap, 'unmasked_file')
+    else:
+        # --- --- --- --- --- --- --- Convert to radians --- --- --- --- --- ---
+
+        # fslmaths $FUNCDIR/"$SUB"_B0_phase -div 100 -mul 3.141592653589793116
+        #     -odt float $FUNCDIR/"$SUB"_B0_phase_rescaled
+
+        # in_file --> out_file
+        phase_radians = Node(fsl.ImageMaths(
+            op_string='-mul 3.141592653589793116 -div 100',
+            out_data_type='float',
+            suffix='_radians',
+        ), name='phaseRadians')
+
+        workflow.connect(inputs, 'fmap_phasediff', phase_radians, 'in_file')
+
+        # --- --- --- --- --- --- --- Unwrap Fieldmap --- --- --- --- --- ---
+        # --- Unwrap phase
+        # prelude -p $FUNCDIR/"$SUB"_B0_phase_rescaled
+        #         -a $FUNCDIR/"$SUB"_B0_magnitude
+        #         -o $FUNCDIR/"$SUB"_fmri_B0_phase_rescaled_unwrapped
+        #         -m $FUNCDIR/"$SUB"_B0_magnitude_brain_mask
+        #  magnitude_file, phase_file [, mask_file] --> unwrapped_phase_file
+        if unwrap_method == 'native':
+            unwrap_interface = native_unwrap_interface
+        else:
+            assert unwrap_method == 'prelude', (
+                'Unknown unwrap_method %s' % unwrap_method)
+            unwrap_interface = PRELUDE()
+        unwrap = MapNode(
+            unwrap_interface,
+            name='unwrap',
+            iterfield=['mask_file'],
+        )
+
+        workflow.connect([
+            (inputs, unwrap, [('fmap_magnitude', 'magnitude_file')]),
+            (inputs, unwrap, [('fmap_mask', 'mask_file')]),
+            (phase_radians, unwrap, [('out_file', 'phase_file')]),
+        ])
+
+        # --- --- --- --- --- --- --- Convert to Radians / Sec --- --- --- --- ---
+        # fslmaths $FUNCDIR/"$SUB"_B0_phase_rescaled_unwrapped
+        #          -mul 200 $FUNCDIR/"$SUB"_B0_phase_rescaled_unwrapped
+        rescale = MapNode(
+            fsl.ImageMaths(op_string='-mul 200'),
+            name='rescale',
+            iterfield=['in_file'],
+        )
+
+        workflow.connect(unwrap, 'unwrapped_phase_file',
+                         rescale, 'in_file')
+
+        # --- --- --- --- --- --- --- Unmask fieldmap --- --- --- --- ---
+
+        unmask_phase = MapNode(
+            FUGUE(
+                save_unmasked_fmap=True,
+                unwarp_direction=unwarp_direction,
+            ),
+            name='unmask_phase',
+            iterfield=['mask_file', 'fmap_in_file'],
+        )
+
+        workflow.connect(rescale, 'out_file', unmask_phase, 'fmap_in_file')
+        workflow.connect(inputs, 'fmap_mask', unmask_phase, 'mask_file')
+
+        unmasked_fmap = (unmask_phase, 'fmap_out_file')
 
     # --- --- --- --- --- --- --- Undistort functionals --- --- --- --- ---
     # phasemap_in_file = phasediff
@@ -108,6 +160,46 @@ def create_workflow(unwarp_direction='y'):
     # dwell_time = 0.0005585 s
     # unwarp_direction
 
+    if vsm_method == 'native':
+        # The voxel shift map only depends on the fieldmap, so it is computed
+        # (and with use_fmap_cache cached) once and then applied to the functional and its mask
+        # in a single resampling pass.
+        calc_vsm = MapNode(
+            calc_vsm_interface,
+            name='calc_vsm',
+            iterfield=['fmap_file'],
+        )
+        calc_vsm.inputs.dwell_time = 0.0005585
+        calc_vsm.inputs.unwarp_direction = unwarp_direction
+        calc_vsm.inputs.smooth3d = 2.0
+        calc_vsm.inputs.median_2dfilter = True
+        calc_vsm.inputs.cache_dir = cache_dir if use_fmap_cache else None
+
+        workflow.connect(unmasked_fmap[0], unmasked_fmap[1],
+                         calc_vsm, 'fmap_file')
+
+        undistort = MapNode(
+            apply_vsm_interface,
+            name='undistort',
+            iterfield=['vsm_file', 'in_file', 'mask_file'],
+        )
+        undistort.inputs.unwarp_direction = unwarp_direction
+
+        workflow.connect(calc_vsm, 'vsm_file',
+                         undistort, 'vsm_file')
+        workflow.connect(inputs, 'funcs',
+                         undistort, 'in_file')
+        workflow.connect(inputs, 'funcmasks',
+                         undistort, 'mask_file')
+
+        workflow.connect(undistort, 'out_file',
+                         outputs, 'funcs')
+        workflow.connect(undistort, 'out_mask_file',
+                         outputs, 'funcmasks')
+        return workflow
+
+    assert vsm_method == 'fugue', 'Unknown vsm_method %s' % vsm_method
+
     undistort = MapNode(
         FUGUE(
             dwell_time=0.0005585,
@@ -121,7 +213,7 @@ def create_workflow(unwarp_direction='y'):
         iterfield=['in_file', 'mask_file', 'fmap_in_file'],
     )
 
-    workflow.connect(unmask_phase, 'fmap_out_file',
+    workflow.connect(unmasked_fmap[0], unmasked_fmap[1],
                      undistort, 'fmap_in_file')
     workflow.connect(inputs, 'fmap_mask',
                      undistort, 'mask_file')
@@ -129,7 +221,7 @@ def create_workflow(unwarp_direction='y'):
                      undistort, 'in_file')
 
     undistort_masks = undistort.clone('undistort_masks')
-    workflow.connect(unmask_phase, 'fmap_out_file',
+    workflow.connect(unmasked_fmap[0], unmasked_fmap[1],
                      undistort_masks, 'fmap_in_file')
     workflow.connect(inputs, 'fmap_mask',
                      undistort_masks, 'mask_file')
@@ -144,7 +236,8 @@ def create_workflow(unwarp_direction='y'):
     return workflow
 
 
-def run_workflow():
+def run_workflow(vsm_method='fugue', use_fmap_cache=False,
+                 unwrap_method='prelude'):
     raise Exception("This code was not tested after refactoring to be used by "
                     "preprocessing_workflow.py.")
     config.enable_debug_mode()
@@ -200,7 +293,7 @@ def run_workflow():
 
     # ------------------ Output Files
     # Datasink
-    outputfiles = Node(nio.DataSink(
+    outputfiles = Node(LinkDataSink(
         base_directory=ds_root,
         container=output_dir,
         parameterization=True),
@@ -230,7 +323,9 @@ def run_workflow():
                       [('subject_id', 'subject_id'),
                        ('session_id', 'session_id')])])
 
-    undistort_flow = create_workflow()
+    undistort_flow = create_workflow(vsm_method=vsm_method,
+                                     use_fmap_cache=use_fmap_cache,
+                                     unwrap_method=unwrap_method)
 
     # Connect sub-workflow inputs
     workflow.connect([(inputfiles, undistort_flow,
@@ -253,8 +348,72 @@ def run_workflow():
     workflow.stop_on_first_crash = True
     workflow.keep_inputs = True
     workflow.remove_unnecessary_outputs = False
-    workflow.write_graph()
+    write_graph(workflow)
     workflow.run()
 
+def run_sweep(args):
+    """ Sweep over FUGUE settings (instead of scratch/undistort-v0.*.sh).
+    """
+    from fieldmap.sweep import make_grid, run_sweep
+
+    grid = make_grid(polys=args.poly, smooth3s=args.smooth3,
+                     medians=[bool(m) for m in args.median],
+                     erodes=[bool(e) for e in args.erode])
+    return run_sweep(args.phasediff, args.magnitude, args.mask,
+                     args.func, args.t1, args.out_dir, grid=grid,
+                     dwell_time=args.dwell_time,
+                     unwarp_direction=args.unwarp_direction,
+                     n_procs=args.n_procs,
+                     unwrap_method=args.unwrap_method,
+                     cache_dir=os.path.join(ds_root, 'derivatives',
+                                            'fieldmap-cache')
+                     if args.fmap_cache else None)
+
+
 if __name__ == '__main__':
-    run_workflow()
+    import argparse
+    parser = argparse.ArgumentParser(
+            description='Undistort functionals using the fieldmap.')
+    parser.add_argument('--sweep', action='store_true',
+            help='Sweep over unwarping settings and rank them by normalised '
+                 'mutual information with the T1.')
+    parser.add_argument('--phasediff', help='Fieldmap phase difference.')
+    parser.add_argument('--magnitude', help='Fieldmap magnitude.')
+    parser.add_argument('--mask', help='Fieldmap mask.')
+    parser.add_argument('--func', help='Functional (3D or 4D).')
+    parser.add_argument('--t1', help='T1 in the space of the functional.')
+    parser.add_argument('-o', '--out-dir', default='undistort-sweep',
+            help='Directory for the unwarped variants and sweep.tsv.')
+    parser.add_argument('--poly', type=int, nargs='+',
+            default=[0, 1, 2, 3, 4, 5],
+            help='Polynomial orders (0 = no fit).')
+    parser.add_argument('--smooth3', type=float, nargs='+',
+            default=[0., 1., 2.], help='3D smoothing sigmas (mm).')
+    parser.add_argument('--median', type=int, nargs='+', default=[0, 1],
+            choices=[0, 1], help='2D median filter off/on.')
+    parser.add_argument('--erode', type=int, nargs='+', default=[0, 1],
+            choices=[0, 1], help='Erode the mask before unmasking off/on.')
+    parser.add_argument('--dwell-time', type=float, default=0.0005585)
+    parser.add_argument('--unwarp-direction', default='y')
+    parser.add_argument('--unwrap-method', default='prelude',
+            choices=['prelude', 'native'],
+            help='Phase unwrapping with PRELUDE or the native unwrapper.')
+    parser.add_argument('-j', '--n-procs', type=int, default=None,
+            help='Number of worker processes.')
+    parser.add_argument('--vsm-method', default='fugue',
+            choices=['fugue', 'native'],
+            help='Unwarp with FUGUE, or with a voxel shift map computed once '
+                 'per fieldmap (linear interpolation, slightly different '
+                 'results).')
+    parser.add_argument('--fmap-cache', action='store_true',
+            help='Look up the fieldmap derivatives in '
+                 'derivatives/fieldmap-cache instead of computing them for '
+                 'every run.')
+    args = parser.parse_args()
+
+    if args.sweep:
+        run_sweep(args)
+    else:
+        run_workflow(vsm_method=args.vsm_method,
+                     use_fmap_cache=args.fmap_cache,
+                     unwrap_method=args.unwrap_method)
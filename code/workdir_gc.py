@@ -0,0 +1,511 @@
+#!/usr/bin/env python3
+
+""" Reclaim the space of the working directories.
+
+The workflows keep every input and output of every node
+(keep_inputs=True, remove_unnecessary_outputs=False), and nodes like
+mc.afni_allin_slices leave their temporary files in the node directory,
+so workingdirs/ grows by tens of GB per session. The collector walks the
+NiPype node directories below the given roots and sorts the files of each
+node into
+
+  provenance  _0x<hash>.json, _inputs.pklz, _node.pklz, result_*.pklz,
+              _report/, command.txt (always kept)
+  outputs     the files in the result of the node
+  scratch     everything else (temporary files of the command)
+
+and then, following the policy:
+
+  scratch     is deleted (unless keep_scratch)
+  relink      an output that is also in derivatives/ (same inode, or same
+              size, modification time and content, compared in full; a
+              LinkDataSink copy keeps the mtime) is replaced by a hardlink
+              to that copy: the space is reclaimed and the node stays
+              cached. The files of derivatives/ are not changed.
+  keep_last   the outputs of the N most recent runs of each node (per
+              workflow and node name, over subjects, sessions and runs) are
+              kept; the older ones are collected
+  max_gb      of the outputs still kept, the oldest are collected until
+              they fit in max_gb
+
+Collecting (action='delete') removes the outputs of a node, or moves them
+into _gc_outputs.tar.gz in the node directory (action='compress'; undo
+with `restore`). Either way only the provenance remains, and the hash file
+is renamed to _0x<hash>.json.gc so that NiPype runs the node again when it
+is needed instead of failing on its missing outputs. Inputs of the nodes
+that are kept (as listed in their hash files) and files shared with other
+directories (e.g. the result cache, hardlinked outputs) are never
+collected.
+
+Nothing is changed without --apply; the report lists what would be
+reclaimed:
+
+    python -m workdir_gc                        # report for workingdirs/
+    python -m workdir_gc --keep-last 2 --max-gb 500 --apply
+    python -m workdir_gc restore workingdirs/level1flow/.../mc
+
+The same runs after every successful Workflow.run() with install(), e.g.
+`nhp_bids.py --gc --gc-keep-last 2 preprocess ...`.
+"""
+
+import fnmatch
+import glob
+import json
+import os
+import re
+import tarfile
+import time
+from collections import OrderedDict
+
+
+ds_root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+PROVENANCE = ['_0x*.json', '_0x*.json.gc', '_inputs.pklz', '_node.pklz',
+              'result_*.pklz', 'command.txt', '_gc_outputs.tar.gz']
+ARCHIVE = '_gc_outputs.tar.gz'
+# smaller outputs are not compared with derivatives/
+MIN_RELINK_SIZE = 1024 ** 2
+
+_mapflow_re = re.compile(r'%smapflow%s_[^%s]+$' % (os.sep, os.sep, os.sep))
+
+
+class NodeDir(object):
+    """ The files of a node directory, sorted into provenance, outputs and
+    scratch.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        match = _mapflow_re.search(path)
+        # MapNode subnodes belong to the run of their MapNode
+        self.instance = path[:match.start()] if match else path
+        self.name = os.path.basename(self.instance)
+        result = os.path.join(path, 'result_%s.pklz' %
+                              os.path.basename(path))
+        self.mtime = os.path.getmtime(result) if os.path.exists(result) \
+            else os.path.getmtime(path)
+        self.result_file = result
+        self.outputs, self.scratch = [], []
+        self.provenance = []
+        self._sort()
+
+    def _own_files(self):
+        """ Files of the node directory, not of its subnodes.
+        """
+        for root, dirs, names in os.walk(self.path):
+            if root == self.path and 'mapflow' in dirs:
+                dirs.remove('mapflow')
+            for name in names:
+                yield os.path.join(root, name)
+
+    def _result_paths(self):
+        """ Paths referenced by the result of the node, or None if it can't
+        be read.
+        """
+        from nipype.utils.filemanip import loadpkl
+
+        try:
+            result = loadpkl(self.result_file)
+            outputs = result.outputs.get() if result.outputs else {}
+        except Exception:
+            return None
+        paths = set()
+
+        def add(value):
+            if isinstance(value, (list, tuple)):
+                for v in value:
+                    add(v)
+            elif isinstance(value, dict):
+                for v in value.values():
+                    add(v)
+            elif isinstance(value, str) and os.path.isabs(value):
+                paths.add(os.path.normpath(value))
+        add(outputs)
+        return paths
+
+    def _sort(self):
+        referenced = self._result_paths()
+        stems = set(_stem(r) for r in referenced or [])
+        for path in self._own_files():
+            rel = os.path.relpath(path, self.path)
+            if rel.startswith('_report' + os.sep) or \
+                    (os.sep not in rel and
+                     any(fnmatch.fnmatch(rel, p) for p in PROVENANCE)):
+                self.provenance.append(path)
+            elif referenced is None or path in referenced or \
+                    any(path.startswith(r + os.sep) for r in referenced) or \
+                    _stem(path) in stems:
+                # (with the .hdr of an .img)
+                self.outputs.append(path)
+            elif os.path.islink(path):
+                # links to the inputs
+                self.provenance.append(path)
+            else:
+                self.scratch.append(path)
+
+    def input_files(self):
+        """ Files the node depends on, from its hash file.
+        """
+        files = set()
+        for hash_file in glob.glob(os.path.join(self.path, '_0x*.json')):
+            try:
+                with open(hash_file) as f:
+                    content = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            def add(value):
+                if isinstance(value, list):
+                    for v in value:
+                        add(v)
+                elif isinstance(value, dict):
+                    for v in value.values():
+                        add(v)
+                elif isinstance(value, str) and os.path.isabs(value):
+                    files.add(os.path.normpath(value))
+            add(content)
+        return files
+
+    def node_type(self, root):
+        """ (top directory below root, node name), e.g.
+        ('level1flow', 'mc').
+        """
+        rel = os.path.relpath(self.path, root)
+        return (rel.split(os.sep)[0], self.name)
+
+
+def _stem(path):
+    for ext in ('.nii.gz', '.img', '.hdr', '.nii'):
+        if path.endswith(ext):
+            return path[:-len(ext)]
+    return path
+
+
+def find_nodes(root):
+    """ The node directories below root (directories with a result or
+    node pickle).
+    """
+    nodes = []
+    for path, dirs, names in os.walk(root):
+        base = os.path.basename(path)
+        if 'result_%s.pklz' % base in names or '_node.pklz' in names:
+            nodes.append(NodeDir(path))
+        dirs[:] = [d for d in dirs if d != '_report']
+    return nodes
+
+
+class DerivativesIndex(object):
+    """ The files of derivatives/, to find the outputs that were sunk.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(ds_root, 'derivatives')
+        self.inodes = set()
+        self.by_size = dict()
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                f = os.path.join(root, name)
+                try:
+                    st = os.stat(f)
+                except OSError:
+                    continue
+                self.inodes.add((st.st_dev, st.st_ino))
+                if st.st_size >= MIN_RELINK_SIZE:
+                    self.by_size.setdefault(st.st_size, []).append(
+                        (f, st.st_mtime_ns))
+        self._digests = dict()
+
+    def _digest(self, path):
+        """ MD5 of the content of path, read once per index (a digest cached
+        by stat could be that of another file of the same size and mtime).
+        """
+        from hashcache import hash_file
+
+        digest = self._digests.get(path)
+        if digest is None:
+            digest = self._digests[path] = hash_file(path)
+        return digest
+
+    def find(self, path, st):
+        """ ('linked', None) if path is a file of derivatives/, ('copy',
+        derivative) if derivative has the same content and modification
+        time, else (None, None).
+        """
+        if (st.st_dev, st.st_ino) in self.inodes:
+            return 'linked', None
+        # a hardlink with another mtime would change the timestamp hash of
+        # the nodes reading it
+        candidates = [derivative for derivative, mtime_ns
+                      in self.by_size.get(st.st_size, [])
+                      if mtime_ns == st.st_mtime_ns]
+        if candidates:
+            digest = self._digest(path)
+            for derivative in candidates:
+                if self._digest(derivative) == digest:
+                    return 'copy', derivative
+        return None, None
+
+
+class Plan(object):
+    """ What collect() does (or would do) with the files of the nodes.
+    """
+
+    def __init__(self):
+        self.relink = []       # (working file, derivative, size)
+        self.collect = OrderedDict()  # node dir -> [(file, size)]
+        self.scratch = []      # (file, size)
+        self.kept = []         # node dirs whose outputs are kept
+        self.types = OrderedDict()  # node type -> counts
+
+    def _count(self, node_type, **counts):
+        row = self.types.setdefault(node_type, OrderedDict(
+            (k, 0) for k in ('nodes', 'kept', 'outputs', 'relink',
+                             'collect', 'scratch')))
+        for k, v in counts.items():
+            row[k] += v
+
+    def reclaimable(self):
+        return (sum(s for _, _, s in self.relink),
+                sum(s for files in self.collect.values() for _, s in files),
+                sum(s for _, s in self.scratch))
+
+
+def _size_if_freed(path):
+    """ Bytes freed by removing path (0 if it has other links).
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return 0, None
+    return (st.st_size if st.st_nlink == 1 else 0), st
+
+
+def plan(roots, keep_last=None, max_gb=None, relink=True, keep_scratch=False,
+         derivatives=None):
+    """ The Plan for the node directories below roots.
+    """
+    nodes = []
+    for root in roots:
+        root = os.path.abspath(root)
+        nodes.extend((root, node) for node in find_nodes(root))
+    out = Plan()
+
+    # runs of every node type, newest first
+    instances = OrderedDict()
+    for root, node in nodes:
+        node_type = node.node_type(root)
+        runs = instances.setdefault(node_type, OrderedDict())
+        runs.setdefault(node.instance, []).append(node)
+    keep = set()
+    for node_type, runs in instances.items():
+        ordered = sorted(runs.values(),
+                         key=lambda r: -max(n.mtime for n in r))
+        for run in ordered[:keep_last]:
+            keep.update(run)
+    if max_gb is not None:
+        budget = max_gb * 1024 ** 3
+        kept = sorted(keep, key=lambda n: -n.mtime)
+        keep, total = set(), 0
+        for node in kept:
+            size = sum(_size_if_freed(f)[0] for f in node.outputs)
+            if total + size > budget:
+                continue
+            total += size
+            keep.add(node)
+
+    protected = set()
+    for node in keep:
+        protected.update(node.input_files())
+
+    index = DerivativesIndex(derivatives) if relink else None
+    for root, node in nodes:
+        node_type = node.node_type(root)
+        kept = node in keep
+        out._count(node_type, nodes=1, kept=int(kept))
+        if kept:
+            out.kept.append(node.path)
+        if not keep_scratch:
+            for f in node.scratch:
+                size, _ = _size_if_freed(f)
+                out.scratch.append((f, size))
+                out._count(node_type, scratch=size)
+        for f in node.outputs:
+            size, st = _size_if_freed(f)
+            out._count(node_type, outputs=st.st_size if st else 0)
+            if not size:
+                # shared with derivatives/, the result cache, ...
+                continue
+            how, derivative = index.find(f, st) if index is not None and \
+                st.st_size >= MIN_RELINK_SIZE else (None, None)
+            if how == 'copy':
+                out.relink.append((f, derivative, size))
+                out._count(node_type, relink=size)
+            elif not kept and f not in protected:
+                out.collect.setdefault(node.path, []).append((f, size))
+                out._count(node_type, collect=size)
+    return out
+
+
+def _disable_hash(node_dir):
+    for hash_file in glob.glob(os.path.join(node_dir, '_0x*.json')):
+        os.rename(hash_file, hash_file + '.gc')
+
+
+def apply(out, action='delete'):
+    """ Carry out a Plan. Returns the bytes reclaimed.
+    """
+    reclaimed = 0
+    for f, size in out.scratch:
+        try:
+            os.remove(f)
+            reclaimed += size
+        except OSError:
+            pass
+    for f, derivative, size in out.relink:
+        tmp = os.path.join(os.path.dirname(f),
+                           '.%s.gc.tmp' % os.path.basename(f))
+        try:
+            st, dst = os.stat(f), os.stat(derivative)
+            if (st.st_size, st.st_mtime_ns) != (dst.st_size, dst.st_mtime_ns):
+                # changed since the plan
+                continue
+            os.link(derivative, tmp)
+            os.replace(tmp, f)
+            reclaimed += size
+        except OSError:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+    for node_dir, files in out.collect.items():
+        _disable_hash(node_dir)
+        if action == 'compress':
+            archive = os.path.join(node_dir, ARCHIVE)
+            # replaces the archive of an earlier collection (the node ran
+            # again since)
+            with tarfile.open(archive, 'w:gz') as tar:
+                for f, _ in files:
+                    tar.add(f, arcname=os.path.relpath(f, node_dir))
+            reclaimed -= os.path.getsize(archive)
+        for f, size in files:
+            os.remove(f)
+            reclaimed += size
+    return reclaimed
+
+
+def restore(node_dir):
+    """ Undo the collection of a node directory compressed by apply().
+    """
+    archive = os.path.join(node_dir, ARCHIVE)
+    if not os.path.exists(archive):
+        raise ValueError('%s has no %s' % (node_dir, ARCHIVE))
+    with tarfile.open(archive) as tar:
+        tar.extractall(node_dir)
+    for hash_file in glob.glob(os.path.join(node_dir, '_0x*.json.gc')):
+        os.rename(hash_file, hash_file[:-len('.gc')])
+    os.remove(archive)
+
+
+def report(out):
+    gb = 1024. ** 3
+    print('%-58s %6s %5s %9s %9s %9s %9s' % (
+        'node', 'runs', 'kept', 'outputs', 'relink', 'collect', 'scratch'))
+    for (top, name), row in sorted(out.types.items()):
+        if not (row['relink'] or row['collect'] or row['scratch']):
+            continue
+        print('%-58s %6d %5d %8.2fG %8.2fG %8.2fG %8.2fG' % (
+            '%s/%s' % (top, name), row['nodes'], row['kept'],
+            row['outputs'] / gb, row['relink'] / gb, row['collect'] / gb,
+            row['scratch'] / gb))
+    relink, collect, scratch = out.reclaimable()
+    print('reclaimable: %.2f GB (relink %.2f GB, collect %.2f GB in %d '
+          'nodes, scratch %.2f GB)' % (
+              (relink + collect + scratch) / gb, relink / gb, collect / gb,
+              len(out.collect), scratch / gb))
+
+
+def collect(roots, keep_last=None, max_gb=None, action='delete', relink=True,
+            keep_scratch=False, derivatives=None, dry_run=True):
+    """ Plan, report and (without dry_run) apply the collection of the
+    working directories below roots. Returns the Plan.
+    """
+    start = time.time()
+    out = plan(roots, keep_last, max_gb, relink, keep_scratch, derivatives)
+    report(out)
+    if not dry_run:
+        reclaimed = apply(out, action)
+        print('workdir gc: %.2f GB reclaimed in %.1f s' % (
+            reclaimed / 1024. ** 3, time.time() - start))
+    return out
+
+
+# --------------------------------------------------------- Post-run hook
+
+_installed = None
+
+
+def install(**policy):
+    """ Collect the working directory of every workflow after it ran
+    successfully, with the policy of collect().
+    """
+    from nipype.pipeline.engine import Workflow
+
+    global _installed
+    if _installed is not None:
+        return
+    original = Workflow.run
+
+    def run(workflow, *args, **kwargs):
+        result = original(workflow, *args, **kwargs)
+        root = os.path.join(workflow.base_dir or os.getcwd(), workflow.name)
+        collect([root], dry_run=False, **policy)
+        return result
+
+    Workflow.run = run
+    _installed = original
+
+
+def uninstall():
+    from nipype.pipeline.engine import Workflow
+
+    global _installed
+    if _installed is not None:
+        Workflow.run = _installed
+        _installed = None
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'restore':
+        for node_dir in sys.argv[2:]:
+            restore(node_dir)
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(
+        description='Reclaim the space of the NiPype working directories '
+                    '(report only, unless --apply).',
+        epilog='`restore <node dirs>` unpacks nodes collected with '
+               '--action compress.')
+    parser.add_argument('roots', nargs='*',
+                        default=[os.path.join(ds_root, 'workingdirs')])
+    parser.add_argument('--keep-last', type=int, default=None,
+                        help='Keep the outputs of the N most recent runs '
+                             'of every node.')
+    parser.add_argument('--max-gb', type=float, default=None,
+                        help='Keep at most this many GB of outputs.')
+    parser.add_argument('--action', choices=['delete', 'compress'],
+                        default='delete',
+                        help='What to do with collected outputs.')
+    parser.add_argument('--no-relink', dest='relink', action='store_false',
+                        help='Do not replace outputs by links to their '
+                             'copies in derivatives/.')
+    parser.add_argument('--keep-scratch', action='store_true',
+                        help='Keep the temporary files of the nodes.')
+    parser.add_argument('--derivatives', default=None,
+                        help='Default: derivatives/ of the dataset.')
+    parser.add_argument('--apply', action='store_true',
+                        help='Change the working directories.')
+    args = parser.parse_args()
+
+    collect(args.roots, args.keep_last, args.max_gb, args.action,
+            args.relink, args.keep_scratch, args.derivatives,
+            dry_run=not args.apply)